@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import IntegrityError, migrations
+from django.db.models import Count
+
+
+def check_for_double_billed_entries(apps, schema_editor):
+    """
+    Timeline entries, billed more than once before the index, should be resolved by hand — they are real money
+    """
+    Event = apps.get_model('accounting.Event')
+    duplicates = Event.objects \
+        .filter(event_type='class') \
+        .values('originator_type_id', 'originator_id') \
+        .annotate(count=Count('pk'), event_ids=ArrayAgg('pk')) \
+        .filter(count__gt=1) \
+        .order_by('originator_type_id', 'originator_id')
+
+    if duplicates:
+        raise IntegrityError(
+            'Timeline entries are billed more than once, resolve them before applying this migration: %s' %
+            '; '.join('entry %d (content type %d) by events %s' % (d['originator_id'], d['originator_type_id'], ', '.join(str(pk) for pk in sorted(d['event_ids']))) for d in duplicates)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounting', '0003_auto_20161012_1551'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_for_double_billed_entries, reverse_code=migrations.RunPython.noop),
+        migrations.RunSQL(
+            # a timeline entry can be billed only once. Customer inspired cancellations are not covered — the same class can be cancelled more than once
+            sql='''CREATE UNIQUE INDEX accounting_event_class_originator ON accounting_event (originator_type_id, originator_id)
+                WHERE event_type = 'class' ''',
+            reverse_sql='DROP INDEX accounting_event_class_originator',
+        ),
+    ]
@@ -1,6 +1,8 @@
+from django.apps import apps
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 
@@ -10,6 +12,25 @@ class EventManager(models.Manager):
             .filter(originator_id=originator.pk) \
             .filter(originator_type=ContentType.objects.get_for_model(originator))
 
+    def bill_timeline_entries(self, entry_ids):
+        """
+        Create 'class' events for timeline entries by a single INSERT ... SELECT. Already
+        billed entries are skipped by the unique index on the originator.
+
+        Returns the count of created events
+        """
+        TimelineEntry = apps.get_model('timeline.Entry')
+        with connection.cursor() as cursor:
+            cursor.execute(
+                '''
+                INSERT INTO {event} (teacher_id, event_type, timestamp, originator_type_id, originator_id)
+                SELECT teacher_id, 'class', %s, %s, id FROM {entry} WHERE id = ANY(%s)
+                ON CONFLICT (originator_type_id, originator_id) WHERE event_type = 'class' DO NOTHING
+                '''.format(event=self.model._meta.db_table, entry=TimelineEntry._meta.db_table),
+                [timezone.now(), ContentType.objects.get_for_model(TimelineEntry).pk, list(entry_ids)]
+            )
+            return cursor.rowcount
+
 
 class Event(models.Model):
     """
@@ -29,7 +50,7 @@ class Event(models.Model):
 
     originator_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     originator_id = models.PositiveIntegerField()
-    originator = GenericForeignKey('originator_type', 'originator_id')
+    originator = GenericForeignKey('originator_type', 'originator_id')  # a class can be billed only once, see the unique index in migration 0004
 
     def __str__(self):
         return '%s: %s' % (self.teacher, self.event_type)
@@ -1,21 +1,76 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
 from accounting.models import Event as AccEvent
 from elk.celery import app as celery
 from elk.logging import logger
+from market.models import Class, Subscription
+from teachers import schedule_versions
 from timeline.models import Entry as TimelineEntry
 
 
 @celery.task
 def bill_timeline_entries():
-    for entry in TimelineEntry.objects.to_be_marked_as_finished().filter(taken_slots__gte=1):
-        entry.is_finished = True
-        entry.save()
-
-        if not AccEvent.objects.by_originator(entry).count():
-            ev = AccEvent(
-                teacher=entry.teacher,
-                originator=entry,
-                event_type='class',
-            )
-            ev.save()
+    """
+    Mark passed timeline entries as finished and bill them. Everything is done by a couple of
+    set-based queries, so catching up after a worker outage does not take long:
+        - entries are marked as finished by a single UPDATE
+        - accounting events are created by a single INSERT ... SELECT, the database does
+          not allow to bill the same entry twice, see AccEvent.objects.bill_timeline_entries()
+        - classes of the entries are marked as used in chunks by finish_classes()
+
+    Chunks, that have been lost (e.g. a worker died), are picked up by the next run: classes
+    of entries, finished within settings.BILLING_CATCHUP_WINDOW, that are still not marked as
+    used, are finished again.
+    """
+    with transaction.atomic():
+        entry_ids = list(
+            TimelineEntry.objects.to_be_marked_as_finished()
+            .filter(taken_slots__gte=1)
+            .select_for_update(skip_locked=True)  # entries, locked by a parallel run, will be billed by it
+            .order_by('pk')
+            .values_list('pk', flat=True)
+        )
+        if entry_ids:
+            TimelineEntry.objects.filter(pk__in=entry_ids).update(is_finished=True)
+
+            billed = AccEvent.objects.bill_timeline_entries(entry_ids)
+            if billed < len(entry_ids):
+                logger.warning('Tried to bill %d already billed timeline entries' % (len(entry_ids) - billed))
+
+            for teacher_id in set(TimelineEntry.objects.filter(pk__in=entry_ids).values_list('teacher_id', flat=True)):
+                schedule_versions.bump(teacher_id)  # bulk update does not send signals
+
+    lost = set(
+        Class.objects
+        .filter(timeline__is_finished=True, is_fully_used=False)
+        .filter(timeline__end__gte=timezone.now() - settings.BILLING_CATCHUP_WINDOW)
+        .values_list('timeline_id', flat=True)
+    ) - set(entry_ids)
+    if lost:
+        logger.warning('Finishing classes of %d timeline entries, that were finished before' % len(lost))
+        entry_ids = sorted(set(entry_ids) | lost)
+
+    for i in range(0, len(entry_ids), settings.BILLING_CHUNK_SIZE):
+        chunk = entry_ids[i:i + settings.BILLING_CHUNK_SIZE]
+        if settings.BILLING_ASYNC:
+            finish_classes.delay(chunk)
         else:
-            logger.warning('Tried to bill already billed timeline entry')
+            finish_classes(chunk)
+
+
+@celery.task
+def finish_classes(entry_ids):
+    """
+    Mark classes of finished timeline entries as used, and notify their subscriptions,
+    the same way Class.mark_as_fully_used() does
+    """
+    classes = Class.objects.filter(timeline__in=entry_ids, is_fully_used=False)
+    subscription_ids = set(classes.filter(subscription__isnull=False).values_list('subscription_id', flat=True))
+
+    classes.update(is_fully_used=True)
+
+    for subscription in Subscription.objects.filter(pk__in=subscription_ids):
+        subscription.update_first_lesson_date()
+        subscription.check_is_fully_finished()
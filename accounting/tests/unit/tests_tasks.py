@@ -1,11 +1,16 @@
+from datetime import timedelta
 from unittest.mock import MagicMock, patch
 
+from django.test import override_settings
 from freezegun import freeze_time
 from mixer.backend.django import mixer
 
 from accounting.models import Event as AccEvent
-from accounting.tasks import bill_timeline_entries
-from elk.utils.testing import TestCase, create_teacher
+from accounting.tasks import bill_timeline_entries, finish_classes
+from elk.utils.testing import TestCase, create_customer, create_teacher
+from lessons import models as lessons
+from market.models import Class, Subscription
+from products.models import Product1
 from timeline.models import Entry as TimelineEntry
 
 
@@ -54,7 +59,6 @@ class TestBillTimelineEntries(TestCase):
 
             bill_timeline_entries()
 
-            self.entry._Entry__update_slots = MagicMock()  # disable timeslot updating — the entry needs to have slots for beeing billed
             self.entry.is_finished = False
             self.entry.save()
 
@@ -63,3 +67,105 @@ class TestBillTimelineEntries(TestCase):
                 bill_timeline_entries()
 
                 self.assertEqual(logger.warning.call_count, 1)
+
+
+@freeze_time('2032-05-11')
+class TestSetBasedBilling(TestCase):
+    def setUp(self):
+        self.teacher = create_teacher()
+
+    def _entry(self, hour):
+        return mixer.blend(
+            TimelineEntry,
+            taken_slots=1,
+            teacher=self.teacher,
+            start=self.tzdatetime(2032, 5, 10, hour, 0),
+            is_finished=False,
+        )
+
+    def test_many_entries_are_billed_at_once(self):
+        entries = [self._entry(hour) for hour in range(10, 15)]
+
+        bill_timeline_entries()
+
+        self.assertEqual(TimelineEntry.objects.filter(is_finished=True).count(), 5)
+        self.assertEqual(AccEvent.objects.count(), 5)
+        self.assertEqual(set(AccEvent.objects.values_list('originator_id', flat=True)), set(entry.pk for entry in entries))
+
+    def test_the_database_does_not_allow_double_billing(self):
+        entry = self._entry(10)
+        self.assertEqual(AccEvent.objects.bill_timeline_entries([entry.pk]), 1)
+        self.assertEqual(AccEvent.objects.bill_timeline_entries([entry.pk]), 0)
+
+        self.assertEqual(AccEvent.objects.count(), 1)
+
+    @override_settings(BILLING_ASYNC=True, BILLING_CHUNK_SIZE=2)
+    @patch('accounting.tasks.finish_classes')
+    def test_classes_are_finished_in_chunks(self, finish_classes):
+        entries = [self._entry(hour) for hour in range(10, 15)]
+
+        bill_timeline_entries()
+
+        self.assertEqual(finish_classes.delay.call_count, 3)
+        chunks = [call[0][0] for call in finish_classes.delay.call_args_list]
+        self.assertEqual(sum(chunks, []), sorted(entry.pk for entry in entries))
+
+    @patch('accounting.tasks.finish_classes')
+    def test_lost_chunks_are_picked_up_by_the_next_run(self, finish_classes):
+        finished = self._finished_entry_with_unused_class(start=self.tzdatetime(2032, 5, 10, 9, 0))  # its chunk has never been processed
+        self._finished_entry_with_unused_class(start=self.tzdatetime(2032, 5, 1, 9, 0))  # out of the catch-up window
+        entry = self._entry(10)
+
+        bill_timeline_entries()
+
+        finish_classes.assert_called_once_with(sorted([finished.pk, entry.pk]))
+        self.assertEqual(AccEvent.objects.count(), 1)  # the earlier entry is not billed again
+
+    def _finished_entry_with_unused_class(self, start):
+        entry = mixer.blend(TimelineEntry, teacher=self.teacher, start=start, end=start + timedelta(minutes=30), is_finished=True)
+        c = Class(customer=create_customer(), lesson_type=lessons.OrdinaryLesson.get_contenttype())
+        c.save()
+        Class.objects.filter(pk=c.pk).update(timeline=entry, is_scheduled=True)
+        return entry
+
+    @patch('accounting.tasks.finish_classes')
+    def test_nothing_to_finish(self, finish_classes):
+        bill_timeline_entries()
+
+        finish_classes.assert_not_called()
+
+
+class TestFinishClasses(TestCase):
+    fixtures = ('products', 'lessons')
+
+    def setUp(self):
+        self.customer = create_customer()
+        self.subscription = Subscription(
+            customer=self.customer,
+            product=Product1.objects.get(pk=1),
+            buy_price=150,
+        )
+        self.subscription.save()
+
+    def test_classes_are_marked_as_used(self):
+        entry = mixer.blend(TimelineEntry, teacher=create_teacher(), is_finished=True)
+        c = self.subscription.classes.first()
+        Class.objects.filter(pk=c.pk).update(timeline=entry, is_scheduled=True)
+
+        finish_classes([entry.pk])
+
+        c.refresh_from_db()
+        self.assertTrue(c.is_fully_used)
+
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.first_lesson_date, entry.start)
+        self.assertFalse(self.subscription.is_fully_used)  # the subscription has other classes
+
+    def test_subscription_is_marked_as_fully_used(self):
+        entry = mixer.blend(TimelineEntry, teacher=create_teacher(), is_finished=True)
+        self.subscription.classes.update(timeline=entry, is_scheduled=True)
+
+        finish_classes([entry.pk])
+
+        self.subscription.refresh_from_db()
+        self.assertTrue(self.subscription.is_fully_used)
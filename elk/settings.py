@@ -24,6 +24,7 @@ TIME_FORMAT = 'h:i a'
 
 TEACHER_GROUP_ID = 2  # PK of django.contrib.auth.models.Group with the teacher django-admin permissions
 PLANNING_DELTA = timedelta(hours=18)  # booking lag
+SLOT_HOLD_TIMEOUT = timedelta(minutes=5)  # slots are held for customers between checking and booking, see market.slot_holds
 CLASS_IS_FINISHED_AFTER = timedelta(minutes=60)  # mark classes as finished after this time
 
 FORMAT_MODULE_PATH = [
@@ -299,6 +300,12 @@ ANYMAIL = {
 }
 EMAIL_BACKEND = env('EMAIL_BACKEND')
 EMAIL_ASYNC = env.bool('EMAIL_ASYNC')
+PRE_START_NOTIFICATIONS_ASYNC = env.bool('PRE_START_NOTIFICATIONS_ASYNC', default=False)  # send pre-start notifications by ETA tasks, see timeline.tasks
+BILLING_ASYNC = env.bool('BILLING_ASYNC', default=False)  # mark classes of billed entries as used by separate tasks, see accounting.tasks
+BILLING_CHUNK_SIZE = 200
+BILLING_CATCHUP_WINDOW = timedelta(days=1)  # classes of entries, finished earlier, are not checked for lost chunks
+EXTERNAL_CALENDAR_POLLING_CONCURRENCY = 8  # calendars polled at the same time, see extevents.tasks
+PAIR_STUDENTS = env.bool('PAIR_STUDENTS', default=False)  # periodically pair students with unscheduled paired lessons, see market.pairing
 
 CACHES = {
     'default': env.cache(),
@@ -311,18 +318,28 @@ CELERY_TASK_SERIALIZER = 'pickle'
 CELERYBEAT_SCHEDULE = {
     'check_classes_that_will_start_soon': {
         'task': 'timeline.tasks.notify_15min_to_class',
-        'schedule': timedelta(minutes=1),
+        'schedule': timedelta(minutes=10) if PRE_START_NOTIFICATIONS_ASYNC else timedelta(minutes=1),  # with ETA tasks it is only a safety net
     },
     'update_google_calendars': {
         'task': 'extevents.tasks.update_google_calendars',
-        'schedule': timedelta(minutes=5),
+        'schedule': timedelta(minutes=1),  # every calendar has its own polling interval, see extevents.models.ExternalEventSource
     },
     'bill_timeline_entries': {
         'task': 'accounting.tasks.bill_timeline_entries',
         'schedule': timedelta(minutes=1),
     },
+    'reconcile_taken_slots': {
+        'task': 'timeline.tasks.reconcile_taken_slots',
+        'schedule': timedelta(minutes=30),
+    },
 }
 
+if PAIR_STUDENTS:
+    CELERYBEAT_SCHEDULE['pair_students'] = {
+        'task': 'market.tasks.pair_students',
+        'schedule': timedelta(hours=1),
+    }
+
 
 CELERY_TIMEZONE = env('TIME_ZONE')
 
@@ -0,0 +1,48 @@
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from elk.utils.cache import get_or_calculate
+from elk.utils.testing import TestCase
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestGetOrCalculate(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_value_is_cached(self):
+        calculate = MagicMock(return_value=[100500])
+
+        self.assertEqual(get_or_calculate('tst-key', calculate, 60), [100500])
+        self.assertEqual(get_or_calculate('tst-key', calculate, 60), [100500])
+
+        self.assertEqual(calculate.call_count, 1)
+
+    def test_lock_is_released(self):
+        get_or_calculate('tst-key', lambda: 'value', 60)
+        self.assertIsNone(cache.get('tst-key:lock'))
+
+    def test_lock_is_released_on_exception(self):
+        with self.assertRaises(ZeroDivisionError):
+            get_or_calculate('tst-key', lambda: 1 / 0, 60)
+
+        self.assertIsNone(cache.get('tst-key:lock'))
+
+    @patch('elk.utils.cache.time')
+    def test_waiting_for_the_other_process(self, time):
+        cache.add('tst-key:lock', 1)  # the other process is calculating the value
+        time.sleep = MagicMock(side_effect=lambda seconds: cache.set('tst-key', 'value from the other process'))
+        calculate = MagicMock(return_value='value')
+
+        self.assertEqual(get_or_calculate('tst-key', calculate, 60), 'value from the other process')
+        calculate.assert_not_called()
+
+    @patch('elk.utils.cache.time')
+    def test_waiting_for_too_long(self, time):
+        cache.add('tst-key:lock', 1)  # the other process has hung up
+        calculate = MagicMock(return_value='value')
+
+        self.assertEqual(get_or_calculate('tst-key', calculate, 60), 'value')
+        self.assertEqual(calculate.call_count, 1)
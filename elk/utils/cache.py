@@ -0,0 +1,43 @@
+"""
+Cache helpers
+"""
+import time
+
+from django.core.cache import cache
+
+LOCK_TIMEOUT = 30  # seconds, should be longer then the longest calculation
+WAIT_STEP = 0.05   # seconds
+WAIT_STEPS = 100   # give up waiting for the other process after 5 seconds
+
+
+def get_or_calculate(key, calculate, timeout):
+    """
+    Get a value from the cache, or calculate and store it.
+
+    Stampede protection: only one process calculates a cold key, others wait for
+    the result. The lock is taken with cache.add(), that is atomic in memcached and
+    redis. If the calculating process takes too long, the waiting one calculates
+    the value by itself.
+
+    The value should not be None.
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock = key + ':lock'
+    if cache.add(lock, 1, LOCK_TIMEOUT):
+        try:
+            value = calculate()
+            cache.set(key, value, timeout)
+        finally:
+            cache.delete(lock)
+        return value
+
+    for i in range(0, WAIT_STEPS):
+        time.sleep(WAIT_STEP)
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+    return calculate()
@@ -16,6 +16,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.test import TestCase as StockTestCase
+from django.test import TransactionTestCase as StockTransactionTestCase
 from django.test import Client, RequestFactory
 from django.utils import timezone
 from mixer.backend.django import mixer
@@ -29,6 +30,7 @@ from timeline.models import Entry as TimelineEntry
 
 __all__ = [
     'TestCase',
+    'TransactionTestCase',
     'ClientTestCase',
     'create_teacher',
     'create_customer',
@@ -119,7 +121,7 @@ def mock_request(customer=None):
     return request
 
 
-class TestCase(StockTestCase):
+class TestCaseMixin():
     @classmethod
     def setUpClass(cls):
         super().setUpClass()
@@ -161,6 +163,18 @@ class TestCase(StockTestCase):
         )
 
 
+class TestCase(TestCaseMixin, StockTestCase):
+    pass
+
+
+class TransactionTestCase(TestCaseMixin, StockTransactionTestCase):
+    """
+    Test case without a wrapping transaction, use it for testing code that
+    depends on transactions, e.g. concurrent scheduling.
+    """
+    pass
+
+
 class SuperUserTestCaseMixin():
     @classmethod
     def _generate_superuser(cls):
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extevents', '0007_auto_20161220_1326'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='next_poll',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='poll_interval',
+            field=models.DurationField(default=datetime.timedelta(0, 300)),
+        ),
+    ]
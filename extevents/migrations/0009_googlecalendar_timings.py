@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extevents', '0008_googlecalendar_conditional_polling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='last_fetch_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='googlecalendar',
+            name='last_parse_time',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
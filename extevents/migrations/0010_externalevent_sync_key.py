@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('extevents', '0009_googlecalendar_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='externalevent',
+            name='recurrence_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='externalevent',
+            name='uid',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
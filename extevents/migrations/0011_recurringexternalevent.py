@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('teachers', '0012_auto_20160910_1235'),
+        ('extevents', '0010_externalevent_sync_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringExternalEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('src_id', models.PositiveIntegerField()),
+                ('uid', models.CharField(blank=True, max_length=255)),
+                ('description', models.TextField()),
+                ('start', models.DateTimeField()),
+                ('duration', models.DurationField()),
+                ('rrule', models.TextField()),
+                ('tzid', models.CharField(blank=True, max_length=64)),
+                ('exdates', django.contrib.postgres.fields.ArrayField(base_field=models.DateTimeField(), blank=True, default=list, size=None)),
+                ('until', models.DateTimeField(blank=True, null=True)),
+                ('last_update', models.DateTimeField(auto_now=True)),
+                ('src_type', models.ForeignKey(limit_choices_to={'app_label': 'extevents'}, on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_busy_periods', to='teachers.Teacher')),
+            ],
+        ),
+    ]
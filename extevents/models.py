@@ -1,16 +1,34 @@
 import datetime
-from copy import deepcopy
+import hashlib
+import time
 
 import pytz
 import requests
+from dateutil import tz
 from dateutil.rrule import rrulestr
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.contrib.postgres.fields import ArrayField
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from icalendar import Calendar
 
 from elk.logging import logger
+from teachers import free_slots, schedule_versions
+
+
+def _as_aware(date):
+    """
+    Make a timezone-aware datetime from a datetime or a date, returned by icalendar. Floating times and dates are treated as UTC
+    """
+    if not isinstance(date, datetime.datetime):
+        return datetime.datetime.combine(date, datetime.time.min.replace(tzinfo=pytz.utc))
+
+    if date.tzinfo is None:
+        return pytz.utc.localize(date)
+
+    return date
 
 
 class ExternalEventManager(models.Manager):
@@ -44,18 +62,121 @@ class ExternalEvent(models.Model):
     description = models.TextField()
     last_update = models.DateTimeField(auto_now=True)
 
+    uid = models.CharField(max_length=255, blank=True)  # iCal UID
+    recurrence_id = models.CharField(max_length=64, blank=True)  # modified instance of a recurring event, empty for the other events
+
+    SYNC_FIELDS = ('start', 'end', 'description')
+
+    @property
+    def sync_key(self):
+        return (self.uid, self.recurrence_id)
+
+    def differs_from(self, other):
+        return any(getattr(self, field) != getattr(other, field) for field in self.SYNC_FIELDS)
+
+
+class RecurringExternalEventManager(models.Manager):
+    def by_src(self, src):
+        return self.get_queryset() \
+            .filter(src_id=src.pk) \
+            .filter(src_type=ContentType.objects.get_for_model(src))
+
+    def periods(self, start=None, end=None, teachers=None):
+        """
+        Occurrences of recurring events within the [start, end) window, a list of (teacher_id, start, end) tuples.
+
+        The whole requested window is expanded. Without the end, occurrences are generated
+        till DEFAULT_WINDOW, so open-ended rules never generate endless lists.
+        """
+        start = start or timezone.now()
+        end = end or start + RecurringExternalEvent.DEFAULT_WINDOW
+
+        rules = self.get_queryset() \
+            .filter(start__lt=end) \
+            .filter(Q(until__isnull=True) | Q(until__gt=start))
+
+        if teachers is not None:
+            rules = rules.filter(teacher__in=teachers)
+
+        return [(rule.teacher_id, occurrence_start, occurrence_end) for rule in rules for (occurrence_start, occurrence_end) in rule.occurrences(start, end)]
+
+
+class RecurringExternalEvent(models.Model):
+    """
+    Recurring external event, stored as a single row with the recurrence rule.
+
+    Occurrences are not stored — they are generated only for the window,
+    requested by :model:`market.AutoSchedule`, see RecurringExternalEvent.objects.periods()
+    """
+    DEFAULT_WINDOW = datetime.timedelta(weeks=52)
+
+    objects = RecurringExternalEventManager()
+
+    teacher = models.ForeignKey('teachers.Teacher', on_delete=models.CASCADE, related_name='recurring_busy_periods')
+
+    src_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, limit_choices_to={'app_label': 'extevents'})
+    src_id = models.PositiveIntegerField()
+    src = GenericForeignKey('src_type', 'src_id')
+
+    uid = models.CharField(max_length=255, blank=True)  # iCal UID
+    description = models.TextField()
+
+    start = models.DateTimeField()  # start of the first occurrence
+    duration = models.DurationField()
+    rrule = models.TextField()  # parsable by dateutil.rrulestr()
+    tzid = models.CharField(max_length=64, blank=True)  # timezone of the original event, rules are expanded in it to respect DST
+    exdates = ArrayField(models.DateTimeField(), default=list, blank=True)  # starts of excluded occurrences
+    until = models.DateTimeField(null=True, blank=True)  # end of the last occurrence, None for endless rules
+
+    last_update = models.DateTimeField(auto_now=True)
+
+    SYNC_FIELDS = ('description', 'start', 'duration', 'rrule', 'tzid', 'exdates', 'until')
+
+    @property
+    def sync_key(self):
+        return (self.uid,)
+
+    def differs_from(self, other):
+        return any(getattr(self, field) != getattr(other, field) for field in self.SYNC_FIELDS)
+
+    def occurrences(self, start, end):
+        """
+        Generate (start, end) tuples of occurrences, that intersect the [start, end) window
+        """
+        excluded = set(self.exdates)
+        for occurrence in self.rule().between(start - self.duration, end, inc=True):
+            if occurrence in excluded:
+                continue
+
+            if occurrence + self.duration > start and occurrence < end:
+                yield (occurrence, occurrence + self.duration)
+
+    def rule(self):
+        dtstart = self.start
+        if self.tzid and tz.gettz(self.tzid) is not None:
+            dtstart = dtstart.astimezone(tz.gettz(self.tzid))
+
+        return rrulestr(self.rrule, dtstart=dtstart)
+
 
 class ExternalEventSourceManager(models.Manager):
     def active(self):
         return self.get_queryset().filter(active=True).filter(teacher__active=True)
 
+    def due(self):
+        """
+        Active sources, that should be polled now
+        """
+        return self.active().filter(Q(next_poll__isnull=True) | Q(next_poll__lte=timezone.now()))
+
 
 class ExternalEventSource(models.Model):
     """
     Generic abstract class for an external events source. External events source
     may be google calendar, icloud or anything you want. Subclasses should
     implement the following two methods:
-        * `poll` method that popuates the self.events list
+        * `poll` method that popuates the self.events list, and, optionaly, the self.recurring_events
+          list with :model:`extevents.RecurringExternalEvent` instances
         * Relation to :model:`teachers.Teacher`, called 'teacher'
 
     Generic usage:
@@ -65,9 +186,18 @@ class ExternalEventSource(models.Model):
             calendar.poll()  # get new events, implemented in subclass
             calendar.update()  # update event database, implemented in this class
 
-    This will clean up previous events and store new ones, fetched
+    This will synchronize stored events with the new ones, fetched
     by the model:`extevents.GoogleCalendar`.poll() method.
+
+    When the source has not changed since the last update, poll() should set `changed`
+    to False — update() will not touch stored events then. Sources, that do not change,
+    are polled less frequently: the polling interval doubles after every poll without
+    changes, up to MAX_POLL_INTERVAL, see ExternalEventSource.objects.due().
     """
+    MIN_POLL_INTERVAL = datetime.timedelta(minutes=5)
+    MAX_POLL_INTERVAL = datetime.timedelta(hours=2)
+
+    POLLING_FIELDS = ('etag', 'last_modified', 'content_hash', 'poll_interval', 'next_poll', 'last_fetch_time', 'last_parse_time')
 
     objects = ExternalEventSourceManager()
 
@@ -75,36 +205,106 @@ class ExternalEventSource(models.Model):
     active = models.BooleanField(default=True)
     last_update = models.DateTimeField(auto_now=True)
 
+    etag = models.CharField(max_length=255, blank=True)  # HTTP headers of the last response, used for conditional requests
+    last_modified = models.CharField(max_length=255, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)  # sha256 of the last stored content
+
+    poll_interval = models.DurationField(default=MIN_POLL_INTERVAL)
+    next_poll = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    last_fetch_time = models.FloatField(null=True, blank=True)  # seconds, timings of the last poll
+    last_parse_time = models.FloatField(null=True, blank=True)
+
     events = []
+    recurring_events = []
+    changed = True
 
     def update(self):
         """
-        Clean previous stored events generated by the source and store new ones.
+        Synchronize stored events, generated by the source, with the polled ones.
 
         Notifies support when unsafe calendar update is performed, i.e. too much events got deleted.
         """
+        self.__schedule_next_poll()
+
+        if not self.changed:
+            self.save(update_fields=self.POLLING_FIELDS)
+            return
+
         if not self.__is_safe():  # warn admins if calendar update is unsafe
             logger.warning('Unsafe calendar update')
 
-        self.__clear_previous_events()
-        self.__save_events()
+        self.__sync_events()
 
-        if self.events:
+        if self.events or self.recurring_events:
             self.last_update = timezone.now()
             self.save()
+        else:
+            self.save(update_fields=self.POLLING_FIELDS)
+
+    def __schedule_next_poll(self):
+        """
+        Back off for sources, that do not change
+        """
+        if self.changed:
+            self.poll_interval = self.MIN_POLL_INTERVAL
+        else:
+            self.poll_interval = min(self.poll_interval * 2, self.MAX_POLL_INTERVAL)
+
+        self.next_poll = timezone.now() + self.poll_interval
 
-    def __clear_previous_events(self):
+    def __sync_events(self):
         """
-        Clear saved events where source is current instance.
+        Apply the difference between polled and stored events by bulk queries.
+
+        Bulk queries do not send signals, so free slots and schedule versions of the teacher
+        are invalidated here, see teachers.signals.
         """
-        self.__previous_events().delete()
+        with transaction.atomic():
+            affected = self.__sync(ExternalEvent, self.__previous_events(), self.events)
+            affected_rules = self.__sync(RecurringExternalEvent, self.__previous_recurring_events(), self.recurring_events)
+
+            if affected_rules:  # rules can last forever
+                free_slots.invalidate_teacher(self.teacher_id)
+            elif affected:
+                free_slots.invalidate(self.teacher_id, min(ev.start for ev in affected), max(ev.end for ev in affected))
 
-    def __save_events(self):
+            if affected or affected_rules:
+                schedule_versions.bump(self.teacher_id)
+
+    def __sync(self, Model, stored_events, polled_events):
         """
-        Store polled events
+        Match polled events with the stored ones by their sync_key, e.g. the iCal UID and the
+        recurrence instance. Insert new events, update only changed ones and delete the rest.
+
+        Returns a list of affected events, both old and new versions
         """
-        for ev in self.events:
-            ev.save()
+        stored = {}
+        for ev in stored_events.order_by('pk'):
+            stored.setdefault(ev.sync_key, []).append(ev)  # events with the same key are matched in order
+
+        to_insert = []
+        affected = []
+        now = timezone.now()
+        for ev in polled_events:
+            previous = stored.get(ev.sync_key)
+            if not previous:
+                ev.pk = None
+                to_insert.append(ev)
+                continue
+
+            old = previous.pop(0)
+            ev.pk = old.pk
+            if ev.differs_from(old):
+                Model.objects.filter(pk=ev.pk).update(last_update=now, **{field: getattr(ev, field) for field in Model.SYNC_FIELDS})
+                affected += [old, ev]
+
+        Model.objects.bulk_create(to_insert)
+
+        to_delete = [ev for events in stored.values() for ev in events]
+        Model.objects.filter(pk__in=[ev.pk for ev in to_delete]).delete()
+
+        return affected + to_insert + to_delete
 
     def __previous_events(self):
         """
@@ -112,17 +312,23 @@ class ExternalEventSource(models.Model):
         """
         return ExternalEvent.objects.by_src(self).filter(teacher=self.teacher)
 
+    def __previous_recurring_events(self):
+        return RecurringExternalEvent.objects.by_src(self).filter(teacher=self.teacher)
+
     def __is_safe(self):
         """
         Check if is it safe to update calendar event.
 
         For examples see extevents/tests/unit/tests_safety.py
         """
-        if len(self.events) == 0 and self.__previous_events().count() > 1:
+        polled_count = len(self.events) + len(self.recurring_events)
+        previous_count = self.__previous_events().filter(parent__isnull=True).count() + self.__previous_recurring_events().count()
+
+        if polled_count == 0 and self.__previous_events().count() + self.__previous_recurring_events().count() > 1:
             return False
 
-        if self.__previous_events().filter(parent__isnull=True).count() > 4:
-            if self.__previous_events().filter(parent__isnull=True).count() / len(self.events) > 2:
+        if previous_count > 4:
+            if previous_count / polled_count > 2:
                 return False
 
         return True
@@ -132,86 +338,148 @@ class ExternalEventSource(models.Model):
 
 
 class IcalEventSource(ExternalEventSource):
-    EXTERNAL_EVENT_WEEK_COUNT = 8  # last all recurring events in 8 weeks to the future
+    FULL_REFRESH_INTERVAL = datetime.timedelta(days=1)  # re-parse unchanged calendars once in a while, to drop passed events
 
     def poll(self):
         """
-        Fetch a calendar, then parse it and populate the `event` property with
-        events from it.
+        Fetch a calendar, then parse it and populate the `events` property with
+        non-recurring events and the `recurring_events` property with recurring ones.
+
+        The calendar is not parsed when the server responds with 304 Not Modified
+        or the content has not changed since the last update.
         """
+        self.changed = True
+        self.last_parse_time = 0
+
+        started = time.monotonic()
         try:
             res = self.fetch_calendar(self.url)
         except:
             logger.warning('Could not fetch google calendar')
             self.events = []
-        else:
-            self.events = list(event for event in self.parse_events(res))
+            self.recurring_events = []
+            return
+        finally:
+            self.last_fetch_time = time.monotonic() - started
+
+        if res is None or not self.__content_has_changed(res):
+            self.changed = False
+            self.events = []
+            self.recurring_events = []
+            return
+
+        started = time.monotonic()
+        self.content_hash = self.__hash(res)
+
+        ical = self._read_ical(res)
+        self.events = list(self._simple_events(ical)) if ical is not None else []
+        self.recurring_events = list(self._recurring_events(ical)) if ical is not None else []
+        self.last_parse_time = time.monotonic() - started
+
+    def __content_has_changed(self, ical_str):
+        return self.__full_refresh_is_due() or self.__hash(ical_str) != self.content_hash
+
+    def __full_refresh_is_due(self):
+        return self.last_update is None or timezone.now() - self.last_update > self.FULL_REFRESH_INTERVAL
+
+    @staticmethod
+    def __hash(ical_str):
+        return hashlib.sha256(ical_str.encode()).hexdigest()
 
     def parse_events(self, ical_str):
         """
-        Generator of events parsed from ical_str.
+        Generator of non-recurring events parsed from ical_str.
+        """
+        ical = self._read_ical(ical_str)
+        if ical is not None:
+            yield from self._simple_events(ical)
+
+    def parse_recurring_events(self, ical_str):
         """
+        Generator of recurring events parsed from ical_str.
+        """
+        ical = self._read_ical(ical_str)
+        if ical is not None:
+            yield from self._recurring_events(ical)
+
+    def _read_ical(self, ical_str):
         try:
-            ical = Calendar.from_ical(ical_str)
+            return Calendar.from_ical(ical_str)
         except:
             logger.warning('Could not parse ical string')
-            raise StopIteration
-
-        yield from self._simple_events(ical)  # first, parse all non-recurring events
-        yield from self._recurring_events(ical)  # second — generate instances of ExternalEvent for every recurring event
 
     def _simple_events(self, ical):
         """
         Generate non-recurring events from icalendar. Ignore events in the past.
         """
         for ev in ical.walk('VEVENT'):
-            if ev.get('rrule') is None:  # rrule is a repeating rule from icalendar RFC
+            if ev.get('rrule') is None:  # rrule is a repeating rule from icalendar RFC
                 event = self.parse_event(ev)
 
                 if event.start < timezone.now():
                     continue
 
-                if (event.start - timezone.now()) > datetime.timedelta(weeks=self.EXTERNAL_EVENT_WEEK_COUNT):
-                    continue
-
                 yield event
 
     def _recurring_events(self, ical):
         """
-        Generate recurring events from icalendar. Ignore events from the past except the first one.
+        Generate :model:`extevents.RecurringExternalEvent` for every recurring event from icalendar. Ignore rules, that have ended.
+
+        Modified instances of a recurring event are generated by _simple_events(), so their original
+        occurrences are excluded from the rule.
         """
+        modified_instances = {}
         for ev in ical.walk('VEVENT'):
-            rrule = ev.get('rrule')  # rrule is a repeating rule from icalendar RFC
-            if rrule is not None:
-                basic_event = self.parse_event(ev)
-
-                yield basic_event  # return basic event as the first event of the spree
-                yield from self._recurring_event_generator(rrule, basic_event)
+            if ev.get('rrule') is None and ev.get('recurrence-id') is not None:
+                modified_instances.setdefault(str(ev.get('uid', '')), []).append(_as_aware(ev.get('recurrence-id').dt))
 
-    def _recurring_event_generator(self, rrule, basic_event):
-        """
-        The main generator of recuring events.
-        Input — generation rule (http://icalendar.readthedocs.io/en/latest/api.html#icalendar.prop.vRecur) and the source event(:model:`extevents.ExternalEvent`).
-        Output — bunch of events, starting from the next future event, ending in timedelta(weeks=self.EXTERNAL_EVENT_WEEK_COUNT)
-        """
-        generating_rule = self._build_generating_rule(rrule)
+        for ev in ical.walk('VEVENT'):
+            rrule = ev.get('rrule')  # rrule is a repeating rule from icalendar RFC
+            if rrule is None:
+                continue
 
-        length = basic_event.end - basic_event.start  # basic length of event, apllited to all generated events
+            (start, end) = self._event_time(ev)
+            start = _as_aware(start)
+            uid = str(ev.get('uid', ''))
+
+            event = RecurringExternalEvent(
+                uid=uid,
+                description=ev.get('summary', ''),
+                start=start,
+                duration=_as_aware(end) - start,
+                rrule=self._build_generating_rule(rrule),
+                tzid=getattr(start.tzinfo, 'zone', ''),
+                exdates=self._exdates(ev) + modified_instances.get(uid, []),
+                teacher=self.teacher,
+                src=self,
+            )
+
+            if 'COUNT' in rrule or 'UNTIL' in rrule:  # finite rule, walk it without keeping the occurrences in memory
+                last = None
+                for last in event.rule():
+                    pass
+
+                if last is None:
+                    continue
+                event.until = last + event.duration
 
-        for i in rrulestr(s=generating_rule, dtstart=basic_event.start):
-            if i < timezone.now():
-                continue
+                if event.until < timezone.now():
+                    continue
 
-            if (i - timezone.now()) > datetime.timedelta(weeks=self.EXTERNAL_EVENT_WEEK_COUNT):
-                return
+            yield event
 
-            event = deepcopy(basic_event)
-            event.start = i
-            event.end = i + length
+    def _exdates(self, event):
+        """
+        Starts of occurrences, excluded from the recurring event
+        """
+        exdate = event.get('exdate')
+        if exdate is None:
+            return []
 
-            event.parent = basic_event
+        if not isinstance(exdate, list):  # icalendar returns a list only for multiple EXDATE lines
+            exdate = [exdate]
 
-            yield event
+        return [_as_aware(i.dt) for line in exdate for i in line.dts]
 
     def _build_generating_rule(self, rrule):
         """
@@ -241,10 +509,13 @@ class IcalEventSource(ExternalEventSource):
         an icalendar event.
         """
         (start, end) = self._event_time(event)
+        recurrence_id = event.get('recurrence-id')  # modified instance of a recurring event
         return ExternalEvent(
             start=start,
             end=end,
             description=event.get('summary'),
+            uid=str(event.get('uid', '')),
+            recurrence_id=recurrence_id.to_ical().decode() if recurrence_id is not None else '',
             teacher=self.teacher,
             src=self,
         )
@@ -277,9 +548,25 @@ class IcalEventSource(ExternalEventSource):
         return (start, end)
 
     def fetch_calendar(self, url):
-        r = requests.get(url, timeout=5)
+        """
+        Fetch the calendar by a conditional request. Returns None if the calendar has not been modified
+        """
+        headers = {}
+        if not self.__full_refresh_is_due():
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+
+        r = requests.get(url, headers=headers, timeout=5)
+        if r.status_code == 304:
+            return None
+
         if r.status_code != 200:
             raise FileNotFoundError('Cannot fetch calendar url (%d)', r.status_code)
+
+        self.etag = r.headers.get('ETag', '')
+        self.last_modified = r.headers.get('Last-Modified', '')
         return r.text
 
     class Meta:
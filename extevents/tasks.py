@@ -1,9 +1,72 @@
+"""
+Polling of external calendars.
+
+update_google_calendars() is a dispatcher: it runs a separate update_google_calendar() task
+for every calendar, that should be polled now, so a slow calendar does not delay the others.
+Dispatched calendars are postponed by DISPATCH_TIMEOUT, so the next run of the dispatcher
+does not queue them again. The poll schedules the real next poll, and a lost task is
+dispatched again after the timeout.
+
+Every calendar is locked while being polled, so it is never polled twice at once. Not more
+than settings.EXTERNAL_CALENDAR_POLLING_CONCURRENCY calendars are polled at the same time,
+tasks, that find the pool full, are retried a bit later.
+
+Locks are taken with cache.add(), that is atomic in memcached and redis.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
 from elk.celery import app as celery
 from extevents.models import GoogleCalendar
 
+LOCK_TIMEOUT = 60  # seconds, should be longer than the slowest poll
+POOL_RETRY_COUNTDOWN = 10  # seconds
+DISPATCH_TIMEOUT = timedelta(minutes=10)  # should be longer than the task can wait for a pool slot
+
 
 @celery.task
 def update_google_calendars():
-    for calendar in GoogleCalendar.objects.active():
-        calendar.poll()
-        calendar.update()
+    with transaction.atomic():
+        calendar_ids = list(GoogleCalendar.objects.due().select_for_update(skip_locked=True).values_list('pk', flat=True))
+        GoogleCalendar.objects.filter(pk__in=calendar_ids).update(next_poll=timezone.now() + DISPATCH_TIMEOUT)
+
+    for calendar_id in calendar_ids:
+        update_google_calendar.delay(calendar_id)
+
+
+@celery.task(bind=True, max_retries=DISPATCH_TIMEOUT.seconds // POOL_RETRY_COUNTDOWN)
+def update_google_calendar(self, calendar_id):
+    calendar_lock = 'extevents:polling:%d' % calendar_id
+    if not cache.add(calendar_lock, 1, LOCK_TIMEOUT):
+        return  # the calendar is being polled by another task
+
+    try:
+        pool_slot = _acquire_pool_slot()
+        if pool_slot is None:
+            raise self.retry(countdown=POOL_RETRY_COUNTDOWN)
+
+        try:
+            calendar = GoogleCalendar.objects.active().filter(pk=calendar_id).first()
+            if calendar is None:  # deactivated, while the task was waiting in the queue
+                return
+
+            calendar.poll()
+            calendar.update()  # timings of the poll are stored in the calendar
+        finally:
+            cache.delete(pool_slot)
+    finally:
+        cache.delete(calendar_lock)
+
+
+def _acquire_pool_slot():
+    """
+    Take one of the polling pool slots. Returns the slot key, or None when all slots are taken
+    """
+    for i in range(0, settings.EXTERNAL_CALENDAR_POLLING_CONCURRENCY):
+        key = 'extevents:polling_pool:%d' % i
+        if cache.add(key, 1, LOCK_TIMEOUT):
+            return key
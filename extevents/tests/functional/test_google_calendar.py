@@ -1,6 +1,6 @@
 from unittest.mock import MagicMock
 
-from extevents.models import ExternalEvent
+from extevents.models import ExternalEvent, RecurringExternalEvent
 from extevents.tests import GoogleCalendarTestCase
 
 
@@ -12,19 +12,13 @@ class TestGoogleCalendar(GoogleCalendarTestCase):
 
         self.src.poll()
 
-        """
-        1 event from 2032
-        1 event from 2016 — the root of recurring events
-        8 events generated in 8 weeks from 2023
-        """
-        assumed_events_count = 1 + 1 + self.src.EXTERNAL_EVENT_WEEK_COUNT
-
-        self.assertEqual(len(self.src.events), assumed_events_count)
+        self.assertEqual(len(self.src.events), 1)  # 1 event from 2023
+        self.assertEqual(len(self.src.recurring_events), 1)  # 1 recurring event since 2018
 
         self.src.update()
 
-        loaded_event_count = ExternalEvent.objects.all().count()
-        self.assertEqual(loaded_event_count, assumed_events_count)
+        self.assertEqual(ExternalEvent.objects.all().count(), 1)
+        self.assertEqual(RecurringExternalEvent.objects.all().count(), 1)
 
     def test_repeated_event_saving(self):
         """
@@ -1,3 +1,7 @@
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from mixer.backend.django import mixer
 
 import extevents.models as models
@@ -41,7 +45,8 @@ class TestEventSource(GoogleCalendarTestCase):
 
     def test_previous_event_cleanup(self):
         self.assertEqual(models.ExternalEvent.objects.count(), 10)
-        self.src._ExternalEventSource__clear_previous_events()
+        self.src.events = []
+        self.src._ExternalEventSource__sync_events()
         self.assertEqual(models.ExternalEvent.objects.count(), 0)  # all generated events should be deleted now
 
     def test_preserving_other_teachers_when_cleaning_previous_events(self):
@@ -53,7 +58,8 @@ class TestEventSource(GoogleCalendarTestCase):
             )
 
         self.assertEqual(models.ExternalEvent.objects.count(), 20)
-        self.src._ExternalEventSource__clear_previous_events()
+        self.src.events = []
+        self.src._ExternalEventSource__sync_events()
         self.assertEqual(models.ExternalEvent.objects.count(), 10)  # only events for self.teacher should be deleted
         self.assertEqual(models.ExternalEvent.objects.all()[0].teacher, some_other_teacher)  # events for some_other_teacher should not be touched
 
@@ -81,3 +87,79 @@ class TestEventSource(GoogleCalendarTestCase):
             self.assertEqual(ev.end, self.src.events[c].end)
 
             c += 1
+
+
+class TestEventSync(GoogleCalendarTestCase):
+    def setUp(self):
+        super().setUp()
+        self._sync('simple-plus-recurring.ics')
+
+    def _sync(self, fixture):
+        self.src.events = list(self.src.parse_events(self.read_fixture(fixture)))
+        self.src.recurring_events = list(self.src.parse_recurring_events(self.read_fixture(fixture)))
+        self.src.update()
+
+    def _writes(self, queries):
+        return [q['sql'] for q in queries if q['sql'].split(' ')[0] in ('INSERT', 'UPDATE', 'DELETE') and 'externalevent' in q['sql']]
+
+    def test_unchanged_calendar_does_not_write_events(self):
+        pks = set(models.ExternalEvent.objects.values_list('pk', flat=True))
+        rule_pks = set(models.RecurringExternalEvent.objects.values_list('pk', flat=True))
+
+        with CaptureQueriesContext(connection) as queries:
+            self._sync('simple-plus-recurring.ics')
+
+        self.assertEqual(self._writes(queries.captured_queries), [])
+        self.assertEqual(set(models.ExternalEvent.objects.values_list('pk', flat=True)), pks)
+        self.assertEqual(set(models.RecurringExternalEvent.objects.values_list('pk', flat=True)), rule_pks)
+
+    def test_changed_event_is_updated_in_place(self):
+        ev = models.ExternalEvent.objects.get(description='far-event')
+        self.src.events = list(self.src.parse_events(self.read_fixture('simple-plus-recurring.ics')))
+        self.src.recurring_events = list(self.src.parse_recurring_events(self.read_fixture('simple-plus-recurring.ics')))
+        for polled in self.src.events:
+            if polled.description == 'far-event':
+                polled.description = 'renamed'
+
+        self.src.update()
+
+        ev.refresh_from_db()
+        self.assertEqual(ev.description, 'renamed')
+
+    def test_removed_events_are_deleted(self):
+        self._sync('recurring.ics')  # only the recurring event is left
+
+        self.assertEqual(models.ExternalEvent.objects.count(), 0)
+
+    def test_changed_rule_is_updated_in_place(self):
+        rule = models.RecurringExternalEvent.objects.get()
+
+        self._sync('recurring.ics')  # the same UID, started in 2023 instead of 2018
+
+        rule.refresh_from_db()
+        self.assertEqual(rule.start, self.tzdatetime('Europe/Moscow', 2023, 9, 11, 21, 0))
+        self.assertEqual(models.RecurringExternalEvent.objects.count(), 1)
+
+    @patch('extevents.models.free_slots')
+    @patch('extevents.models.schedule_versions')
+    def test_free_slots_are_invalidated(self, schedule_versions, free_slots):
+        self._sync('recurring.ics')
+
+        free_slots.invalidate_teacher.assert_called_once_with(self.teacher.pk)  # recurring events have changed
+        schedule_versions.bump.assert_called_once_with(self.teacher.pk)
+
+    @patch('extevents.models.free_slots')
+    def test_nothing_is_invalidated_without_changes(self, free_slots):
+        self._sync('simple-plus-recurring.ics')
+
+        self.assertEqual(free_slots.invalidate.call_count, 0)
+        self.assertEqual(free_slots.invalidate_teacher.call_count, 0)
+
+    @patch('extevents.models.free_slots')
+    def test_changed_events_are_invalidated_by_period(self, free_slots):
+        self.src.events = []
+        self.src.recurring_events = list(self.src.parse_recurring_events(self.read_fixture('simple-plus-recurring.ics')))
+        self.src.update()  # only the non-recurring event is deleted
+
+        free_slots.invalidate.assert_called_once_with(self.teacher.pk, self.tzdatetime('UTC', 2023, 9, 11, 18, 0), self.tzdatetime('UTC', 2023, 9, 11, 19, 0))
+        self.assertEqual(free_slots.invalidate_teacher.call_count, 0)
@@ -1,6 +1,7 @@
 import datetime
 from unittest.mock import MagicMock, patch
 
+import pytz
 from icalendar import Calendar
 
 import extevents.models as models
@@ -57,7 +58,10 @@ class TestGoogleCalendar(GoogleCalendarTestCase):
     def test_recurring_events_count(self):
         ical = Calendar.from_ical(self.read_fixture('recurring.ics'))
         events = list(self.src._recurring_events(ical))
-        self.assertEqual(len(events), self.src.EXTERNAL_EVENT_WEEK_COUNT + 1)  # weekly event should repeat as many times as recurring is configured
+        self.assertEqual(len(events), 1)  # every recurring event is stored as a single rule
+
+        occurrences = list(events[0].occurrences(self.tzdatetime('UTC', 2023, 9, 11, 10, 0), self.tzdatetime('UTC', 2023, 11, 6, 10, 0)))
+        self.assertEqual(len(occurrences), 8)  # weekly event should repeat every week
 
     def test_recurring_events_withhout_timezone(self):
         ical = Calendar.from_ical(self.read_fixture('recurring-without-timezone.ics'))
@@ -66,40 +70,77 @@ class TestGoogleCalendar(GoogleCalendarTestCase):
 
     def test_recurring_events_are_the_same(self):
         """
-        All generated events should be the same besides the length
+        All generated occurrences should be the same besides the start
         """
         ical = Calendar.from_ical(self.read_fixture('recurring.ics'))
 
-        for ev in self.src._recurring_events(ical):
-            self.assertIsInstance(ev, models.ExternalEvent)
-            self.assertEqual(ev.end - ev.start, datetime.timedelta(hours=1))  # all generated events should have similar length
-            self.assertEqual(ev.src, self.src)
+        ev = list(self.src._recurring_events(ical))[0]
+        self.assertIsInstance(ev, models.RecurringExternalEvent)
+        self.assertEqual(ev.src, self.src)
+        self.assertEqual(ev.tzid, 'Europe/Moscow')
+
+        for (start, end) in ev.occurrences(self.tzdatetime('UTC', 2023, 9, 11, 10, 0), self.tzdatetime('UTC', 2024, 9, 11, 10, 0)):
+            self.assertEqual(end - start, datetime.timedelta(hours=1))  # all generated events should have similar length
+            self.assertEqual(start.astimezone(pytz.timezone('Europe/Moscow')).hour, 21)
 
-    def test_recurring_events_do_store_parent(self):
+    def test_excluded_occurrences(self):
         """
-        Generated recurring events should store parent event.
+        Occurrences, excluded by EXDATE, and occurrences, that have been modified, should not be generated
         """
-        ical = Calendar.from_ical(self.read_fixture('recurring.ics'))
-
-        events = list(self.src._recurring_events(ical))
-
-        parent_event = events.pop(0)
-        for ev in events:
-            self.assertEqual(ev.parent, parent_event)
+        ical = Calendar.from_ical('\r\n'.join([
+            'BEGIN:VCALENDAR',
+            'VERSION:2.0',
+            'BEGIN:VEVENT',
+            'DTSTART:20230917T180000Z',
+            'DTEND:20230917T190000Z',
+            'RRULE:FREQ=WEEKLY',
+            'EXDATE:20230924T180000Z',
+            'UID:weekly@test',
+            'SUMMARY:Weekly',
+            'END:VEVENT',
+            'BEGIN:VEVENT',
+            'DTSTART:20231001T200000Z',
+            'DTEND:20231001T210000Z',
+            'RECURRENCE-ID:20231001T180000Z',
+            'UID:weekly@test',
+            'SUMMARY:Weekly, moved',
+            'END:VEVENT',
+            'END:VCALENDAR',
+            '',
+        ]))
+
+        ev = list(self.src._recurring_events(ical))[0]
+        occurrences = [start for (start, end) in ev.occurrences(self.tzdatetime('UTC', 2023, 9, 11, 10, 0), self.tzdatetime('UTC', 2023, 10, 9, 0, 0))]
+        self.assertEqual(occurrences, [self.tzdatetime('UTC', 2023, 9, 17, 18, 0), self.tzdatetime('UTC', 2023, 10, 8, 18, 0)])
+
+        moved = list(self.src._simple_events(ical))
+        self.assertEqual(len(moved), 1)
+        self.assertEqual(moved[0].start, self.tzdatetime('UTC', 2023, 10, 1, 20, 0))
+
+    def test_ended_rules_are_ignored(self):
+        ical = Calendar.from_ical('\r\n'.join([
+            'BEGIN:VCALENDAR',
+            'VERSION:2.0',
+            'BEGIN:VEVENT',
+            'DTSTART:20230101T180000Z',
+            'DTEND:20230101T190000Z',
+            'RRULE:FREQ=WEEKLY;COUNT=4',
+            'UID:ended@test',
+            'SUMMARY:Ended',
+            'END:VEVENT',
+            'END:VCALENDAR',
+            '',
+        ]))
+
+        self.assertEqual(list(self.src._recurring_events(ical)), [])
 
     @patch('extevents.models.timezone')
     def test_simple_and_recurring_events_mixup(self, timezone):
         timezone.now = MagicMock(return_value=self.tzdatetime('UTC', 2023, 9, 1, 10, 0))
-        events = list(self.src.parse_events(self.read_fixture('simple-plus-recurring.ics')))
-
-        """
-        1 normal event
-        1 event from 2018 — the root of recurring events
-        8 events generated in 8 weeks from 2023
-        """
-        assumed_event_count = 1 + 1 + self.src.EXTERNAL_EVENT_WEEK_COUNT
+        ical_str = self.read_fixture('simple-plus-recurring.ics')
 
-        self.assertEqual(len(events), assumed_event_count)
+        self.assertEqual(len(list(self.src.parse_events(ical_str))), 1)  # 1 normal event
+        self.assertEqual(len(list(self.src.parse_recurring_events(ical_str))), 1)  # 1 recurring event since 2018
 
     def test_event_without_endtime(self):
         events = list(self.src.parse_events(self.read_fixture('no-endtime.ics')))
@@ -0,0 +1,160 @@
+import hashlib
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+import responses
+from mixer.backend.django import mixer
+
+from extevents.models import ExternalEvent, GoogleCalendar
+from extevents.tests import GoogleCalendarTestCase
+
+
+class TestConditionalPolling(GoogleCalendarTestCase):
+    def setUp(self):
+        super().setUp()
+        self.ical = self.read_fixture('simple.ics')
+
+    def _respond(self, status=200, body=None, **headers):
+        responses.add(
+            responses.GET,
+            'http://testing',
+            body=body if body is not None else self.ical,
+            status=status,
+            adding_headers=headers,
+        )
+
+    @responses.activate
+    def test_validators_are_stored(self):
+        self._respond(ETag='"v1"', **{'Last-Modified': 'Mon, 11 Sep 2023 09:00:00 GMT'})
+
+        self.src.poll()
+        self.src.update()
+
+        self.src.refresh_from_db()
+        self.assertEqual(self.src.etag, '"v1"')
+        self.assertEqual(self.src.last_modified, 'Mon, 11 Sep 2023 09:00:00 GMT')
+        self.assertEqual(self.src.content_hash, hashlib.sha256(self.ical.encode()).hexdigest())
+
+    @responses.activate
+    def test_conditional_request(self):
+        self.src.etag = '"v1"'
+        self.src.last_modified = 'Mon, 11 Sep 2023 09:00:00 GMT'
+        self._respond(status=304, body='')
+
+        self.src.poll()
+
+        headers = responses.calls[0].request.headers
+        self.assertEqual(headers['If-None-Match'], '"v1"')
+        self.assertEqual(headers['If-Modified-Since'], 'Mon, 11 Sep 2023 09:00:00 GMT')
+
+        self.assertFalse(self.src.changed)
+        self.assertEqual(self.src.events, [])
+
+    @responses.activate
+    def test_unchanged_content_is_not_parsed(self):
+        self.src.content_hash = hashlib.sha256(self.ical.encode()).hexdigest()
+        self._respond()
+
+        with patch.object(self.src, '_read_ical') as read_ical:
+            self.src.poll()
+            self.assertEqual(read_ical.call_count, 0)
+
+        self.assertFalse(self.src.changed)
+
+    @responses.activate
+    def test_changed_content_is_parsed(self):
+        self.src.content_hash = 'previous'
+        self._respond()
+
+        self.src.poll()
+
+        self.assertTrue(self.src.changed)
+        self.assertEqual(len(self.src.events), 1)
+
+    @responses.activate
+    def test_full_refresh(self):
+        """
+        Calendars should be re-parsed once in a while, even when they do not change
+        """
+        GoogleCalendar.objects.filter(pk=self.src.pk).update(last_update=self.tzdatetime('UTC', 2023, 9, 1, 10, 0))
+        self.src.refresh_from_db()
+        self.src.etag = '"v1"'
+        self.src.content_hash = hashlib.sha256(self.ical.encode()).hexdigest()
+        self._respond()
+
+        self.src.poll()
+
+        self.assertNotIn('If-None-Match', responses.calls[0].request.headers)
+        self.assertTrue(self.src.changed)
+        self.assertEqual(len(self.src.events), 1)
+
+    def test_unchanged_source_does_not_touch_events(self):
+        for i in range(0, 3):
+            mixer.blend(ExternalEvent, teacher=self.teacher, src=self.src)
+
+        self.src.fetch_calendar = MagicMock(return_value=None)  # 304 Not Modified
+        self.src.poll()
+
+        with patch('extevents.models.logger') as logger:
+            self.src.update()
+            self.assertEqual(logger.warning.call_count, 0)  # no unsafe update warning
+
+        self.assertEqual(ExternalEvent.objects.by_src(self.src).count(), 3)
+
+
+class TestAdaptivePolling(GoogleCalendarTestCase):
+    def _poll(self, changed):
+        self.src.changed = changed
+        self.src.events = []
+        self.src.update()
+        self.src.refresh_from_db()
+
+    def test_backoff(self):
+        self._poll(changed=False)
+        self.assertEqual(self.src.poll_interval, timedelta(minutes=10))
+
+        self._poll(changed=False)
+        self.assertEqual(self.src.poll_interval, timedelta(minutes=20))
+        self.assertEqual(self.src.next_poll, self.tzdatetime('UTC', 2023, 9, 11, 10, 20))
+
+    def test_backoff_limit(self):
+        for i in range(0, 10):
+            self._poll(changed=False)
+
+        self.assertEqual(self.src.poll_interval, self.src.MAX_POLL_INTERVAL)
+
+    def test_change_resets_the_interval(self):
+        for i in range(0, 3):
+            self._poll(changed=False)
+
+        self._poll(changed=True)
+        self.assertEqual(self.src.poll_interval, self.src.MIN_POLL_INTERVAL)
+
+    def test_due(self):
+        self.assertIn(self.src, GoogleCalendar.objects.due())  # never polled before
+
+        self._poll(changed=False)
+        self.assertNotIn(self.src, GoogleCalendar.objects.due())
+
+        GoogleCalendar.objects.filter(pk=self.src.pk).update(next_poll=self.tzdatetime('UTC', 2023, 9, 11, 9, 0))
+        self.assertIn(self.src, GoogleCalendar.objects.due())
+
+
+class TestPollingTimings(GoogleCalendarTestCase):
+    def test_timings_are_stored(self):
+        self.src.fetch_calendar = MagicMock(return_value=self.read_fixture('simple.ics'))
+
+        self.src.poll()
+        self.src.update()
+
+        self.src.refresh_from_db()
+        self.assertGreaterEqual(self.src.last_fetch_time, 0)
+        self.assertGreater(self.src.last_parse_time, 0)
+
+    def test_nothing_is_parsed(self):
+        self.src.fetch_calendar = MagicMock(return_value=None)
+
+        self.src.poll()
+
+        self.assertIsNotNone(self.src.last_fetch_time)
+        self.assertEqual(self.src.last_parse_time, 0)
@@ -0,0 +1,83 @@
+from unittest.mock import patch
+
+from celery.exceptions import Retry
+from django.core.cache import cache
+from django.test import override_settings
+
+from extevents import tasks
+from extevents.models import GoogleCalendar
+from extevents.tests import GoogleCalendarTestCase
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    EXTERNAL_CALENDAR_POLLING_CONCURRENCY=2,
+)
+@patch('extevents.models.GoogleCalendar.update')
+@patch('extevents.models.GoogleCalendar.poll')
+class TestCalendarPolling(GoogleCalendarTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_dispatcher(self, poll, update):
+        GoogleCalendar.objects.create(teacher=self.teacher, url='http://testing/2')
+        GoogleCalendar.objects.create(teacher=self.teacher, url='http://testing/3', active=False)
+
+        with patch('extevents.tasks.update_google_calendar') as update_google_calendar:
+            tasks.update_google_calendars()
+
+            self.assertEqual(update_google_calendar.delay.call_count, 2)  # only active calendars
+
+    def test_dispatched_calendars_are_not_queued_twice(self, poll, update):
+        with patch('extevents.tasks.update_google_calendar') as update_google_calendar:
+            tasks.update_google_calendars()
+            tasks.update_google_calendars()
+
+            self.assertEqual(update_google_calendar.delay.call_count, 1)
+
+    def test_single_calendar(self, poll, update):
+        tasks.update_google_calendar(self.src.pk)
+
+        self.assertEqual(poll.call_count, 1)
+        self.assertEqual(update.call_count, 1)
+
+        self.assertTrue(cache.add('extevents:polling:%d' % self.src.pk, 1))  # the lock should be released
+
+    def test_locked_calendar_is_not_polled(self, poll, update):
+        cache.add('extevents:polling:%d' % self.src.pk, 1)
+
+        tasks.update_google_calendar(self.src.pk)
+
+        self.assertEqual(poll.call_count, 0)
+
+    def test_bounded_concurrency(self, poll, update):
+        cache.add('extevents:polling_pool:0', 1)
+        cache.add('extevents:polling_pool:1', 1)
+
+        with self.assertRaises(Retry):  # all pool slots are taken
+            tasks.update_google_calendar(self.src.pk)
+        self.assertEqual(poll.call_count, 0)
+        self.assertTrue(cache.add('extevents:polling:%d' % self.src.pk, 1))  # the calendar is not locked while waiting for the retry
+        cache.delete('extevents:polling:%d' % self.src.pk)
+
+        cache.delete('extevents:polling_pool:1')
+
+        tasks.update_google_calendar(self.src.pk)
+        self.assertEqual(poll.call_count, 1)
+
+    def test_locks_are_released_after_failure(self, poll, update):
+        poll.side_effect = RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            tasks.update_google_calendar(self.src.pk)
+
+        self.assertIsNotNone(tasks._acquire_pool_slot())
+        self.assertTrue(cache.add('extevents:polling:%d' % self.src.pk, 1))
+
+    def test_inactive_calendar_is_skipped(self, poll, update):
+        GoogleCalendar.objects.filter(pk=self.src.pk).update(active=False)
+
+        tasks.update_google_calendar(self.src.pk)
+
+        self.assertEqual(poll.call_count, 0)
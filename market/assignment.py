@@ -0,0 +1,90 @@
+"""
+Min-cost assignment (the Hungarian algorithm) for a numpy cost matrix, used by market.pairing.
+
+    columns = min_cost_assignment(costs)  # costs[row, column], np.inf for forbidden cells
+
+Every row gets a distinct column, so that the most rows are assigned and the total cost
+is minimal. Rows, that can't be assigned, get -1.
+"""
+import numpy as np
+
+
+def min_cost_assignment(costs):
+    """
+    Return an array of column indexes by row, -1 for rows without an acceptable column
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    rows, columns = costs.shape
+    if rows == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    acceptable = np.isfinite(costs)
+    finite = costs[acceptable]
+
+    # forbidden cells get a cost, that is bigger than any full assignment of acceptable ones,
+    # so an assignment with more acceptable cells is always cheaper
+    forbidden = (np.abs(finite).max() if finite.size else 0) * rows * 2 + 1
+
+    matrix = np.full((rows, max(columns, rows)), forbidden)  # dummy columns for rows, that do not fit
+    matrix[:, :columns] = np.where(acceptable, costs, forbidden)
+
+    assigned = _hungarian(matrix)
+
+    return np.array([
+        column if column < columns and acceptable[row, column] else -1
+        for row, column in enumerate(assigned)
+    ], dtype=np.int64)
+
+
+def _hungarian(matrix):
+    """
+    Assign a column to every row of the n×m matrix (n <= m) with the minimal total cost.
+
+    Rows are added one by one, every addition finds the shortest augmenting path with
+    potentials u and v. Indexes are 1-based, the zero column is a fake one.
+    """
+    n, m = matrix.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)  # row, assigned to the column, 0 for none
+    way = np.zeros(m + 1, dtype=np.int64)  # previous column on the augmenting path
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+
+            free = ~used[1:]
+            reduced = matrix[i0 - 1] - u[i0] - v[1:]
+            improved = free & (reduced < minv[1:])
+            minv[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+
+            candidates = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+
+            j0 = j1
+            if p[j0] == 0:
+                break
+
+        while j0:  # flip the augmenting path
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    assigned = np.zeros(n, dtype=np.int64)
+    for j in range(1, m + 1):
+        if p[j]:
+            assigned[p[j] - 1] = j - 1
+
+    return assigned
@@ -1,6 +1,9 @@
-from collections import UserList
-from datetime import timedelta
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
 
+import numpy as np
+import pytz
+from django.apps import apps
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
@@ -8,6 +11,16 @@ from market.exceptions import AutoScheduleExpcetion
 from teachers.slot_list import SlotList
 
 
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def _as_microseconds(date):
+    """
+    Integer count of microseconds since epoch, used by the vectorized code
+    """
+    return (date - EPOCH) // timedelta(microseconds=1)
+
+
 class TeacherHasEvents(AutoScheduleExpcetion):
     pass
 
@@ -24,60 +37,179 @@ class EntryIsInPast(AutoScheduleExpcetion):
     pass
 
 
-class BusyPeriods(UserList):
+class BusyPeriods():
     """
     Abstract representation of a busy period
 
+    Periods are stored as a compact interval index: two sorted lists with
+    starts and ends of non-overlapping periods. Overlapping and adjacent
+    periods are merged on load, so every check is a pair of binary searches
+    instead of a scan over every stored period.
+
     Params:
-        - queryset: a querset with periods of inavailability
+        - queryset: a querset with periods of inavailability, or an iterable of (start, end) tuples
         - start_field: field with a period start (default: 'start')
         - end_field: field with a period end (default: 'end')
     """
-    def __init__(self, queryset, start_field='start', end_field='end'):
-        super().__init__()
-        for absense in queryset.values(start_field, end_field):
-            self.data.append(absense)
+    def __init__(self, queryset=(), start_field='start', end_field='end'):
+        if hasattr(queryset, 'values_list'):
+            queryset = queryset.values_list(start_field, end_field)
+
+        self.starts = []
+        self.ends = []
+        self.count = 0
+
+        for (start, end) in sorted(queryset):
+            self.count += 1
+            if end <= start:  # empty periods are never checked positively, see is_present()
+                continue
+
+            if self.ends and start <= self.ends[-1]:  # period overlaps or touches the previous one
+                if end > self.ends[-1]:
+                    self.ends[-1] = end
+                continue
+
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        """
+        Count of loaded periods, including the merged ones
+        """
+        return self.count
 
     def is_present(self, start, end):
         """
         Return True if the event is not found in the abscence list
         """
-        for period in self.data:
-            if start >= period['start'] and start < period['end']:
-                return False
-            if end > period['start'] and end <= period['end']:
-                return False
+        i = bisect_right(self.starts, start) - 1  # the last period, that starts not later than the event
+        if i >= 0 and start < self.ends[i]:
+            return False
+
+        i = bisect_left(self.starts, end) - 1  # the last period, that starts before the event ends
+        if i >= 0 and end <= self.ends[i]:
+            return False
 
         return True
 
+    def are_present(self, starts, ends):
+        """
+        Vectorized version of is_present(). Accepts numpy arrays with starts and
+        ends of the checked events in microseconds since epoch.
+
+        Returns a boolean array, True for events that are not found in the abscence list
+        """
+        if not self.starts:
+            return np.ones(len(starts), dtype=bool)
+
+        period_starts = np.array([_as_microseconds(i) for i in self.starts], dtype=np.int64)
+        period_ends = np.array([_as_microseconds(i) for i in self.ends], dtype=np.int64)
+
+        i = np.searchsorted(period_starts, starts, side='right') - 1  # the last period, that starts not later than the event
+        busy = (i >= 0) & (starts < period_ends[i])
+
+        i = np.searchsorted(period_starts, ends, side='left') - 1  # the last period, that starts before the event ends
+        busy |= (i >= 0) & (ends <= period_ends[i])
+
+        return ~busy
+
+
+def _within_window(queryset, start=None, end=None):
+    """
+    Filter busy periods, that intersect the [start, end) window
+    """
+    if start is not None:
+        queryset = queryset.filter(end__gt=start)
+
+    if end is not None:
+        queryset = queryset.filter(start__lt=end)
+
+    return queryset
+
 
 class AutoSchedule():
     """
     Big class for automatically generating teachers schedule
+
+    When start and end are passed, only busy periods that intersect the
+    [start, end) window are loaded. Schedule built this way should not be
+    asked about anything outside of the window.
+
+    Busy periods can be passed directly via the `busy_periods` dict with
+    iterables of (start, end) tuples (see `for_teachers()`), in this case
+    the schedule does not touch the database at all.
+
+    Recurring external events are expanded only within the window, see
+    :model:`extevents.RecurringExternalEvent`.
     """
-    def __init__(self, teacher, exclude_timeline_entries=[]):
+    def __init__(self, teacher, exclude_timeline_entries=[], start=None, end=None, busy_periods=None):
         super().__init__()
 
         self.teacher = teacher
+        self.start = start
+        self.end = end
 
         if None in exclude_timeline_entries:
             exclude_timeline_entries.remove(None)  # There is a difference between exclude(pk__in=[]) and exclude(pk__in=[None]). The latter breaks the whole query.
 
+        if busy_periods is None:
+            RecurringExternalEvent = apps.get_model('extevents.RecurringExternalEvent')
+            recurring_events = RecurringExternalEvent.objects.periods(start, end, teachers=[teacher])
+            busy_periods = {
+                'extevents': list(_within_window(teacher.busy_periods.all(), start, end).values_list('start', 'end')) + [period[1:] for period in recurring_events],
+                'absences': _within_window(teacher.absences.approved(), start, end),
+                'other_entries': _within_window(teacher.timeline_entries.filter(end__gte=timezone.now()).exclude(pk__in=exclude_timeline_entries), start, end),
+            }
+
         self.busy_periods = {
             'extevents': {
-                'src': BusyPeriods(teacher.busy_periods.all()),
+                'src': BusyPeriods(busy_periods['extevents']),
                 'exception': TeacherHasEvents,
             },
             'absences': {
-                'src': BusyPeriods(teacher.absences.approved()),
+                'src': BusyPeriods(busy_periods['absences']),
                 'exception': TeacherIsAbsent,
             },
             'other_entries': {
-                'src': BusyPeriods(teacher.timeline_entries.filter(end__gte=timezone.now()).exclude(pk__in=exclude_timeline_entries)),
+                'src': BusyPeriods(busy_periods['other_entries']),
                 'exception': TeacherHasOtherLessons,
             },
         }
 
+    @classmethod
+    def for_teachers(cls, teachers, start, end):
+        """
+        Build schedules for a bunch of teachers within the [start, end) window.
+
+        All busy periods are loaded by a single query per busy period type, so the
+        query count does not depend on the teacher count.
+
+        Returns a dict of schedules by teacher pk
+        """
+        ExternalEvent = apps.get_model('extevents.ExternalEvent')
+        RecurringExternalEvent = apps.get_model('extevents.RecurringExternalEvent')
+        Absence = apps.get_model('teachers.Absence')
+        TimelineEntry = apps.get_model('timeline.Entry')
+
+        teachers = list(teachers)
+        sources = {
+            'extevents': ExternalEvent.objects.all(),
+            'absences': Absence.objects.approved(),
+            'other_entries': TimelineEntry.objects.filter(end__gte=timezone.now()),
+        }
+
+        busy_periods = {teacher.pk: {period_type: [] for period_type in sources.keys()} for teacher in teachers}
+
+        for period_type, queryset in sources.items():
+            queryset = _within_window(queryset.filter(teacher__in=teachers), start, end)
+            for (teacher_id, period_start, period_end) in queryset.values_list('teacher_id', 'start', 'end'):
+                busy_periods[teacher_id][period_type].append((period_start, period_end))
+
+        for (teacher_id, period_start, period_end) in RecurringExternalEvent.objects.periods(start, end, teachers=teachers):
+            busy_periods[teacher_id]['extevents'].append((period_start, period_end))
+
+        return {teacher.pk: cls(teacher, start=start, end=end, busy_periods=busy_periods[teacher.pk]) for teacher in teachers}
+
     def slots(self, start, end, period=timedelta(minutes=30)):
         """
         Return a slot list with available time slots
@@ -95,6 +227,27 @@ class AutoSchedule():
 
         return slot_list
 
+    def vectorized_slots(self, start, end, period=timedelta(minutes=30)):
+        """
+        Same as slots(), but checks all time slots at once with numpy, without
+        raising an exception for every busy slot.
+        """
+        if start > end - period:
+            return SlotList()
+
+        count = (end - period - start) // period + 1
+
+        starts = _as_microseconds(start) + np.arange(count, dtype=np.int64) * (period // timedelta(microseconds=1))
+        ends = starts + period // timedelta(microseconds=1)
+
+        now = _as_microseconds(timezone.now())
+        free = (starts >= now) & (ends >= now)
+
+        for busy_period in self.busy_periods.values():
+            free &= busy_period['src'].are_present(starts, ends)
+
+        return SlotList(start + period * int(i) for i in np.flatnonzero(free))
+
     def test(self, period_type, start, end):
         busy_period = self.busy_periods.get(period_type)
 
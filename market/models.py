@@ -6,7 +6,7 @@ from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.db.models import F, Q
 from django.utils import timezone
 from djmoney.models.fields import MoneyField
@@ -403,28 +403,33 @@ class Class(ProductContainer):
 
         self.is_scheduled = True
 
-        if not self.timeline.pk:  # this happens when the entry is created in current iteration
-            self.timeline.save()
-            """
-            We do not use self.assign_entry() method here, because we assume, that
-            all required checks have passed. In future there may be cases, when
-            we should re-save a class with an invalid timeline entry. If we re-run
-            all checks, we will not be able to do this
-            """
-            self.timeline = self.timeline
+        with transaction.atomic():
+            if not self.timeline.pk:  # this happens when the entry is created in current iteration
+                self.timeline = self.__save_or_get_existing(self.timeline)
+                """
+                We do not use self.assign_entry() method here, because we assume, that
+                all required checks have passed. In future there may be cases, when
+                we should re-save a class with an invalid timeline entry. If we re-run
+                all checks, we will not be able to do this
+                """
+                self.timeline = self.timeline
 
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
 
-        """
-        Below we run save() on an entry one more time. This is needed for
-        an ability to run save() only on a class, without a need to run save()
-        also on an entry.
+            """ If the class is scheduled for the first time — atomicaly take a slot of the entry """
+            if not was_scheduled and not self.timeline.take_slot():
+                raise ValidationError('Trying to assign a class to event without free slots')
 
-        This is usefull when instance of Class is created within the same
-        iteration with a timeline entry, i.e. when scheduling through the
-        sorting hat.
-        """
-        self.timeline.save()
+            """
+            Below we run save() on an entry one more time. This is needed for
+            an ability to run save() only on a class, without a need to run save()
+            also on an entry.
+
+            This is usefull when instance of Class is created within the same
+            iteration with a timeline entry, i.e. when scheduling through the
+            sorting hat.
+            """
+            self.timeline.save()
 
         """ If the class was scheduled for the first time — send a signal """
         if not was_scheduled:
@@ -449,6 +454,7 @@ class Class(ProductContainer):
         if kwargs.get('update_fields') and 'timeline_entry' in kwargs['update_fields']:
             old_entry = Class.objects.get(pk=self.pk).timeline
             super().save(*args, **kwargs)
+            old_entry.release_slot()
             old_entry.save()
 
         super().save(*args, **kwargs)
@@ -472,16 +478,19 @@ class Class(ProductContainer):
             s += " (%s)" % self.subscription.product
         return s
 
-    def assign_entry(self, entry):
+    def assign_entry(self, entry, auto_schedule=None, working_hours=None):
         """
         Assign a timeline entry.
+
+        Prebuilt auto schedule and teachers working hours are passed to the entry
+        clean() method, see :model:`timeline.Entry`.
         """
         if not self.can_be_scheduled(entry):
             raise exceptions.CannotBeScheduled('%s %s' % (self, entry))
         self.timeline = entry
-        self.timeline.clean()
+        self.timeline.clean(auto_schedule=auto_schedule, working_hours=working_hours)
 
-    def schedule(self, **kwargs):
+    def schedule(self, auto_schedule=None, working_hours=None, **kwargs):
         """
         Method for scheduling a lesson that does not require a timeline entry.
         allow_besides_working_hours should be set to True only when testing.
@@ -492,16 +501,20 @@ class Class(ProductContainer):
             raise exceptions.CannotBeScheduled("Lesson '%s' requieres a teachers timeline entry" % self.lesson_type)
 
         entry = self.__get_entry(**kwargs)
-        self.assign_entry(entry)
+        self.assign_entry(entry, auto_schedule=auto_schedule, working_hours=working_hours)
 
-    def __get_entry(self, teacher, date, allow_overlap=True, allow_besides_working_hours=False):
+    def __get_entry(self, teacher, date, allow_overlap=False, allow_besides_working_hours=False):
         """
         Find existing timeline entry or create a new one for lessons, that don't require
         a particular timeline entry.
         """
         TimelineEntry = apps.get_model('timeline.Entry')
+        entries = TimelineEntry.objects.all()
+        if transaction.get_connection().in_atomic_block:
+            entries = entries.select_for_update()  # see SortingHat docs about concurrent scheduling
+
         try:
-            return TimelineEntry.objects.get(
+            return entries.get(
                 teacher=teacher,
                 lesson_type=self.lesson_type,
                 start=date
@@ -512,8 +525,32 @@ class Class(ProductContainer):
                 lesson=self.lesson_type.model_class().get_default(),
                 start=date,
                 allow_besides_working_hours=False,
+                allow_overlap=allow_overlap,
             )
 
+    def __save_or_get_existing(self, entry):
+        """
+        Insert a new implicit timeline entry. If the same entry (teacher, lesson type and start)
+        has been inserted by a parallel request, lock and return it instead.
+
+        The insert is done within a savepoint, so the failed one does not break the transaction
+        """
+        TimelineEntry = apps.get_model('timeline.Entry')
+        try:
+            with transaction.atomic():
+                entry.save()
+                return entry
+        except IntegrityError:
+            existing = TimelineEntry.objects \
+                .select_for_update() \
+                .filter(teacher=entry.teacher, lesson_type=entry.lesson_type, start=entry.start) \
+                .first()
+
+            if existing is None:  # the entry overlaps with another one, see TimelineEntry.allow_overlap
+                raise
+
+            return existing
+
     def cancel(self, src='teacher', request=None):
         """
         Unschedule previously scheduled lesson
@@ -530,9 +567,11 @@ class Class(ProductContainer):
         signals.class_cancelled.send(sender=self.__class__, instance=self, src=src)
 
         entry = self.timeline
-        entry.classes.remove(self, bulk=True)  # expcitly disable running of self.save()
-        self.renew()
-        entry.save()
+        with transaction.atomic():
+            entry.classes.remove(self, bulk=True)  # expcitly disable running of self.save()
+            self.renew()
+            entry.release_slot()
+            entry.save()
 
     def renew(self):
         self.timeline = None
@@ -0,0 +1,300 @@
+"""
+Pairing engine for lessons, that can be planned only by the system, i.e. :model:`lessons.PairedLesson`.
+
+    pairing = Pairing()
+    pairing.run()
+
+    for result in pairing.results:  # {'customers': (customer, customer), 'entry': entry, 'error': 'E_NONE'}
+        ...
+
+How it works:
+    - Every customer, that has an unscheduled class, is put into a bucket by his level.
+    - Customers within a bucket are paired by max-weight matching: as many pairs as possible,
+      with the smallest total timezone difference, see _match().
+    - Pairs are assigned to free timeline entries of the lesson type by min-cost assignment,
+      see market.assignment. The entry should start within comfortable hours of both students
+      and should not overlap their scheduled classes, the closer to PREFERRED_HOUR — the better.
+    - Assigned classes are scheduled within a single transaction, every pair in its own
+      savepoint, so a failed pair does not affect the others.
+
+Teachers availability is checked once for all candidate entries, see TimelineEntry.objects.only_valid().
+"""
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from market.assignment import min_cost_assignment
+from market.auto_schedule import BusyPeriods
+from market.exceptions import CannotBeScheduled
+
+PREFERRED_HOUR = 19  # local time of a student
+EARLIEST_HOUR = 8
+LATEST_HOUR = 22  # the last hour, when the lesson can start
+MAX_OFFSET_DIFFERENCE = timedelta(hours=3)  # students with bigger timezone difference are not paired
+DAY_PENALTY = 10  # minutes, the penalty for every day of waiting for the lesson
+
+MINUTES_IN_DAY = 24 * 60
+
+
+def _utc_offset(customer):
+    return timezone.now().astimezone(customer.timezone).utcoffset()
+
+
+def _level(customer):
+    return customer.current_level or customer.starting_level
+
+
+def _match(bucket):
+    """
+    Max-weight matching of classes within a bucket, sorted by UTC offset of students: the most
+    pairs, then the smallest total offset difference.
+
+    Compatibility of students depends only on the distance between their offsets, so in an
+    optimal matching only neighbours are paired — any crossing or nested pairs can be replaced
+    by neighbouring ones with smaller differences. The matching is found by dynamic programming
+    over the neighbour differences.
+
+    Returns a list of (i, i + 1) index tuples
+    """
+    offsets = np.array([_utc_offset(c.customer).total_seconds() // 60 for c in bucket], dtype=np.int64)
+    differences = np.diff(offsets)
+    compatible = differences <= MAX_OFFSET_DIFFERENCE.total_seconds() // 60
+
+    score = [(0, 0)] * (len(bucket) + 1)  # (pairs, -total difference) of the first k classes
+    paired = [False] * (len(bucket) + 1)  # the best matching of the first k classes pairs the last two
+    for k in range(2, len(bucket) + 1):
+        score[k] = score[k - 1]
+        if compatible[k - 2]:
+            candidate = (score[k - 2][0] + 1, score[k - 2][1] - int(differences[k - 2]))
+            if candidate > score[k]:
+                score[k] = candidate
+                paired[k] = True
+
+    pairs = []
+    k = len(bucket)
+    while k >= 2:
+        if paired[k]:
+            pairs.append((k - 2, k - 1))
+            k -= 2
+        else:
+            k -= 1
+
+    return pairs[::-1]
+
+
+class Pairing():
+    def __init__(self, lesson_type=None, start=None, end=None):
+        PairedLesson = apps.get_model('lessons.PairedLesson')
+
+        self.lesson_type = lesson_type or PairedLesson.get_contenttype()
+        self.start = start or timezone.now() + settings.PLANNING_DELTA
+        self.end = end or self.start + timedelta(days=14)
+        self.results = []
+
+    def run(self, dry_run=False):
+        """
+        Pair students and schedule their classes. With dry_run=True nothing is saved.
+
+        Returns the count of scheduled pairs
+        """
+        classes = self.__get_classes()
+        pairs, unpaired = self.make_pairs(classes)
+
+        self.results = [self.__result((c.customer,), None, 'E_NO_PAIR') for c in unpaired]
+
+        entries = list(self.__get_entries())
+        assignment = self.assign(pairs, entries, self.__customer_busy_periods(classes))
+
+        with transaction.atomic():
+            locked_classes = self.__lock_classes(classes)
+            locked_entries = self.__lock_entries(entries)
+
+            for pair, entry in assignment:
+                if entry is None:
+                    self.results.append(self.__result(self.__customers(pair), None, 'E_ENTRY_NOT_FOUND'))
+                    continue
+
+                err = self.__schedule_pair(
+                    [locked_classes.get(c.pk) for c in pair],
+                    locked_entries.get(entry.pk),
+                    dry_run,
+                )
+                self.results.append(self.__result(self.__customers(pair), entry, err))
+
+        return len([result for result in self.results if result['error'] == 'E_NONE'])
+
+    @staticmethod
+    def make_pairs(classes):
+        """
+        Pair classes of students with the same level and close timezones.
+
+        Returns a tuple of pairs and classes, that have been left without a pair
+        """
+        buckets = OrderedDict()
+        unpaired = []
+        for c in classes:
+            level = _level(c.customer)
+            if level is None:  # we cannot pair students with unknown level
+                unpaired.append(c)
+                continue
+            buckets.setdefault(level, []).append(c)
+
+        pairs = []
+        for level, bucket in buckets.items():
+            bucket = sorted(bucket, key=lambda c: (_utc_offset(c.customer), c.customer_id))
+            matched = _match(bucket)
+
+            pairs += [(bucket[i], bucket[j]) for (i, j) in matched]
+            paired = set(i for pair in matched for i in pair)
+            unpaired += [c for i, c in enumerate(bucket) if i not in paired]
+
+        return pairs, unpaired
+
+    def assign(self, pairs, entries, busy_periods=None):
+        """
+        Assign a timeline entry to every pair. busy_periods is a dict of customers BusyPeriods by customer pk.
+
+        Returns a list of (pair, entry) tuples, entry is None when nothing has been found
+        """
+        if not pairs:
+            return []
+
+        busy_periods = busy_periods or {}
+        entries = list(entries)
+        starts = [timezone.localtime(entry.start, timezone.utc) for entry in entries]
+        utc_minutes = np.array([start.hour * 60 + start.minute for start in starts], dtype=np.int64)
+        days = np.array([(start - self.start).days for start in starts], dtype=np.int64)
+
+        costs = np.array([self.__costs(pair, utc_minutes, days) for pair in pairs]).reshape(len(pairs), len(entries))
+        for i, pair in enumerate(pairs):
+            for j in np.flatnonzero(np.isfinite(costs[i])):  # students should be free, checked only for acceptable entries
+                if not all(busy_periods.get(c.customer_id, BusyPeriods()).is_present(entries[j].start, entries[j].end) for c in pair):
+                    costs[i, j] = np.inf
+
+        assignment = [entries[j] if j >= 0 else None for j in min_cost_assignment(costs)]
+
+        return list(zip(pairs, assignment))
+
+    def __costs(self, pair, utc_minutes, days):
+        """
+        Cost of every entry for the pair, np.inf for unacceptable ones
+        """
+        costs = days * DAY_PENALTY
+        acceptable = np.ones(len(utc_minutes), dtype=bool)
+        for c in pair:
+            local_minutes = (utc_minutes + int(_utc_offset(c.customer).total_seconds() // 60)) % MINUTES_IN_DAY
+            acceptable &= (local_minutes >= EARLIEST_HOUR * 60) & (local_minutes <= LATEST_HOUR * 60)
+            costs = costs + np.abs(local_minutes - PREFERRED_HOUR * 60)
+
+        return np.where(acceptable, costs, np.inf)
+
+    def __schedule_pair(self, pair, entry, dry_run):
+        """
+        Schedule both classes of the pair, return the error code
+        """
+        if None in pair:  # classes have been scheduled by a parallel request
+            return 'E_CLASS_NOT_FOUND'
+
+        if entry is None:  # the entry has been taken by a parallel request
+            return 'E_ENTRY_NOT_FOUND'
+
+        try:
+            with transaction.atomic():
+                for c in pair:
+                    if not c.can_be_scheduled(entry):
+                        raise CannotBeScheduled('%s %s' % (c, entry))
+                    c.timeline = entry  # the entry has been validated by TimelineEntry.objects.only_valid(), so no need to clean() it
+
+                    if not dry_run:
+                        c.save()
+
+        except (CannotBeScheduled, IntegrityError, ValidationError):
+            for c in pair:
+                c.timeline = None
+                c.is_scheduled = False
+            return 'E_CANT_SCHEDULE'
+
+        return 'E_NONE'
+
+    def __get_classes(self):
+        """
+        A single unscheduled class for every customer
+        """
+        Class = apps.get_model('market.Class')
+        return list(
+            Class.objects.find_student_classes(self.lesson_type)
+            .select_related('customer')
+            .order_by('customer', 'buy_date')
+        )
+
+    def __get_entries(self):
+        """
+        Free timeline entries, that can fit a pair of students
+        """
+        TimelineEntry = apps.get_model('timeline.Entry')
+        entries = TimelineEntry.objects \
+            .filter(lesson_type=self.lesson_type) \
+            .filter(start__range=(self.start, self.end)) \
+            .filter(taken_slots=0, slots__gte=2, is_finished=False) \
+            .select_related('teacher') \
+            .prefetch_related('lesson') \
+            .order_by('start')
+
+        return TimelineEntry.objects.only_valid(entries)
+
+    def __customer_busy_periods(self, classes):
+        """
+        Already scheduled classes of customers, a dict of BusyPeriods by customer pk
+        """
+        Class = apps.get_model('market.Class')
+        periods = {}
+        scheduled = Class.objects \
+            .filter(customer__in=[c.customer_id for c in classes], is_scheduled=True) \
+            .filter(timeline__end__gt=self.start, timeline__start__lt=self.end + timedelta(days=1)) \
+            .values_list('customer_id', 'timeline__start', 'timeline__end')
+
+        for (customer_id, start, end) in scheduled:
+            periods.setdefault(customer_id, []).append((start, end))
+
+        return {customer_id: BusyPeriods(customer_periods) for customer_id, customer_periods in periods.items()}
+
+    def __lock_classes(self, classes):
+        """
+        Lock classes, that are still unscheduled. Classes, locked by parallel requests, are skipped
+        """
+        Class = apps.get_model('market.Class')
+        locked = Class.objects \
+            .filter(pk__in=[c.pk for c in classes], is_scheduled=False) \
+            .select_related('customer') \
+            .select_for_update(skip_locked=True)
+
+        return {c.pk: c for c in locked}
+
+    def __lock_entries(self, entries):
+        """
+        Lock entries, that are still free. Entries, locked by parallel requests, are skipped
+        """
+        TimelineEntry = apps.get_model('timeline.Entry')
+        locked = TimelineEntry.objects \
+            .filter(pk__in=[entry.pk for entry in entries], taken_slots=0) \
+            .select_for_update(skip_locked=True)
+
+        return {entry.pk: entry for entry in locked}
+
+    @staticmethod
+    def __customers(pair):
+        return tuple(c.customer for c in pair)
+
+    @staticmethod
+    def __result(customers, entry, err):
+        return {
+            'customers': customers,
+            'entry': entry,
+            'error': err,
+        }
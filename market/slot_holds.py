@@ -0,0 +1,66 @@
+"""
+Short-lived holds of teacher slots during checkout.
+
+When a customer checks a slot (market:step2 with ?check), the slot is held for him for
+settings.SLOT_HOLD_TIMEOUT, so nobody can take it before the real booking:
+    - held slots are excluded from availability, see :model:`teachers.Teacher`.objects.find_free()
+    - SortingHat refuses to schedule a slot, held by another customer
+
+Holds are stored in the django cache, keyed by teacher, lesson type and start. Cache backends
+with atomic add() (memcached, redis) are required for two parallel checks not to hold the same
+slot. Holds are used only for lessons, that do not require a timeline entry — slots of the
+other lessons are guarded by taken slots of their entries.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from teachers import schedule_versions
+
+
+def _key(teacher_id, lesson_type_id, start):
+    return 'market:slot_hold:%d:%d:%s' % (teacher_id, int(lesson_type_id), timezone.localtime(start, timezone.utc).isoformat())
+
+
+def _timeout():
+    return int(settings.SLOT_HOLD_TIMEOUT.total_seconds())
+
+
+def hold(teacher_id, lesson_type_id, start, customer_id):
+    """
+    Hold the slot for the customer. Holding the same slot again prolongs the hold.
+
+    Returns False if the slot is held by another customer
+    """
+    key = _key(teacher_id, lesson_type_id, start)
+    if not cache.add(key, customer_id, _timeout()):
+        if cache.get(key) != customer_id:
+            return False
+        cache.set(key, customer_id, _timeout())
+
+    schedule_versions.bump(teacher_id)  # drop cached responses, that contain the slot
+    return True
+
+
+def is_held_by_another_customer(teacher_id, lesson_type_id, start, customer_id):
+    holder = cache.get(_key(teacher_id, lesson_type_id, start))
+    return holder is not None and holder != customer_id
+
+
+def release(teacher_id, lesson_type_id, start, customer_id):
+    """
+    Release the slot, if it is held by the customer
+    """
+    key = _key(teacher_id, lesson_type_id, start)
+    if cache.get(key) == customer_id:
+        cache.delete(key)
+
+
+def exclude_held(slots, teacher_id, lesson_type_id):
+    """
+    Return slots of the teacher, that are not held by anybody
+    """
+    slots = list(slots)
+    held = cache.get_many([_key(teacher_id, lesson_type_id, slot) for slot in slots])
+
+    return [slot for slot in slots if _key(teacher_id, lesson_type_id, slot) not in held]
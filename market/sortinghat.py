@@ -1,11 +1,18 @@
+from datetime import timedelta
+
 from django.apps import apps
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
 from django.db.models import F
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.utils.translation import ugettext as _
 
+from market import slot_holds
+from market.auto_schedule import AutoSchedule, BusyPeriods, TeacherHasOtherLessons
 from market.exceptions import AutoScheduleExpcetion, CannotBeScheduled
+from teachers import working_hours as working_hours_cache
 from timeline.exceptions import DoesNotFitWorkingHours
 
 
@@ -36,6 +43,17 @@ class SortingHat():
             hat.c.save()    # actualy schedule a user-purchased class, found by the hat.
                             # 'c' here is an instance of :model:`market.Class`
 
+    Concurrent scheduling
+    =====================
+    do_the_thing() + c.save() is a read-then-write, so two customers can take the last
+    slot of a timeline entry, and two requests can spend the same purchased class. Use
+    the schedule() method — it does the same within a transaction. Inside a transaction
+    the hat locks the rows it has found: the class is locked with SKIP LOCKED, so parallel
+    requests of a single customer pick different classes, and the timeline entry is locked
+    till the end of transaction, so only bookings of the same entry wait for each other.
+    Timeline entries for lessons, that do not require them, are inserted with a savepoint:
+    if a parallel request has inserted the same entry, the class joins it.
+
     This class is supposed to be a god-object for further class scheduling logic,
     so it should be covered by unit-tests (not fucntional, but UNIT) for 100%.
     """
@@ -49,8 +67,41 @@ class SortingHat():
         'E_CLASS_NOT_FOUND': _("You don't have available lessons"),
         'E_ENTRY_NOT_FOUND': _("Your choice is not found in the curriculum"),
         'E_CANT_SCHEDULE': _("Your choice does not fit teachers timeline"),
+        'E_SLOT_HELD': _("Somebody is booking this time right now, please choose another one"),
     }
 
+    def schedule(self):
+        """
+        Atomicaly find all required objects and save the scheduled class.
+
+        Returns True on success, on failure see self.err and self.msg
+        """
+        try:
+            with transaction.atomic():
+                if not self.do_the_thing():
+                    return False
+                self.c.save()
+        except (IntegrityError, ValidationError):  # somebody has created an overlapping timeline entry, or taken the last slot of the same one in parallel
+            self.__set_err('E_CANT_SCHEDULE')
+            return False
+
+        if self.__holds_are_used():
+            slot_holds.release(self.teacher.pk, self.lesson_type.pk, self.date, self.customer.pk)
+
+        return True
+
+    def hold(self):
+        """
+        Hold the slot for the customer during checkout, see market.slot_holds.
+        Call it after a successful do_the_thing().
+
+        Returns True on success, on failure see self.err and self.msg
+        """
+        if self.__holds_are_used() and not slot_holds.hold(self.teacher.pk, self.lesson_type.pk, self.date, self.customer.pk):
+            self.__set_err('E_SLOT_HELD')
+
+        return self.result
+
     def do_the_thing(self):
         """
         Do all the planning magic:
@@ -58,7 +109,7 @@ class SortingHat():
             2) Find a timeline entry if user's lesson require it
             3) Schedule it
         """
-        for staff in self.find_a_class, self.find_an_entry, self.schedule_a_class:
+        for staff in self.find_a_class, self.find_an_entry, self.check_the_hold, self.schedule_a_class:
             staff()
             if not self.result:
                 return False
@@ -92,13 +143,17 @@ class SortingHat():
         has not yet been scheduled.
         """
         Class = apps.get_model('market.Class')
-        return Class.objects \
+        classes = Class.objects \
             .filter(customer=self.customer) \
             .filter(lesson_type=self.lesson_type) \
             .filter(is_scheduled=False) \
             .filter(is_fully_used=False) \
-            .order_by('subscription_id', 'buy_date') \
-            .first()
+            .order_by('subscription_id', 'buy_date')
+
+        if transaction.get_connection().in_atomic_block:
+            classes = classes.select_for_update(skip_locked=True)  # a class, that is being scheduled by a parallel request, is skipped
+
+        return classes.first()
 
     def __get_entry(self):
         """
@@ -106,12 +161,16 @@ class SortingHat():
         lesson_type and starts just when user wants it.
         """
         TimelineEntry = apps.get_model('timeline.entry')
-        return TimelineEntry.objects \
+        entries = TimelineEntry.objects \
             .filter(taken_slots__lt=F('slots')) \
             .filter(teacher=self.teacher) \
             .filter(lesson_type=self.lesson_type) \
-            .filter(start=self.date) \
-            .first()
+            .filter(start=self.date)
+
+        if transaction.get_connection().in_atomic_block:
+            entries = entries.select_for_update()  # free slots are re-checked after a parallel booking of the entry is commited
+
+        return entries.first()
 
     def find_a_class(self):
         """
@@ -146,6 +205,19 @@ class SortingHat():
             return
         self.__set_err('E_ENTRY_NOT_FOUND')
 
+    def check_the_hold(self):
+        """
+        Check if the slot is held by another customer during checkout, see market.slot_holds
+        """
+        if self.__holds_are_used() and slot_holds.is_held_by_another_customer(self.teacher.pk, self.lesson_type.pk, self.date, self.customer.pk):
+            self.__set_err('E_SLOT_HELD')
+
+    def __holds_are_used(self):
+        """
+        Slots of lessons, that require a timeline entry, are not held
+        """
+        return not self.lesson_type.model_class().timeline_entry_required()
+
     def schedule_a_class(self):
         """
         Actualy assign a timeline entry to the class. If there is not entry, the
@@ -160,7 +232,8 @@ class SortingHat():
             else:  # otherwise — schedule it without an entry
                 self.c.schedule(
                     teacher=self.teacher,
-                    date=self.date
+                    date=self.date,
+                    allow_overlap=False,  # the database will not allow a parallel request to create an overlapping entry
                 )
         except CannotBeScheduled:
             """
@@ -177,3 +250,164 @@ class SortingHat():
             return
 
         self.__set_err('E_NONE')
+
+
+class BulkSortingHat():
+    """
+    Schedule a bunch of classes at once, i.e. 'every tuesday 18:00 with teacher X for 6 weeks':
+
+        hat = BulkSortingHat.weekly(
+            customer=request.user.crm,
+            lesson_type=lesson_type,
+            teacher=teacher,
+            date='2016-05-31',
+            time='18:00',
+            weeks=6,
+        )
+        hat.schedule()
+
+        for result in hat.results:  # {'date': datetime, 'result': True, 'error': 'E_NONE', 'text': ''}
+            ...
+
+    All requested slots are checked against a single snapshot of the teacher schedule,
+    classes and timeline entries are locked once (see the SortingHat docs about concurrent
+    scheduling) and reserved within a single transaction. Every slot is saved within its
+    own savepoint, so a failed slot does not affect the others.
+
+    Per-slot results are in the SortingHat error code format.
+    """
+    def __init__(self, customer, lesson_type, teacher, dates):
+        self.customer = customer
+        self.lesson_type = ContentType.objects.get(app_label='lessons', pk=lesson_type)
+        self.teacher = teacher
+        self.dates = sorted(set(dates))
+        self.results = []
+
+    @classmethod
+    def weekly(cls, customer, lesson_type, teacher, date, time, weeks):
+        """
+        Create a hat for the same time every week, starting from date
+        """
+        first = parse_datetime(date + ' ' + time)
+        dates = [timezone.make_aware(first + timedelta(weeks=i)) for i in range(0, weeks)]  # naive arithmetic keeps the local time over DST changes
+
+        return cls(customer=customer, lesson_type=lesson_type, teacher=teacher, dates=dates)
+
+    @property
+    def result(self):
+        """
+        True if all slots have been scheduled
+        """
+        return all(result['result'] for result in self.results)
+
+    def schedule(self, dry_run=False):
+        """
+        Check and reserve all requested slots. With dry_run=True nothing is saved.
+
+        Returns True if all slots have been scheduled.
+        """
+        self.results = []
+        if not self.dates:
+            return False
+
+        with transaction.atomic():
+            classes = self.__get_classes()
+            entries = self.__get_entries()
+
+            auto_schedule = AutoSchedule(
+                self.teacher,
+                exclude_timeline_entries=[entry.pk for entry in entries.values()],
+                start=self.dates[0],
+                end=self.dates[-1] + timedelta(days=1),  # long enough to contain the end of the last lesson
+            )
+            working_hours = working_hours_cache.for_teacher(self.teacher.pk)
+
+            reserved = []  # periods, reserved during this run
+
+            for date in self.dates:
+                err = self.__schedule_one(date, classes, entries, auto_schedule, working_hours, reserved, dry_run)
+                self.results.append({
+                    'date': date,
+                    'result': err == 'E_NONE',
+                    'error': err,
+                    'text': SortingHat.errs.get(err, 'Internal scheduling error, please contact us'),
+                })
+
+        return self.result
+
+    def __schedule_one(self, date, classes, entries, auto_schedule, working_hours, reserved, dry_run):
+        """
+        Schedule a single slot, return the error code
+        """
+        if not classes:
+            return 'E_CLASS_NOT_FOUND'
+
+        Lesson = self.lesson_type.model_class()
+        entry = entries.get(date)
+        if Lesson.timeline_entry_required() and (entry is None or not entry.is_free):
+            return 'E_ENTRY_NOT_FOUND'
+
+        if not Lesson.timeline_entry_required() and slot_holds.is_held_by_another_customer(self.teacher.pk, self.lesson_type.pk, date, self.customer.pk):
+            return 'E_SLOT_HELD'
+
+        c = classes[0]
+        try:
+            with transaction.atomic():
+                if entry is not None:
+                    c.assign_entry(entry, auto_schedule=auto_schedule, working_hours=working_hours)
+                else:
+                    c.schedule(teacher=self.teacher, date=date, allow_overlap=False, auto_schedule=auto_schedule, working_hours=working_hours)
+
+                if not BusyPeriods(reserved).is_present(c.timeline.start, c.timeline.end):
+                    raise TeacherHasOtherLessons('Slot overlaps with another slot of this request')
+
+                if not dry_run:
+                    c.save()
+
+        except (AutoScheduleExpcetion, DoesNotFitWorkingHours) as e:
+            self.__reset(c)
+            return e.__class__.__name__
+
+        except (CannotBeScheduled, IntegrityError, ValidationError):  # IntegrityError is raised when a parallel request creates the same timeline entry
+            self.__reset(c)
+            return 'E_CANT_SCHEDULE'
+
+        classes.pop(0)
+        reserved.append((c.timeline.start, c.timeline.end))
+        return 'E_NONE'
+
+    def __reset(self, c):
+        """
+        Return a class, that has failed to be scheduled, to its unscheduled state,
+        the database changes are rolled back by the savepoint
+        """
+        c.timeline = None
+        c.is_scheduled = False
+
+    def __get_classes(self):
+        """
+        Lock purchased classes, one for each requested slot. Classes, locked by parallel requests, are skipped
+        """
+        Class = apps.get_model('market.Class')
+        return list(
+            Class.objects
+            .filter(customer=self.customer)
+            .filter(lesson_type=self.lesson_type)
+            .filter(is_scheduled=False)
+            .filter(is_fully_used=False)
+            .order_by('subscription_id', 'buy_date')
+            .select_for_update(skip_locked=True)[:len(self.dates)]
+        )
+
+    def __get_entries(self):
+        """
+        Lock existing timeline entries for requested slots, return them as a dict by start
+        """
+        TimelineEntry = apps.get_model('timeline.Entry')
+        entries = TimelineEntry.objects \
+            .filter(teacher=self.teacher) \
+            .filter(lesson_type=self.lesson_type) \
+            .filter(start__in=self.dates) \
+            .select_for_update()
+
+        return {entry.start: entry for entry in entries}
@@ -0,0 +1,10 @@
+from elk.celery import app as celery
+from market.pairing import Pairing
+
+
+@celery.task
+def pair_students():
+    """
+    Pair students with unscheduled paired lessons, see market.pairing
+    """
+    Pairing().run()
@@ -0,0 +1,83 @@
+"""
+Microbenchmark for :class:`market.auto_schedule.BusyPeriods`.
+
+Compares the interval index with the former linear scan over a list of dicts.
+Does not require a database, run it from the project root:
+
+    python -m market.tests.AutoSchedule.bench_busy_periods
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+import pytz
+
+from market.auto_schedule import BusyPeriods
+
+PERIOD_COUNTS = (10, 1000, 100000)
+CHECKS = 1000
+
+
+class LinearBusyPeriods():
+    """
+    The former implementation of BusyPeriods, kept here as a reference
+    """
+    def __init__(self, periods):
+        self.data = [{'start': start, 'end': end} for (start, end) in periods]
+
+    def is_present(self, start, end):
+        for period in self.data:
+            if start >= period['start'] and start < period['end']:
+                return False
+            if end > period['start'] and end <= period['end']:
+                return False
+
+        return True
+
+
+def generate_periods(count, since):
+    for i in range(0, count):
+        start = since + timedelta(minutes=random.randrange(0, 60 * 24 * 365 * 3))
+        yield (start, start + timedelta(minutes=random.choice([15, 30, 60, 120, 60 * 24])))
+
+
+def generate_checks(count, since):
+    for i in range(0, count):
+        start = since + timedelta(minutes=30 * random.randrange(0, 2 * 24 * 365 * 3))
+        yield (start, start + timedelta(minutes=30))
+
+
+def bench(count):
+    since = datetime(2032, 1, 1, tzinfo=pytz.utc)
+    periods = list(generate_periods(count, since))
+    checks = list(generate_checks(CHECKS, since))
+
+    linear = LinearBusyPeriods(periods)
+    indexed = BusyPeriods(periods)
+
+    for (start, end) in checks:
+        assert linear.is_present(start, end) == indexed.is_present(start, end)
+
+    def run(busy_periods):
+        def checker():
+            for (start, end) in checks:
+                busy_periods.is_present(start, end)
+        return checker
+
+    linear_time = min(timeit.repeat(run(linear), number=1, repeat=3))
+    indexed_time = min(timeit.repeat(run(indexed), number=1, repeat=3))
+    load_time = min(timeit.repeat(lambda: BusyPeriods(periods), number=1, repeat=3))
+
+    return linear_time, indexed_time, load_time
+
+
+def main():
+    print('%10s %16s %16s %16s %10s' % ('periods', 'linear, s', 'indexed, s', 'index load, s', 'speedup'))
+    for count in PERIOD_COUNTS:
+        linear_time, indexed_time, load_time = bench(count)
+        print('%10d %16.6f %16.6f %16.6f %9.1fx' % (count, linear_time, indexed_time, load_time, linear_time / indexed_time))
+    print('(%d checks per run)' % CHECKS)
+
+
+if __name__ == '__main__':
+    main()
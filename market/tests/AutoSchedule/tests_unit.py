@@ -5,7 +5,9 @@ from freezegun import freeze_time
 from mixer.backend.django import mixer
 
 from elk.utils.testing import TestCase, create_teacher
+from extevents.models import RecurringExternalEvent
 from market.auto_schedule import AutoSchedule, BusyPeriods
+from market.tests.AutoSchedule.bench_busy_periods import LinearBusyPeriods, generate_checks, generate_periods
 
 
 class TestBusyPeriods(TestCase):
@@ -91,6 +93,45 @@ class TestBusyPeriods(TestCase):
         ))
 
 
+class TestBusyPeriodsIndex(TestCase):
+    """
+    Database-free checks of the BusyPeriods interval index
+    """
+    def test_from_iterable(self):
+        absenses = BusyPeriods([
+            (self.tzdatetime(2032, 12, 5, 13, 30), self.tzdatetime(2032, 12, 5, 14, 30)),
+        ])
+        self.assertEqual(len(absenses), 1)
+        self.assertFalse(absenses.is_present(self.tzdatetime(2032, 12, 5, 13, 40), self.tzdatetime(2032, 12, 5, 13, 45)))
+
+    def test_overlapping_periods_are_merged(self):
+        absenses = BusyPeriods([
+            (self.tzdatetime(2032, 12, 5, 13, 30), self.tzdatetime(2032, 12, 5, 14, 30)),
+            (self.tzdatetime(2032, 12, 5, 14, 00), self.tzdatetime(2032, 12, 5, 15, 00)),
+            (self.tzdatetime(2032, 12, 5, 15, 00), self.tzdatetime(2032, 12, 5, 15, 30)),
+            (self.tzdatetime(2032, 12, 5, 17, 00), self.tzdatetime(2032, 12, 5, 18, 00)),
+        ])
+        self.assertEqual(len(absenses), 4)
+        self.assertEqual(absenses.starts, [self.tzdatetime(2032, 12, 5, 13, 30), self.tzdatetime(2032, 12, 5, 17, 00)])
+        self.assertEqual(absenses.ends, [self.tzdatetime(2032, 12, 5, 15, 30), self.tzdatetime(2032, 12, 5, 18, 00)])
+
+        self.assertFalse(absenses.is_present(self.tzdatetime(2032, 12, 5, 15, 00), self.tzdatetime(2032, 12, 5, 15, 15)))
+        self.assertTrue(absenses.is_present(self.tzdatetime(2032, 12, 5, 15, 30), self.tzdatetime(2032, 12, 5, 16, 00)))
+
+    def test_same_results_as_linear_scan(self):
+        """
+        Compare the index with the former linear implementation on random data
+        """
+        since = self.tzdatetime(2032, 12, 5, 0, 0)
+        periods = list(generate_periods(300, since))
+
+        linear = LinearBusyPeriods(periods)
+        indexed = BusyPeriods(periods)
+
+        for (start, end) in generate_checks(1000, since):
+            self.assertEqual(indexed.is_present(start, end), linear.is_present(start, end))
+
+
 class TestAutoschedule(TestCase):
     @classmethod
     def setUpTestData(cls):
@@ -141,6 +182,86 @@ class TestAutoschedule(TestCase):
         s = AutoSchedule(self.teacher, exclude_timeline_entries=[None])
         self.assertEqual(len(s.busy_periods['other_entries']['src']), 1)
 
+    @freeze_time('2032-12-05 13:30')
+    def test_init_within_window(self):
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+        for i in range(0, 3):  # one before the window, one inside it and one after it
+            day = start + timedelta(days=i - 1)
+            mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=day, end=day + timedelta(minutes=30))
+            mixer.blend('teachers.Absence', teacher=self.teacher, start=day, end=day + timedelta(minutes=30))
+            mixer.blend('timeline.Entry', teacher=self.teacher, start=day + timedelta(days=1), end=day + timedelta(days=1, minutes=30))
+
+        s = AutoSchedule(self.teacher, start=start, end=start + timedelta(hours=2))
+        self.assertEqual(len(s.busy_periods['extevents']['src']), 1)
+        self.assertEqual(len(s.busy_periods['absences']['src']), 1)
+        self.assertEqual(len(s.busy_periods['other_entries']['src']), 1)
+
+    def test_window_bounds_are_not_busy(self):
+        """
+        Periods, that end right at the window start or begin right at the window end, should be ignored
+        """
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+        mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=start - timedelta(hours=1), end=start)
+        mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=start + timedelta(hours=2), end=start + timedelta(hours=3))
+
+        s = AutoSchedule(self.teacher, start=start, end=start + timedelta(hours=2))
+        self.assertEqual(len(s.busy_periods['extevents']['src']), 0)
+        self.assertEqual(len(s.slots(start, start + timedelta(hours=2))), 4)
+
+    def _recurring_event(self, teacher, start, rrule='RRULE:FREQ=WEEKLY', **kwargs):
+        calendar = mixer.blend('extevents.GoogleCalendar', teacher=teacher)
+        return RecurringExternalEvent.objects.create(
+            teacher=teacher,
+            src=calendar,
+            start=start,
+            duration=timedelta(hours=1),
+            rrule=rrule,
+            description='weekly',
+            **kwargs
+        )
+
+    def test_recurring_events_are_expanded_within_window(self):
+        self._recurring_event(self.teacher, start=self.tzdatetime(2032, 1, 4, 14, 0))  # weekly since january
+
+        start = self.tzdatetime(2032, 12, 5, 14, 0)  # sunday, almost a year later
+        s = AutoSchedule(self.teacher, start=start - timedelta(days=1), end=start + timedelta(days=1))
+
+        self.assertEqual(len(s.busy_periods['extevents']['src']), 1)  # only a single occurrence is generated
+        self.assertEqual(len(s.slots(start, start + timedelta(hours=2))), 2)
+
+    def test_recurring_events_within_window_longer_than_a_year(self):
+        start = self.tzdatetime(2032, 1, 4, 14, 0)
+        self._recurring_event(self.teacher, start=start)
+
+        periods = RecurringExternalEvent.objects.periods(start, start + timedelta(weeks=104))
+
+        self.assertEqual(len(periods), 104)
+        self.assertEqual(periods[-1][1], start + timedelta(weeks=103))
+
+    def test_recurring_events_without_window_end(self):
+        start = self.tzdatetime(2032, 1, 4, 14, 0)
+        self._recurring_event(self.teacher, start=start)
+
+        self.assertEqual(len(RecurringExternalEvent.objects.periods(start)), 52)  # RecurringExternalEvent.DEFAULT_WINDOW
+
+    def test_excluded_occurrences_are_not_busy(self):
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+        self._recurring_event(self.teacher, start=self.tzdatetime(2032, 1, 4, 14, 0), exdates=[start])
+
+        s = AutoSchedule(self.teacher, start=start, end=start + timedelta(hours=2))
+
+        self.assertEqual(len(s.slots(start, start + timedelta(hours=2))), 4)
+
+    def test_recurring_events_for_teachers(self):
+        busy_teacher = create_teacher()
+        self._recurring_event(busy_teacher, start=self.tzdatetime(2032, 1, 4, 14, 0))
+
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+        schedules = AutoSchedule.for_teachers([self.teacher, busy_teacher], start=start, end=start + timedelta(hours=2))
+
+        self.assertEqual(len(schedules[self.teacher.pk].slots(start, start + timedelta(hours=2))), 4)
+        self.assertEqual(len(schedules[busy_teacher.pk].slots(start, start + timedelta(hours=2))), 2)
+
     def test_slots(self):
         s = AutoSchedule(self.teacher)
 
@@ -202,3 +323,45 @@ class TestAutoschedule(TestCase):
 
             with self.assertRaises(busy_period['exception']):
                 schedule.clean(start, end)
+
+
+@freeze_time('2032-12-05 13:30')
+class TestVectorizedSlots(TestCase):
+    """
+    AutoSchedule.vectorized_slots() should always return the same slots as AutoSchedule.slots()
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher = create_teacher()
+
+    def assertSameSlots(self, schedule, start, end, period=timedelta(minutes=30)):
+        self.assertEqual(list(schedule.vectorized_slots(start, end, period)), list(schedule.slots(start, end, period)))
+
+    def test_no_busy_periods(self):
+        s = AutoSchedule(self.teacher)
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+
+        self.assertSameSlots(s, start, start + timedelta(hours=2))
+        self.assertSameSlots(s, start, start + timedelta(minutes=20))  # less then a single period
+        self.assertSameSlots(s, start - timedelta(hours=2), start + timedelta(hours=2))  # some slots are in past
+
+    def test_busy_periods_from_the_database(self):
+        start = self.tzdatetime(2032, 12, 5, 14, 0)
+        mixer.blend('teachers.Absence', teacher=self.teacher, start=start + timedelta(minutes=30), end=start + timedelta(minutes=45))
+        mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=start + timedelta(minutes=80), end=start + timedelta(minutes=120))
+        mixer.blend('timeline.Entry', teacher=self.teacher, start=start + timedelta(hours=3), end=start + timedelta(hours=3, minutes=30))
+
+        s = AutoSchedule(self.teacher)
+        self.assertSameSlots(s, start, start + timedelta(hours=5))
+        self.assertEqual(len(s.vectorized_slots(start, start + timedelta(hours=5))), 6)
+
+    def test_random_busy_periods(self):
+        since = self.tzdatetime(2032, 12, 5, 0, 0)
+        for i in range(0, 20):
+            busy_periods = {period_type: list(generate_periods(20, since)) for period_type in ('extevents', 'absences', 'other_entries')}
+            for period_type, periods in busy_periods.items():  # make the periods dense enough to hit the checked day
+                busy_periods[period_type] = [(since + (start - since) / 1000, since + (end - since) / 1000) for (start, end) in periods]
+
+            s = AutoSchedule(self.teacher, busy_periods=busy_periods)
+            for period in (timedelta(minutes=15), timedelta(minutes=30), timedelta(hours=1)):
+                self.assertSameSlots(s, since, since + timedelta(days=2), period)
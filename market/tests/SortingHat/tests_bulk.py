@@ -0,0 +1,157 @@
+import json
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from freezegun import freeze_time
+from mixer.backend.django import mixer
+
+import lessons.models as lessons
+from elk.utils.testing import ClientTestCase, TestCase, create_customer, create_teacher
+from extevents.models import ExternalEvent
+from market import views
+from market.models import Class
+from market.sortinghat import BulkSortingHat
+from teachers.models import WorkingHours
+
+
+@override_settings(TIME_ZONE='UTC')
+@freeze_time('2032-05-01 12:00')
+class TestBulkSortingHat(TestCase):
+    fixtures = ('lessons',)
+
+    def setUp(self):
+        self.customer = create_customer()
+        self.host = create_teacher()
+        self.lesson = lessons.OrdinaryLesson.get_default()
+        mixer.blend(WorkingHours, teacher=self.host, weekday=0, start='13:00', end='15:00')  # monday
+
+    def _buy_lessons(self, count):
+        for i in range(0, count):
+            Class(customer=self.customer, lesson_type=self.lesson.get_contenttype()).save()
+
+    def _hat(self, weeks=4, time='14:00'):
+        return BulkSortingHat.weekly(
+            customer=self.customer,
+            lesson_type=self.lesson.get_contenttype().pk,
+            teacher=self.host,
+            date='2032-05-03',  # monday
+            time=time,
+            weeks=weeks,
+        )
+
+    def test_weekly_dates(self):
+        hat = self._hat(weeks=3)
+        self.assertEqual(hat.dates, [
+            self.tzdatetime('UTC', 2032, 5, 3, 14, 0),
+            self.tzdatetime('UTC', 2032, 5, 10, 14, 0),
+            self.tzdatetime('UTC', 2032, 5, 17, 14, 0),
+        ])
+
+    def test_schedule(self):
+        self._buy_lessons(4)
+        hat = self._hat(weeks=4)
+
+        self.assertTrue(hat.schedule())
+
+        self.assertEqual(len(hat.results), 4)
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 4)
+        self.assertEqual(
+            sorted(self.customer.classes.values_list('timeline__start', flat=True)),
+            hat.dates,
+        )
+
+    def test_not_enough_classes(self):
+        self._buy_lessons(2)
+        hat = self._hat(weeks=4)
+
+        self.assertFalse(hat.schedule())
+
+        self.assertEqual([result['error'] for result in hat.results], ['E_NONE', 'E_NONE', 'E_CLASS_NOT_FOUND', 'E_CLASS_NOT_FOUND'])
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 2)
+
+    def test_dry_run(self):
+        self._buy_lessons(4)
+        hat = self._hat(weeks=4)
+
+        self.assertTrue(hat.schedule(dry_run=True))
+
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 0)
+
+    def test_failing_slot_does_not_affect_others(self):
+        self._buy_lessons(3)
+        mixer.blend(ExternalEvent, teacher=self.host, start=self.tzdatetime('UTC', 2032, 5, 10, 13, 0), end=self.tzdatetime('UTC', 2032, 5, 10, 15, 0))
+        hat = self._hat(weeks=3)
+
+        self.assertFalse(hat.schedule())
+
+        self.assertEqual([result['error'] for result in hat.results], ['E_NONE', 'TeacherHasEvents', 'E_NONE'])
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 2)
+
+    def test_working_hours(self):
+        self._buy_lessons(2)
+        hat = self._hat(weeks=2, time='17:00')
+
+        self.assertFalse(hat.schedule())
+
+        self.assertEqual([result['error'] for result in hat.results], ['DoesNotFitWorkingHours', 'DoesNotFitWorkingHours'])
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 0)
+
+    def test_teacher_schedule_is_fetched_once(self):
+        """
+        Teacher busy periods should be fetched once per request, not once per slot
+        """
+        self._buy_lessons(6)
+
+        with CaptureQueriesContext(connection) as queries:
+            self._hat(weeks=6).schedule(dry_run=True)
+
+        for table in ('teachers_absence', 'extevents_externalevent'):
+            self.assertEqual(len([query for query in queries if table in query['sql']]), 1)
+
+
+@override_settings(TIME_ZONE='UTC')
+@freeze_time('2032-05-01 12:00')
+class TestWeeklyView(ClientTestCase):
+    fixtures = ('lessons',)
+
+    def setUp(self):
+        self.customer = create_customer()
+        self.host = create_teacher()
+        mixer.blend(WorkingHours, teacher=self.host, weekday=0, start='13:00', end='15:00')  # monday
+
+        for i in range(0, 2):
+            Class(customer=self.customer, lesson_type=lessons.OrdinaryLesson.get_contenttype()).save()
+
+    def _step2_weekly(self, weeks, just_checking=False):
+        url = '/market/schedule/step2/'
+        if just_checking:
+            url = url + '?check'
+
+        request = self.factory.get(url)
+        request.user = self.customer.user
+        response = views.step2_weekly(
+            request,
+            teacher=self.host.pk,
+            lesson_type=lessons.OrdinaryLesson.get_contenttype().pk,
+            date='2032-05-03',
+            time='14:00',
+            weeks=weeks,
+        )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_check(self):
+        got = self._step2_weekly(weeks='3', just_checking=True)
+
+        self.assertFalse(got['result'])
+        self.assertEqual([slot['result'] for slot in got['slots']], [True, True, False])
+        self.assertEqual(got['slots'][2]['error'], 'E_CLASS_NOT_FOUND')
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 0)
+
+    def test_schedule(self):
+        got = self._step2_weekly(weeks='2')
+
+        self.assertTrue(got['result'])
+        self.assertEqual(got['slots'][0]['date'], '2032-05-03T14:00:00+00:00')
+        self.assertEqual(self.customer.classes.filter(is_scheduled=True).count(), 2)
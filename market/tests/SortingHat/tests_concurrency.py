@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connection
+from mixer.backend.django import mixer
+
+import lessons.models as lessons
+from elk.utils.testing import TransactionTestCase, create_customer, create_teacher
+from market.models import Class
+from market.sortinghat import SortingHat
+from timeline.models import Entry as TimelineEntry
+
+
+class TestConcurrentScheduling(TransactionTestCase):
+    """
+    Fire a lot of parallel bookings through SortingHat.schedule(). Every booking
+    runs in its own thread with its own database connection, so the row locks
+    are real.
+    """
+    BOOKINGS = 200
+    WORKERS = 16  # keep it lower then the database connection limit
+
+    def setUp(self):
+        self.host = create_teacher(works_24x7=True)
+        self.master_class = mixer.blend(lessons.MasterClass, host=self.host, slots=5, duration=timedelta(minutes=30))
+        self.entry = mixer.blend(TimelineEntry, teacher=self.host, lesson=self.master_class, start=self.tzdatetime(2032, 5, 3, 13, 0))
+
+    def _buy_a_lesson(self, customer):
+        c = Class(
+            customer=customer,
+            lesson_type=self.master_class.get_contenttype(),
+        )
+        c.save()
+        return c
+
+    def _schedule(self, customer, start):
+        try:
+            hat = SortingHat(
+                customer=customer,
+                lesson_type=self.master_class.get_contenttype().pk,
+                teacher=self.host,
+                date=start.strftime('%Y-%m-%d'),
+                time=start.strftime('%H:%M'),
+            )
+            return hat.schedule()
+        finally:
+            connection.close()  # every thread has its own connection
+
+    def _run_in_parallel(self, bookings):
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            return list(executor.map(lambda args: self._schedule(*args), bookings))
+
+    def test_only_free_slots_are_taken(self):
+        customers = [create_customer() for i in range(0, self.BOOKINGS)]
+        for customer in customers:
+            self._buy_a_lesson(customer)
+
+        results = self._run_in_parallel((customer, self.entry.start) for customer in customers)
+
+        self.assertEqual(results.count(True), self.master_class.slots)
+
+        self.entry.refresh_from_db()
+        self.assertEqual(self.entry.taken_slots, self.master_class.slots)
+        self.assertEqual(self.entry.classes.count(), self.master_class.slots)
+
+    def test_a_class_is_spent_only_once(self):
+        customer = create_customer()
+        c = self._buy_a_lesson(customer)
+
+        entries = [self.entry]
+        for hour in range(14, 20):
+            master_class = mixer.blend(lessons.MasterClass, host=self.host, slots=5, duration=timedelta(minutes=30))
+            entries.append(mixer.blend(TimelineEntry, teacher=self.host, lesson=master_class, start=self.tzdatetime(2032, 5, 3, hour, 0)))
+
+        results = self._run_in_parallel((customer, entry.start) for entry in entries * 10)
+
+        self.assertEqual(results.count(True), 1)
+
+        c.refresh_from_db()
+        self.assertTrue(c.is_scheduled)
+        self.assertEqual(sum(TimelineEntry.objects.filter(pk__in=[entry.pk for entry in entries]).values_list('taken_slots', flat=True)), 1)
+
+
+class TestConcurrentImplicitEntries(TransactionTestCase):
+    """
+    Parallel bookings of a lesson, that does not require a timeline entry. The entry
+    is inserted by the first booking, others should join it instead of failing.
+    """
+    fixtures = ('lessons',)
+
+    def setUp(self):
+        self.teacher = create_teacher(works_24x7=True)
+        self.lesson = lessons.OrdinaryLesson.get_default()
+        self.start = self.tzdatetime(2032, 5, 3, 13, 0)
+
+    def _schedule(self, customer):
+        try:
+            hat = SortingHat(
+                customer=customer,
+                lesson_type=self.lesson.get_contenttype().pk,
+                teacher=self.teacher,
+                date=self.start.strftime('%Y-%m-%d'),
+                time=self.start.strftime('%H:%M'),
+            )
+            return hat.schedule()
+        finally:
+            connection.close()  # every thread has its own connection
+
+    def _book_in_parallel(self):
+        customers = [create_customer() for i in range(0, TestConcurrentScheduling.BOOKINGS)]
+        for customer in customers:
+            Class(customer=customer, lesson_type=self.lesson.get_contenttype()).save()
+
+        with ThreadPoolExecutor(max_workers=TestConcurrentScheduling.WORKERS) as executor:
+            return list(executor.map(self._schedule, customers))  # should not throw anything
+
+    def test_single_slot(self):
+        results = self._book_in_parallel()
+
+        self.assertEqual(results.count(True), 1)
+
+        entry = TimelineEntry.objects.get(teacher=self.teacher, start=self.start)
+        self.assertEqual(entry.taken_slots, 1)
+        self.assertEqual(entry.classes.count(), 1)
+
+    def test_parallel_bookings_join_the_same_entry(self):
+        self.lesson.slots = 3
+        self.lesson.save()
+
+        results = self._book_in_parallel()
+
+        self.assertEqual(results.count(True), 3)
+
+        entry = TimelineEntry.objects.get(teacher=self.teacher, start=self.start)
+        self.assertEqual(entry.taken_slots, 3)
+        self.assertEqual(entry.classes.count(), 3)
@@ -0,0 +1,105 @@
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.test import override_settings
+from freezegun import freeze_time
+from mixer.backend.django import mixer
+
+import lessons.models as lessons
+from elk.utils.testing import TestCase, create_customer, create_teacher
+from market import slot_holds
+from market.models import Class
+from market.sortinghat import SortingHat
+from teachers.models import Teacher, WorkingHours
+
+
+@freeze_time('2032-05-01 12:00')
+@override_settings(
+    TIME_ZONE='UTC',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SLOT_HOLD_TIMEOUT=timedelta(minutes=5),
+)
+class TestSlotHolds(TestCase):
+    fixtures = ('lessons',)
+
+    def setUp(self):
+        cache.clear()
+
+        self.customer = create_customer()
+        self.other_customer = create_customer()
+        self.teacher = create_teacher()
+        mixer.blend(WorkingHours, teacher=self.teacher, weekday=0, start='13:00', end='15:00')  # monday
+
+        self.lesson_type = lessons.OrdinaryLesson.get_contenttype().pk
+        self.slot = self.tzdatetime(2032, 5, 3, 14, 0)
+
+    def _hat(self, customer):
+        Class(customer=customer, lesson_type=lessons.OrdinaryLesson.get_contenttype()).save()
+        return SortingHat(
+            customer=customer,
+            lesson_type=self.lesson_type,
+            teacher=self.teacher,
+            date='2032-05-03',
+            time='14:00',
+        )
+
+    def _hold(self, customer):
+        return slot_holds.hold(self.teacher.pk, self.lesson_type, self.slot, customer.pk)
+
+    def test_hold(self):
+        self.assertTrue(self._hold(self.customer))
+        self.assertTrue(self._hold(self.customer))  # holding again is ok
+        self.assertFalse(self._hold(self.other_customer))
+
+        self.assertTrue(slot_holds.is_held_by_another_customer(self.teacher.pk, self.lesson_type, self.slot, self.other_customer.pk))
+        self.assertFalse(slot_holds.is_held_by_another_customer(self.teacher.pk, self.lesson_type, self.slot, self.customer.pk))
+
+    def test_release(self):
+        self._hold(self.customer)
+
+        slot_holds.release(self.teacher.pk, self.lesson_type, self.slot, self.other_customer.pk)  # should not release a hold of another customer
+        self.assertFalse(self._hold(self.other_customer))
+
+        slot_holds.release(self.teacher.pk, self.lesson_type, self.slot, self.customer.pk)
+        self.assertTrue(self._hold(self.other_customer))
+
+    def test_hold_expires(self):
+        self._hold(self.customer)
+
+        with freeze_time('2032-05-01 12:06'):  # locmem cache uses time.time() for expiration
+            self.assertTrue(self._hold(self.other_customer))
+
+    def test_held_slots_are_excluded_from_availability(self):
+        self._hold(self.customer)
+
+        teacher = next(Teacher.objects.find_free(date=self.tzdatetime(2032, 5, 3, 0, 0), lesson_type=self.lesson_type))
+        self.assertNotIn(self.slot, teacher.free_slots)
+        self.assertEqual(len(teacher.free_slots), 3)
+
+    def test_sorting_hat_honours_the_hold(self):
+        self._hold(self.customer)
+
+        hat = self._hat(self.other_customer)
+        self.assertFalse(hat.schedule())
+        self.assertEqual(hat.err, 'E_SLOT_HELD')
+
+        hat = self._hat(self.customer)
+        self.assertTrue(hat.schedule())
+
+    def test_sorting_hat_holds_the_slot(self):
+        hat = self._hat(self.customer)
+        self.assertTrue(hat.do_the_thing())
+        self.assertTrue(hat.hold())
+
+        hat = self._hat(self.other_customer)
+        self.assertFalse(hat.do_the_thing())
+        self.assertEqual(hat.err, 'E_SLOT_HELD')
+
+    def test_hold_is_released_after_booking(self):
+        hat = self._hat(self.customer)
+        hat.do_the_thing()
+        hat.hold()
+
+        self.assertTrue(self._hat(self.customer).schedule())
+
+        self.assertFalse(slot_holds.is_held_by_another_customer(self.teacher.pk, self.lesson_type, self.slot, self.other_customer.pk))
@@ -1,7 +1,9 @@
 import json
 from datetime import datetime, timedelta
+from unittest.mock import patch
 
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.test import override_settings
 from freezegun import freeze_time
 from mixer.backend.django import mixer
@@ -131,3 +133,107 @@ class SchdulingPopupSlotsTestCase(ClientTestCase):
 
         self.assertNotIn('host', records[0].keys())
         self.assertNotIn('host', records[1].keys())  # records here represent teachers, so don't need any host information
+
+    @override_settings(TIME_ZONE='US/Eastern')
+    def test_filter_by_date_in_a_timezone_ahead_of_the_server(self):
+        self.superuser.crm.timezone = 'Europe/Moscow'
+        self.superuser.crm.save()
+
+        self.c.login(username=self.superuser_login, password=self.superuser_password)  # need to login once again due to timezone change
+        response = self.c.get('/market/2032-05-03/type/%d/teachers.json' % lessons.OrdinaryLesson.get_contenttype().pk)
+        self.assertEquals(response.status_code, 200)
+
+        records = json.loads(response.content.decode('utf-8'))
+        self.assertEquals([len(record['slots']) for record in records], [5, 4])  # monday slots, not sunday ones of the server
+
+    def test_nearest(self):
+        response = self.c.get('/market/type/%d/nearest.json?count=3' % lessons.OrdinaryLesson.get_contenttype().pk)
+        self.assertEquals(response.status_code, 200)
+
+        records = json.loads(response.content.decode('utf-8'))
+
+        self.assertEquals(len(records), 3)
+        self.assertEquals(records[0]['date'], '2032-05-03')  # the nearest monday
+        self.assertIsTime(records[0]['slot']['server'])
+        self.assertEquals(records[0]['slot']['server'], records[1]['slot']['server'])  # both teachers are free at 13:00
+        self.assertEquals({records[0]['teacher']['id'], records[1]['teacher']['id']}, {self.first_teacher.pk, self.second_teacher.pk})
+
+    def test_nearest_404(self):
+        response = self.c.get('/market/type/100500/nearest.json')
+        self.assertEqual(response.status_code, 404)  # non-existent lesson_type
+
+        response = self.c.get('/market/type/%d/nearest.json?count=many' % lessons.OrdinaryLesson.get_contenttype().pk)
+        self.assertEqual(response.status_code, 404)
+
+
+@freeze_time('2032-05-01 12:30')
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TestResponseCache(ClientTestCase):
+    """
+    Schedule changes are commited in the end of the test transaction, that never happens,
+    so schedule versions are bumped immediately here.
+    """
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+        self.teacher = create_teacher()
+        mixer.blend(WorkingHours, teacher=self.teacher, weekday=0, start='13:00', end='15:00')  # monday
+
+        self.on_commit = patch('teachers.schedule_versions.transaction.on_commit', side_effect=lambda f: f())
+        self.on_commit.start()
+
+    def tearDown(self):
+        self.on_commit.stop()
+
+    def _get_slots(self):
+        response = self.c.get('/market/2032-05-03/type/%d/teachers.json' % lessons.OrdinaryLesson.get_contenttype().pk)
+        return json.loads(response.content.decode('utf-8'))[0]['slots']
+
+    def test_response_is_cached(self):
+        self._get_slots()
+
+        with patch('market.views.Teacher.objects.find_free') as find_free:
+            self.assertEqual(len(self._get_slots()), 4)
+            find_free.assert_not_called()
+
+    def test_passed_slots_are_dropped_from_the_cached_response(self):
+        self._get_slots()
+
+        with freeze_time(self.tzdatetime(2032, 5, 3, 14, 10)), patch('market.views.Teacher.objects.find_free') as find_free:
+            slots = self._get_slots()
+            find_free.assert_not_called()
+
+        self.assertEqual(len(slots), 1)  # 14:30
+
+    def test_lessons_response_depends_only_on_hosts_of_the_lesson_type(self):
+        create_teacher(works_24x7=True)  # without entries of the lesson type
+
+        lesson = mixer.blend(lessons.MasterClass, host=self.teacher, slots=5, duration=timedelta(minutes=30))
+        mixer.blend(TimelineEntry, teacher=self.teacher, lesson=lesson, start=self.tzdatetime(2032, 5, 3, 13, 0))
+        url = '/market/2032-05-03/type/%d/lessons.json' % lesson.get_contenttype().pk
+
+        with patch('market.views.schedule_versions.for_teachers', return_value={}) as for_teachers, patch('market.views.Teacher.objects.find_lessons', return_value=[]):
+            self.c.get(url)
+
+        self.assertEqual(list(for_teachers.call_args[0][0]), [self.teacher.pk])  # only hosts of the lesson type
+
+    def test_schedule_change_bumps_the_version(self):
+        self.assertEqual(len(self._get_slots()), 4)
+
+        mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 13, 0), end=self.tzdatetime(2032, 5, 3, 14, 0))
+
+        self.assertEqual(len(self._get_slots()), 2)
+
+    def test_taking_a_slot_bumps_the_version(self):
+        lesson = mixer.blend(lessons.MasterClass, host=self.teacher, slots=5, duration=timedelta(minutes=30))
+        entry = mixer.blend(TimelineEntry, teacher=self.teacher, lesson=lesson, start=self.tzdatetime(2032, 5, 3, 13, 0))
+        url = '/market/2032-05-03/type/%d/lessons.json' % lesson.get_contenttype().pk
+
+        self.c.get(url)
+
+        with patch('market.views.Teacher.objects.find_lessons') as find_lessons:
+            find_lessons.return_value = []
+            entry.take_slot()
+            self.c.get(url)
+            find_lessons.assert_called_once()
@@ -0,0 +1,50 @@
+import numpy as np
+
+from elk.utils.testing import TestCase
+from market.assignment import min_cost_assignment
+
+
+class TestMinCostAssignment(TestCase):
+    def test_optimal_where_greedy_is_not(self):
+        costs = np.array([
+            [1, 3],
+            [2, 10],
+        ])  # greedy gives the first column to the first row, and the total cost is 11
+
+        self.assertEqual(list(min_cost_assignment(costs)), [1, 0])  # 3 + 2
+
+    def test_the_most_rows_are_assigned(self):
+        costs = np.array([
+            [1, 100],
+            [2, np.inf],
+        ])
+
+        self.assertEqual(list(min_cost_assignment(costs)), [1, 0])
+
+    def test_rows_without_acceptable_columns(self):
+        costs = np.array([
+            [np.inf, np.inf],
+            [5, 1],
+        ])
+
+        self.assertEqual(list(min_cost_assignment(costs)), [-1, 1])
+
+    def test_more_rows_than_columns(self):
+        costs = np.array([
+            [3],
+            [1],
+            [2],
+        ])
+
+        self.assertEqual(list(min_cost_assignment(costs)), [-1, 0, -1])
+
+    def test_more_columns_than_rows(self):
+        costs = np.array([
+            [4, 3, 1, 2],
+        ])
+
+        self.assertEqual(list(min_cost_assignment(costs)), [2])
+
+    def test_empty(self):
+        self.assertEqual(list(min_cost_assignment(np.zeros((2, 0)))), [-1, -1])
+        self.assertEqual(list(min_cost_assignment(np.zeros((0, 2)))), [])
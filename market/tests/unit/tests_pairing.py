@@ -0,0 +1,144 @@
+from datetime import timedelta
+
+from django.test import override_settings
+from freezegun import freeze_time
+from mixer.backend.django import mixer
+
+import lessons.models as lessons
+from elk.utils.testing import TestCase, create_customer, create_teacher
+from extevents.models import ExternalEvent
+from market.models import Class
+from market.pairing import Pairing
+from timeline.models import Entry as TimelineEntry
+
+
+@override_settings(TIME_ZONE='UTC')
+@freeze_time('2032-05-01 12:00')
+class TestPairing(TestCase):
+    def setUp(self):
+        self.host = create_teacher(works_24x7=True)
+        self.lesson = mixer.blend(lessons.PairedLesson, host=self.host, slots=2, duration=timedelta(minutes=30))
+        self.pairing = Pairing(start=self.tzdatetime(2032, 5, 2, 0, 0))
+
+    def _customer(self, level='A1', timezone='Europe/Moscow'):
+        customer = create_customer(current_level=level, timezone=timezone)
+        Class(customer=customer, lesson_type=self.lesson.get_contenttype()).save()
+        return customer
+
+    def _entry(self, *args):
+        return mixer.blend(TimelineEntry, teacher=self.host, lesson=self.lesson, start=self.tzdatetime(*args))
+
+    def _pairs(self):
+        pairs, unpaired = self.pairing.make_pairs(Class.objects.select_related('customer'))
+        return (
+            sorted(tuple(sorted(c.customer_id for c in pair)) for pair in pairs),
+            sorted(c.customer_id for c in unpaired),
+        )
+
+    def test_pairs_by_level(self):
+        a1 = [self._customer(level='A1') for i in range(0, 2)]
+        b1 = [self._customer(level='B1') for i in range(0, 3)]
+
+        pairs, unpaired = self._pairs()
+
+        self.assertIn(tuple(sorted(c.pk for c in a1)), pairs)
+        self.assertEqual(len(pairs), 2)
+        self.assertEqual(len(unpaired), 1)
+        self.assertIn(unpaired[0], [c.pk for c in b1])
+
+    def test_pairs_by_timezone(self):
+        moscow = self._customer(timezone='Europe/Moscow')
+        london = self._customer(timezone='Europe/London')
+        new_york = self._customer(timezone='America/New_York')
+        chicago = self._customer(timezone='America/Chicago')
+
+        pairs, unpaired = self._pairs()
+
+        self.assertEqual(pairs, sorted([
+            tuple(sorted((moscow.pk, london.pk))),
+            tuple(sorted((new_york.pk, chicago.pk))),
+        ]))
+        self.assertEqual(unpaired, [])
+
+    def test_pairs_are_matched_optimally(self):
+        self._customer(timezone='Atlantic/Reykjavik')  # +0
+        moscow = self._customer(timezone='Europe/Moscow')  # +3
+        dubai = self._customer(timezone='Asia/Dubai')  # +4
+        tashkent = self._customer(timezone='Asia/Tashkent')  # +5
+        dhaka = self._customer(timezone='Asia/Dhaka')  # +6
+
+        pairs, unpaired = self._pairs()
+
+        self.assertEqual(pairs, sorted([  # pairing the adjacent ones from the west gives the same pair count with 4 hours of total difference instead of 2
+            tuple(sorted((moscow.pk, dubai.pk))),
+            tuple(sorted((tashkent.pk, dhaka.pk))),
+        ]))
+        self.assertEqual(len(unpaired), 1)
+
+    def test_far_timezones_are_not_paired(self):
+        self._customer(timezone='Asia/Tokyo')
+        self._customer(timezone='America/New_York')
+
+        pairs, unpaired = self._pairs()
+
+        self.assertEqual(pairs, [])
+        self.assertEqual(len(unpaired), 2)
+
+    def test_customers_without_level_are_not_paired(self):
+        self._customer(level=None)
+        self._customer(level=None)
+
+        pairs, unpaired = self._pairs()
+
+        self.assertEqual(pairs, [])
+        self.assertEqual(len(unpaired), 2)
+
+    def test_entry_within_comfortable_hours(self):
+        self._customer(timezone='Europe/Moscow')
+        self._customer(timezone='Europe/Moscow')
+        self._entry(2032, 5, 3, 1, 0)  # 04:00 in Moscow
+        comfortable = self._entry(2032, 5, 3, 16, 0)  # 19:00 in Moscow
+
+        self.assertEqual(self.pairing.run(), 1)
+
+        comfortable.refresh_from_db()
+        self.assertEqual(comfortable.taken_slots, 2)
+        self.assertEqual(Class.objects.filter(is_scheduled=True, timeline=comfortable).count(), 2)
+
+    def test_no_acceptable_entry(self):
+        self._customer(timezone='Europe/Moscow')
+        self._customer(timezone='Europe/Moscow')
+        self._entry(2032, 5, 3, 1, 0)  # 04:00 in Moscow
+
+        self.assertEqual(self.pairing.run(), 0)
+
+        self.assertEqual(self.pairing.results[0]['error'], 'E_ENTRY_NOT_FOUND')
+        self.assertEqual(Class.objects.filter(is_scheduled=True).count(), 0)
+
+    def test_busy_teacher(self):
+        self._customer()
+        self._customer()
+        entry = self._entry(2032, 5, 3, 16, 0)
+        mixer.blend(ExternalEvent, teacher=self.host, start=entry.start, end=entry.end)
+
+        self.assertEqual(self.pairing.run(), 0)
+        self.assertEqual(Class.objects.filter(is_scheduled=True).count(), 0)
+
+    def test_every_pair_gets_its_own_entry(self):
+        for i in range(0, 4):
+            self._customer()
+        self._entry(2032, 5, 3, 15, 0)
+        self._entry(2032, 5, 3, 16, 0)
+
+        self.assertEqual(self.pairing.run(), 2)
+
+        self.assertEqual(set(TimelineEntry.objects.values_list('taken_slots', flat=True)), {2})
+
+    def test_dry_run(self):
+        self._customer()
+        self._customer()
+        self._entry(2032, 5, 3, 16, 0)
+
+        self.assertEqual(self.pairing.run(dry_run=True), 1)
+
+        self.assertEqual(Class.objects.filter(is_scheduled=True).count(), 0)
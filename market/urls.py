@@ -6,12 +6,17 @@ urlpatterns = [
     url(r'mylessons/$', views.CustomerLessons.as_view(), name='customer_lessons'),
     url(r'(?P<date>[\d\-]+)/type/(?P<lesson_type>\d+)/teachers.json$', views.teachers, name='teachers'),
     url(r'(?P<date>[\d\-]+)/type/(?P<lesson_type>\d+)/lessons.json$', views.lessons, name='lessons'),
+    url(r'type/(?P<lesson_type>\d+)/nearest.json$', views.nearest, name='nearest'),
 
     url(regex=r'schedule/(?P<pk>\d+)/',
         view=views.TimelineEntryPopup.as_view(),
         name='timeline_entry_popup',
         ),
 
+    url(regex=r'schedule/step2/teacher/(?P<teacher>\d+)/(?P<lesson_type>\d+)/(?P<date>[\d-]+)/(?P<time>[\d:]{5})/weekly/(?P<weeks>\d+)/',
+        view=views.step2_weekly,
+        name='step2_weekly'
+        ),  # should go before the step2, because it has the same prefix
     url(regex=r'schedule/step2/teacher/(?P<teacher>\d+)/(?P<lesson_type>\d+)/(?P<date>[\d-]+)/(?P<time>[\d:]{5})/',
         view=views.step2,
         name='step2'
@@ -1,13 +1,19 @@
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
-from django.utils import timezone
+from django.utils import timezone, translation
 from django.utils.dateparse import parse_datetime
 
 from elk.logging import logger
+from elk.utils.cache import get_or_calculate
 from elk.views import LoginRequiredDetailView, LoginRequiredTemplateView
 from lessons.api.serializers import factory as lesson_serializer_factory
-from market.sortinghat import SortingHat
+from market.sortinghat import BulkSortingHat, SortingHat
+from teachers import schedule_versions
 from teachers.api.serializers import TeacherSerializer, TimeSlotSerializer
 from teachers.models import Teacher
 from timeline.models import Entry as TimelineEntry
@@ -28,22 +34,64 @@ class TimelineEntryPopup(LoginRequiredDetailView):
     model = TimelineEntry
 
 
+RESPONSE_CACHE_TIMEOUT = 10 * 60  # seconds. Passed slots are dropped from cached responses on every read
+
+
+def _response_cache_key(name, date, lesson_type, teacher_ids):
+    """
+    Cache key for a JSON response. Contains schedule versions of all teachers, that can
+    appear in the response, see teachers.schedule_versions, so responses are never stale.
+    """
+    versions = schedule_versions.for_teachers(teacher_ids)
+    versions_digest = hashlib.md5(';'.join('%d:%s' % (pk, versions[pk]) for pk in sorted(versions)).encode()).hexdigest()
+
+    return 'market:%s:%s:%s:%s:%s:%s' % (
+        name,
+        date,
+        lesson_type,
+        timezone.get_current_timezone_name(),  # days and slots depend on the user timezone
+        translation.get_language(),
+        versions_digest,
+    )
+
+
+def _serialize_cached(records, not_before):
+    """
+    Serialize slots of cached records, dropping the ones before not_before. Records, that
+    are left without slots, are dropped too
+    """
+    result = []
+    for record in records:
+        slots = [slot for slot in record['slots'] if slot >= not_before]
+        if slots:
+            result.append(dict(record, slots=TimeSlotSerializer(slots, many=True).data))
+
+    return result
+
+
 @login_required
 def teachers(request, date, lesson_type):
     """
     Return of JSON of time slots, avaialbe for planning. The used method is
     :model:`teachers.Teacher`.find_free, filtering is done via :model:`timeline.Entry`.
+
+    Responses are cached by schedule versions of all teachers, that can host the lesson type.
     """
     date = timezone.make_aware(parse_datetime(date + ' 00:00:00'))
-    teachers_with_slots = Teacher.objects.find_free(date=date, lesson_type=lesson_type)
-    if not teachers_with_slots:
-        raise Http404('No free teachers found')
 
-    teachers = []
-    for teacher in teachers_with_slots:
-        teacher_dict = TeacherSerializer(teacher).data
-        teacher_dict['slots'] = TimeSlotSerializer(teacher.free_slots, many=True).data
-        teachers.append(teacher_dict)
+    def calculate():
+        teachers = []
+        for teacher in Teacher.objects.find_free(date=date, lesson_type=lesson_type):
+            teacher_dict = TeacherSerializer(teacher).data
+            teacher_dict['slots'] = list(teacher.free_slots)  # serialized on every read, see _serialize_cached()
+            teachers.append(teacher_dict)
+        return teachers
+
+    teacher_ids = Teacher.objects.with_photos().filter(allowed_lessons=lesson_type).values_list('pk', flat=True)
+    teachers = get_or_calculate(_response_cache_key('teachers', date, lesson_type, teacher_ids), calculate, RESPONSE_CACHE_TIMEOUT)
+    teachers = _serialize_cached(teachers, not_before=timezone.now())
+    if not teachers:
+        raise Http404('No free teachers found')
 
     return JsonResponse(teachers, safe=False)
 
@@ -52,18 +100,57 @@ def teachers(request, date, lesson_type):
 def lessons(request, date, lesson_type):
     """
     Return a JSON of avaialble time slots for distinct date and lesson_type
+
+    Responses are cached by schedule versions of teachers, that have entries of the lesson type this day.
     """
     date = timezone.make_aware(parse_datetime(date + ' 00:00:00'))
-    lessons = list(Teacher.objects.find_lessons(date=date, lesson_type=lesson_type))
-    if not lessons:
+
+    def calculate():
+        result = []
+        for lesson in Teacher.objects.find_lessons(date=date, lesson_type=lesson_type):
+            Serializer = lesson_serializer_factory(lesson)
+            lesson_dict = Serializer(lesson).data
+            lesson_dict['slots'] = list(lesson.free_slots)  # serialized on every read, see _serialize_cached()
+            result.append(lesson_dict)
+        return result
+
+    teacher_ids = TimelineEntry.objects \
+        .filter(lesson_type=lesson_type, start__range=(date, date + timedelta(days=1))) \
+        .order_by() \
+        .values_list('teacher_id', flat=True) \
+        .distinct()
+    result = get_or_calculate(_response_cache_key('lessons', date, lesson_type, teacher_ids), calculate, RESPONSE_CACHE_TIMEOUT)
+    result = _serialize_cached(result, not_before=timezone.now() + settings.PLANNING_DELTA)
+    if not result:
         raise Http404('No lessons found on this date')
 
+    return JsonResponse(result, safe=False)
+
+
+@login_required
+def nearest(request, lesson_type):
+    """
+    Return a JSON of the nearest time slots for lesson_type with any teacher.
+    The used method is :model:`teachers.Teacher`.objects.find_nearest_slots().
+
+    Accepts the `count` GET parameter, from 1 to 50
+    """
+    try:
+        count = min(max(int(request.GET.get('count', 10)), 1), 50)
+    except ValueError:
+        raise Http404('Bad slot count')
+
+    slots = list(Teacher.objects.find_nearest_slots(lesson_type=lesson_type, count=count))
+    if not slots:
+        raise Http404('No free slots found')
+
     result = []
-    for lesson in lessons:
-        Serializer = lesson_serializer_factory(lesson)
-        lesson_dict = Serializer(lesson).data
-        lesson_dict['slots'] = TimeSlotSerializer(lesson.free_slots, many=True).data
-        result.append(lesson_dict)
+    for slot, teacher in slots:
+        result.append({
+            'date': timezone.localtime(slot).strftime('%Y-%m-%d'),
+            'slot': TimeSlotSerializer(slot).data,
+            'teacher': TeacherSerializer(teacher).data,
+        })
 
     return JsonResponse(result, safe=False)
 
@@ -83,23 +170,58 @@ def step2(request, teacher, lesson_type, date, time):
         time=time,
     )
 
-    hat.do_the_thing()  # do the actual scheduling
-
     if 'check' in request.GET.keys():
+        if hat.do_the_thing():  # just check, without saving anything
+            hat.hold()  # keep the slot for the customer till the real booking
         return JsonResponse({
             'result': hat.result,
             'error': hat.err,
             'text': hat.msg,
         })
 
-    if not hat.result:
+    if not hat.schedule():  # do the actual scheduling and save a hat-generated class
         logger.warning('Step 2 scheduling error')  # write a log entry to Sentry for future processing
         raise Http404('%s: %s' % (hat.err, hat.msg))
 
-    hat.c.save()  # save a hat-generated class
     return redirect('/')  # TODO: a page with success story
 
 
+MAX_BULK_WEEKS = 26
+
+
+@login_required
+def step2_weekly(request, teacher, lesson_type, date, time, weeks):
+    """
+    Schedule the same time with the same teacher every week, see :class:`market.sortinghat.BulkSortingHat`.
+    With ?check nothing is saved.
+
+    Returns a JSON with per-slot results in the step2 ?check format.
+    """
+    weeks = int(weeks)
+    if weeks < 1 or weeks > MAX_BULK_WEEKS:
+        raise Http404('Bad week count')
+
+    hat = BulkSortingHat.weekly(
+        customer=request.user.crm,
+        teacher=get_object_or_404(Teacher, pk=teacher),
+        lesson_type=lesson_type,  # numeric
+        date=date,
+        time=time,
+        weeks=weeks,
+    )
+    hat.schedule(dry_run='check' in request.GET.keys())
+
+    return JsonResponse({
+        'result': hat.result,
+        'slots': [{
+            'date': timezone.localtime(result['date']).isoformat(),
+            'result': result['result'],
+            'error': result['error'],
+            'text': result['text'],
+        } for result in hat.results],
+    })
+
+
 @login_required
 def cancel_popup(request, class_id):
     if not request.user.crm.can_cancel_classes():
@@ -0,0 +1,121 @@
+"""
+Materialized free slots of teachers, see :model:`teachers.FreeSlots`.
+
+Free slots, based on working hours, are read much more often, than their inputs change,
+so they are stored by teacher and day. When teachers working hours, absences, external
+events or timeline entries change, teachers.signals drop the rows of the affected
+teacher and days.
+
+A row, that is built from the data read before a parallel change has been commited,
+could survive such deletion. So every row carries the teacher and the day versions,
+read before the calculation. Versions are stored in the django cache and are changed
+after the commit of every change — rows with outdated versions are treated as misses.
+
+Only the default 30-minute period is materialized. Days are the days of the timezone,
+active during the request, so rows are stored by teacher, day and timezone. A change
+invalidates the affected days of all timezones.
+"""
+from datetime import timedelta
+from uuid import uuid4
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from teachers.slot_list import SlotList
+
+PERIOD = timedelta(minutes=30)
+MAX_INVALIDATED_DAYS = 31  # longer periods invalidate the whole teacher
+
+
+def _teacher_key(teacher_id):
+    return 'teachers:free_slots:%d' % teacher_id
+
+
+def _day_key(teacher_id, date):
+    return 'teachers:free_slots:%d:%s' % (teacher_id, date.isoformat())
+
+
+def _versions(teacher_ids, date):
+    keys = {pk: (_teacher_key(pk), _day_key(pk, date)) for pk in teacher_ids}
+    versions = cache.get_many([key for pair in keys.values() for key in pair])
+
+    return {pk: '%s:%s' % (versions.get(teacher_key) or '', versions.get(day_key) or '') for pk, (teacher_key, day_key) in keys.items()}
+
+
+def for_date(teachers, date, calculate):
+    """
+    Return free slots of teachers for the date: a dict of SlotLists by teacher pk, None
+    for teachers that do not work this day. Slots from the past are filtered out.
+
+    Misses are calculated by calculate(teachers, date) — it should return the dict of the
+    same format — and stored.
+    """
+    FreeSlots = apps.get_model('teachers.FreeSlots')
+
+    tz = timezone.get_current_timezone_name()
+    day = timezone.localtime(date).date()
+    versions = _versions([teacher.pk for teacher in teachers], day)
+    now = timezone.now()
+
+    result = {}
+    outdated = []
+    for (teacher_id, version, slots) in FreeSlots.objects.filter(teacher__in=teachers, date=day, tz=tz).values_list('teacher_id', 'version', 'slots'):
+        if version != versions[teacher_id]:
+            outdated.append(teacher_id)
+            continue
+
+        result[teacher_id] = SlotList(slot for slot in slots if slot >= now) if slots is not None else None
+
+    missing = [teacher for teacher in teachers if teacher.pk not in result]
+    if missing:
+        calculated = calculate(missing, date)
+        _store(day, tz, calculated, versions, outdated)
+        result.update(calculated)
+
+    return result
+
+
+def _store(date, tz, slots, versions, outdated):
+    FreeSlots = apps.get_model('teachers.FreeSlots')
+    try:
+        with transaction.atomic():
+            if outdated:
+                FreeSlots.objects.filter(teacher_id__in=outdated, date=date, tz=tz).delete()
+
+            FreeSlots.objects.bulk_create(
+                FreeSlots(teacher_id=pk, date=date, tz=tz, version=versions[pk], slots=list(teacher_slots) if teacher_slots is not None else None)
+                for pk, teacher_slots in slots.items()
+            )
+    except IntegrityError:  # the same day has been stored by a parallel request
+        pass
+
+
+def invalidate(teacher_id, start, end):
+    """
+    Drop free slots of the teacher for all days from start till end in any timezone
+    """
+    FreeSlots = apps.get_model('teachers.FreeSlots')
+
+    first = timezone.localtime(start, timezone.utc).date() - timedelta(days=1)  # local days are no more than a day away from the UTC ones
+    last = timezone.localtime(max(start, end - timedelta(microseconds=1)), timezone.utc).date() + timedelta(days=1)
+
+    if (last - first).days >= MAX_INVALIDATED_DAYS:
+        invalidate_teacher(teacher_id)
+        return
+
+    FreeSlots.objects.filter(teacher_id=teacher_id, date__range=(first, last)).delete()
+
+    keys = [_day_key(teacher_id, first + timedelta(days=i)) for i in range(0, (last - first).days + 1)]
+    transaction.on_commit(lambda: cache.set_many({key: uuid4().hex for key in keys}, None))
+
+
+def invalidate_teacher(teacher_id):
+    """
+    Drop all free slots of the teacher
+    """
+    FreeSlots = apps.get_model('teachers.FreeSlots')
+
+    FreeSlots.objects.filter(teacher_id=teacher_id).delete()
+    transaction.on_commit(lambda: cache.set(_teacher_key(teacher_id), uuid4().hex, None))
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teachers', '0019_teacher_ordering'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FreeSlots',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('version', models.CharField(blank=True, max_length=65)),
+                ('slots', django.contrib.postgres.fields.ArrayField(base_field=models.DateTimeField(), null=True, size=None)),
+                ('build_date', models.DateTimeField(auto_now=True)),
+                ('teacher', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='teachers.Teacher')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='freeslots',
+            unique_together=set([('teacher', 'date')]),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('teachers', '0020_freeslots'),
+    ]
+
+    operations = [
+        migrations.RunSQL('DELETE FROM teachers_freeslots', reverse_sql=migrations.RunSQL.noop),  # materialized slots are rebuilt on the next read
+        migrations.AddField(
+            model_name='freeslots',
+            name='tz',
+            field=models.CharField(default='', max_length=64),
+            preserve_default=False,
+        ),
+        migrations.AlterUniqueTogether(
+            name='freeslots',
+            unique_together=set([('teacher', 'date', 'tz')]),
+        ),
+    ]
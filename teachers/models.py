@@ -1,10 +1,13 @@
 import datetime
+import heapq
+from itertools import islice
 
 import pytz
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth.models import Group, User
 from django.contrib.contenttypes.models import ContentType
+from django.contrib.postgres.fields import ArrayField
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
 from django.db import models
@@ -15,10 +18,11 @@ from image_cropping import ImageRatioField
 from image_cropping.templatetags.cropping import cropped_thumbnail
 
 from elk.utils.date import day_range, minute_after_midnight, minute_till_midnight
+from market import slot_holds
 from market.auto_schedule import AutoSchedule
-from market.exceptions import AutoScheduleExpcetion
+from teachers import free_slots as free_slots_store
+from teachers import working_hours as working_hours_cache
 from teachers.slot_list import SlotList
-from timeline.exceptions import DoesNotFitWorkingHours
 
 
 def _planning_ofsset(start):
@@ -39,6 +43,77 @@ def _planning_ofsset(start):
     return start
 
 
+def _clip_working_hours_to_date(hours, date):
+    """
+    Do not let working hours end later then the date's midnight
+    """
+    if hours.end > timezone.make_aware(minute_till_midnight(date)):
+        hours.end = timezone.make_aware(minute_after_midnight(date))
+
+
+class _DailySchedules():
+    """
+    Lazy by-day auto schedules for a bunch of teachers.
+
+    Busy periods of all teachers are loaded by AutoSchedule.for_teachers() only when
+    somebody asks for the day for the first time.
+    """
+    def __init__(self, teachers, weekly_hours):
+        self.teachers = teachers
+        self.weekly_hours = weekly_hours
+        self.days = {}
+
+    def works(self, teacher, date):
+        """
+        Check if the teacher works this day without loading busy periods
+        """
+        return self.weekly_hours[teacher.pk].for_date(date) is not None
+
+    def get(self, date):
+        """
+        Return a tuple of working hours and schedules, both keyed by teacher pk
+        """
+        if date not in self.days:
+            hours = {}
+            for teacher in self.teachers:
+                teacher_hours = self.weekly_hours[teacher.pk].for_date(date)
+                if teacher_hours is not None:
+                    _clip_working_hours_to_date(teacher_hours, date)
+                    hours[teacher.pk] = teacher_hours
+
+            schedules = {}
+            if hours:
+                schedules = AutoSchedule.for_teachers(
+                    [teacher for teacher in self.teachers if teacher.pk in hours],
+                    start=min(h.start for h in hours.values()),
+                    end=max(h.end for h in hours.values()),
+                )
+            self.days[date] = (hours, schedules)
+
+        return self.days[date]
+
+
+def _slot_stream(teacher, dates, daily_schedules, not_before, period, lesson_type=None):
+    """
+    Generate (slot, teacher pk, teacher) tuples of a single teacher in chronological order.
+    Slots, held during checkout for the lesson_type, are skipped
+    """
+    for date in dates:
+        if not daily_schedules.works(teacher, date):  # do not load busy periods of other teachers for the day we do not need
+            continue
+
+        hours, schedules = daily_schedules.get(date)
+        if teacher.pk not in hours:
+            continue
+
+        slots = [slot for slot in schedules[teacher.pk].vectorized_slots(hours[teacher.pk].start, hours[teacher.pk].end, period) if slot >= not_before]
+        if slots and lesson_type is not None:
+            slots = slot_holds.exclude_held(slots, teacher.pk, lesson_type)
+
+        for slot in slots:
+            yield (slot, teacher.pk, teacher)
+
+
 class TeacherManager(models.Manager):
     def with_photos(self):
         """
@@ -61,16 +136,101 @@ class TeacherManager(models.Manager):
         Returns an iterable of teachers with assigned attribute free_slots — 
         iterable of available slots as datetime.
         """
-        queryset = self.with_photos()
+        queryset = self.with_photos().select_related('user__crm')
         if lesson_type is not None:
             queryset = queryset.filter(allowed_lessons=lesson_type)
 
-        for teacher in queryset:
-            free_slots = teacher.find_free_slots(date, **kwargs)
-            if free_slots:
-                teacher.free_slots = free_slots
+        if len(kwargs.keys()):  # timeline entry filters are processed teacher by teacher
+            for teacher in queryset:
+                free_slots = teacher.find_free_slots(date, **kwargs)
+                if free_slots:
+                    teacher.free_slots = free_slots
+                    yield teacher
+            return
+
+        yield from self.__find_free_by_working_hours(list(queryset), date, lesson_type)
+
+    def __find_free_by_working_hours(self, teachers, date, lesson_type=None):
+        """
+        Batch version of :model:`teachers.Teacher`.find_free_slots() without
+        timeline entry filters. Reads materialized free slots, see teachers.free_slots.
+
+        Slots, held by customers during checkout, are excluded, see market.slot_holds.
+        """
+        if not teachers:
+            return
+
+        slots = free_slots_store.for_date(teachers, date, self.__calculate_free_slots)
+
+        for teacher in teachers:
+            teacher_slots = slots.get(teacher.pk)
+            if teacher_slots and lesson_type is not None:
+                teacher_slots = SlotList(slot_holds.exclude_held(teacher_slots, teacher.pk, lesson_type))
+
+            if teacher_slots:
+                teacher.free_slots = teacher_slots
                 yield teacher
 
+    def __calculate_free_slots(self, teachers, date, period=free_slots_store.PERIOD):
+        """
+        Calculate free slots of teachers for the date: working hours and busy periods
+        of all teachers are loaded by a constant number of queries.
+
+        Returns a dict of SlotLists by teacher pk, None for teachers that do not work this day.
+        """
+        hours = WorkingHours.objects.by_teacher_for_date(teachers, date)
+        for teacher_hours in hours.values():
+            _clip_working_hours_to_date(teacher_hours, date)
+
+        result = {teacher.pk: None for teacher in teachers}
+        if not hours:
+            return result
+
+        schedules = AutoSchedule.for_teachers(
+            [teacher for teacher in teachers if teacher.pk in hours],
+            start=min(h.start for h in hours.values()),
+            end=max(h.end for h in hours.values()),
+        )
+
+        for pk, teacher_hours in hours.items():
+            result[pk] = schedules[pk].vectorized_slots(teacher_hours.start, teacher_hours.end, period)
+
+        return result
+
+    def find_nearest_slots(self, lesson_type=None, start=None, count=10, days=14, period=datetime.timedelta(minutes=30)):
+        """
+        Find the nearest free slots among all teachers, that can host the lesson type.
+
+        Per-teacher slot streams are merged lazily, so the days after the one, where
+        the requested slot count is reached, are not calculated at all.
+
+        Returns an iterable of (slot, teacher) tuples ordered by slot.
+        """
+        if start is None:
+            start = timezone.now()
+
+        queryset = self.with_photos().select_related('user__crm')
+        if lesson_type is not None:
+            queryset = queryset.filter(allowed_lessons=lesson_type)
+
+        teachers = list(queryset)
+        if not teachers:
+            return
+
+        weekly_hours = working_hours_cache.for_teachers(teacher.pk for teacher in teachers)
+        teachers = [teacher for teacher in teachers if weekly_hours[teacher.pk].hours]  # teachers without working hours have no slots at all
+        if not teachers:
+            return
+
+        first_day = timezone.localtime(start).date()
+        dates = [timezone.make_aware(datetime.datetime.combine(first_day + datetime.timedelta(days=i), datetime.time.min)) for i in range(0, days)]
+
+        daily_schedules = _DailySchedules(teachers, weekly_hours)
+
+        streams = [_slot_stream(teacher, dates, daily_schedules, start, period, lesson_type) for teacher in teachers]
+        for (slot, pk, teacher) in islice(heapq.merge(*streams), count):
+            yield (slot, teacher)
+
     def find_lessons(self, date, **kwargs):
         """
         Find all lessons, that are planned to a date. Accepts keyword agruments
@@ -183,22 +343,52 @@ class Teacher(models.Model):
         if hours is None:
             return None
 
-        if hours.end > timezone.make_aware(minute_till_midnight(date)):
-            hours.end = timezone.make_aware(minute_after_midnight(date))
+        _clip_working_hours_to_date(hours, date)
 
-        auto_schedule = AutoSchedule(teacher=self)
-        return auto_schedule.slots(hours.start, hours.end, period)
+        auto_schedule = AutoSchedule(teacher=self, start=hours.start, end=hours.end)
+        return auto_schedule.vectorized_slots(hours.start, hours.end, period)
 
-    def free_slots_for_dates(self, dates):
+    def free_slots_for_dates(self, dates, period=datetime.timedelta(minutes=30)):
         """
-        Get an iterable of by-day auto schedule
+        Get an iterable of by-day auto schedule.
+
+        Working hours and busy periods are loaded once for all dates.
         """
+        dates = list(dates)
+        weekly_hours = working_hours_cache.for_teacher(self.pk)
+
+        hours_for_dates = []
         for date in dates:
+            hours = weekly_hours.for_date(date)
+            if hours is not None:
+                _clip_working_hours_to_date(hours, date)
+            hours_for_dates.append(hours)
+
+        auto_schedule = None
+        if any(hours_for_dates):
+            auto_schedule = AutoSchedule(
+                teacher=self,
+                start=min(hours.start for hours in hours_for_dates if hours is not None),
+                end=max(hours.end for hours in hours_for_dates if hours is not None),
+            )
+
+        for date, hours in zip(dates, hours_for_dates):
             yield {
                 'date': date,
-                'slots': self.find_free_slots(date)
+                'slots': auto_schedule.vectorized_slots(hours.start, hours.end, period) if hours is not None else None,
             }
 
+    def free_slots_for_range(self, start, end, period=datetime.timedelta(minutes=30)):
+        """
+        Get an iterable of by-day auto schedule for every day from start till end (not including it)
+        """
+        dates = []
+        while start < end:
+            dates.append(start)
+            start += datetime.timedelta(days=1)
+
+        return self.free_slots_for_dates(dates, period)
+
     def available_lessons(self, lesson_type):
         """
         Get list of lessons, that teacher can lead
@@ -251,14 +441,13 @@ class Teacher(models.Model):
         Returns an iterable of slots as datetime objects.
         """
         TimelineEntry = apps.get_model('timeline.entry')
-        for entry in TimelineEntry.objects.filter(teacher=self, start__range=day_range(date), **kwargs):
-            if entry.is_free:
-                try:
-                    entry.clean()
-                except (AutoScheduleExpcetion, DoesNotFitWorkingHours) as e:
-                    continue
+        entries = TimelineEntry.objects \
+            .filter(teacher=self, start__range=day_range(date), **kwargs) \
+            .select_related('teacher') \
+            .prefetch_related('lesson')
 
-                yield entry.start
+        for entry in TimelineEntry.objects.only_valid(entry for entry in entries if entry.is_free):
+            yield entry.start
 
     def __delete_lesson_types_that_dont_require_a_timeline_entry(self, kwargs):
         """
@@ -285,7 +474,12 @@ class WorkingHoursManager(models.Manager):
 
         All working hours objects are returned in the server timezone, defined
         in settings.TIME_ZONE
+
+        When called from the related manager, like teacher.working_hours.for_date(),
+        uses cached teachers working hours, see teachers.working_hours.
         """
+        if hasattr(self, 'instance'):
+            return working_hours_cache.for_teacher(self.instance.pk).for_date(date)
 
         date = timezone.localtime(date)
 
@@ -294,12 +488,21 @@ class WorkingHoursManager(models.Manager):
         except ObjectDoesNotExist:
             return None
 
-        server_tz = pytz.timezone(settings.TIME_ZONE)
+        return hours.localize(date)
+
+    def by_teacher_for_date(self, teachers, date):
+        """
+        Return a dict of working hours objects for the date, keyed by teacher pk.
 
-        hours.start = timezone.make_aware(datetime.datetime.combine(date, hours.start), timezone=server_tz)
-        hours.end = timezone.make_aware(datetime.datetime.combine(date, hours.end), timezone=server_tz)
+        Teachers, that do not work this day, are not present in the dict.
+        """
+        result = {}
+        for teacher_id, weekly_hours in working_hours_cache.for_teachers(teacher.pk for teacher in teachers).items():
+            hours = weekly_hours.for_date(date)
+            if hours is not None:
+                result[teacher_id] = hours
 
-        return hours
+        return result
 
 
 class WorkingHours(models.Model):
@@ -319,6 +522,18 @@ class WorkingHours(models.Model):
     start = models.TimeField('Start hour (EDT)')
     end = models.TimeField('End hour (EDT)')
 
+    def localize(self, date):
+        """
+        Turn start and end hours to the datetime objects for the date in the
+        server timezone. Returns self for chaining.
+        """
+        server_tz = pytz.timezone(settings.TIME_ZONE)
+
+        self.start = timezone.make_aware(datetime.datetime.combine(date, self.start), timezone=server_tz)
+        self.end = timezone.make_aware(datetime.datetime.combine(date, self.end), timezone=server_tz)
+
+        return self
+
     def does_fit(self, time):
         """
         Check if time fits within working hours
@@ -361,3 +576,21 @@ class Absence(models.Model):
     def __str__(self):
         return '%s of %s from %s to %s' % \
             (self.type, str(self.teacher), format(self.start, 'Y-m-d H:i'), format(self.end, 'Y-m-d H:i'))
+
+
+class FreeSlots(models.Model):
+    """
+    Materialized free slots of a teacher for a single day, based on working hours.
+
+    Rows are built on a cache miss and dropped when teachers working hours, absences,
+    external events or timeline entries change, see teachers.free_slots for details.
+    """
+    teacher = models.ForeignKey(Teacher, on_delete=models.CASCADE, related_name='+')
+    date = models.DateField()
+    tz = models.CharField(max_length=64)  # days and slots differ for customers in different timezones
+    version = models.CharField(max_length=65, blank=True)
+    slots = ArrayField(models.DateTimeField(), null=True)  # None means, that the teacher does not work this day
+    build_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('teacher', 'date', 'tz')
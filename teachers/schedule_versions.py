@@ -0,0 +1,36 @@
+"""
+Schedule versions of teachers.
+
+A version is a random token, that is changed after every commited change of the
+teacher schedule: working hours, absences, external events and timeline entries
+including their taken slots. Use it as a part of cache keys for anything, that is
+calculated from the teachers schedule, e.g. market JSON responses.
+
+Versions are changed on commit, so a parallel request can't cache the data read
+before the commit with the new version.
+"""
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _key(teacher_id):
+    return 'teachers:schedule_version:%d' % teacher_id
+
+
+def for_teachers(teacher_ids):
+    """
+    Return a dict of versions by teacher pk. Unknown versions are empty strings
+    """
+    teacher_ids = list(teacher_ids)
+    versions = cache.get_many([_key(pk) for pk in teacher_ids])
+
+    return {pk: versions.get(_key(pk)) or '' for pk in teacher_ids}
+
+
+def bump(teacher_id):
+    """
+    Change the version of the teacher schedule after the current transaction commits
+    """
+    transaction.on_commit(lambda: cache.set(_key(teacher_id), uuid4().hex, None))
@@ -0,0 +1,82 @@
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from extevents.models import ExternalEvent, RecurringExternalEvent
+from teachers import free_slots, schedule_versions, working_hours
+from teachers.models import Absence, WorkingHours
+from timeline.models import Entry as TimelineEntry
+
+
+@receiver(post_save, sender=WorkingHours, dispatch_uid='invalidate_working_hours_cache_on_save')
+@receiver(post_delete, sender=WorkingHours, dispatch_uid='invalidate_working_hours_cache_on_delete')
+def invalidate_working_hours_cache(sender, **kwargs):
+    working_hours.invalidate(kwargs['instance'].teacher_id)
+    free_slots.invalidate_teacher(kwargs['instance'].teacher_id)
+    schedule_versions.bump(kwargs['instance'].teacher_id)
+
+
+@receiver(post_save, sender=RecurringExternalEvent, dispatch_uid='invalidate_free_slots_on_recurring_event_save')
+@receiver(post_delete, sender=RecurringExternalEvent, dispatch_uid='invalidate_free_slots_on_recurring_event_delete')
+def invalidate_free_slots_on_recurring_event_change(sender, **kwargs):
+    """
+    Recurring events can last forever, so all free slots of the teacher are dropped
+    """
+    free_slots.invalidate_teacher(kwargs['instance'].teacher_id)
+    schedule_versions.bump(kwargs['instance'].teacher_id)
+
+
+# Busy periods of teachers: absences, external events and timeline entries. When one of them
+# changes, materialized free slots are dropped for the days it has occupied before and after
+# the change. Any save bumps the teacher schedule version.
+BUSY_PERIOD_MODELS = (Absence, ExternalEvent, TimelineEntry)
+
+
+def _period(instance):
+    """
+    Teacher, start, end and approval status (only for absences) of the busy period.
+    __dict__ is used to not to load deferred fields.
+    """
+    return tuple(instance.__dict__.get(field) for field in ('teacher_id', 'start', 'end', 'is_approved'))
+
+
+def _invalidate_free_slots(period):
+    teacher_id, start, end = period[:3]
+    if None not in (teacher_id, start, end):
+        free_slots.invalidate(teacher_id, start, end)
+
+
+def _bump_schedule_versions(*periods):
+    for teacher_id in set(period[0] for period in periods):
+        if teacher_id is not None:
+            schedule_versions.bump(teacher_id)
+
+
+def remember_busy_period(sender, **kwargs):
+    instance = kwargs['instance']
+    instance._initial_busy_period = _period(instance)
+
+
+def invalidate_free_slots_on_save(sender, **kwargs):
+    instance = kwargs['instance']
+    initial, current = getattr(instance, '_initial_busy_period', (None, None, None, None)), _period(instance)
+
+    _bump_schedule_versions(initial, current)
+
+    if kwargs['created']:
+        _invalidate_free_slots(current)
+    elif initial != current:
+        _invalidate_free_slots(initial)
+        _invalidate_free_slots(current)
+
+    instance._initial_busy_period = current
+
+
+def invalidate_free_slots_on_delete(sender, **kwargs):
+    _invalidate_free_slots(_period(kwargs['instance']))
+    _bump_schedule_versions(_period(kwargs['instance']))
+
+
+for Model in BUSY_PERIOD_MODELS:
+    post_init.connect(remember_busy_period, sender=Model, dispatch_uid='remember_busy_period_%s' % Model.__name__)
+    post_save.connect(invalidate_free_slots_on_save, sender=Model, dispatch_uid='invalidate_free_slots_on_save_%s' % Model.__name__)
+    post_delete.connect(invalidate_free_slots_on_delete, sender=Model, dispatch_uid='invalidate_free_slots_on_delete_%s' % Model.__name__)
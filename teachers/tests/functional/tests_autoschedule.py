@@ -7,6 +7,7 @@ from freezegun import freeze_time
 from mixer.backend.django import mixer
 
 from elk.utils.testing import TestCase, create_teacher
+from extevents.models import RecurringExternalEvent
 from lessons import models as lessons
 from market.exceptions import AutoScheduleExpcetion
 from teachers.models import Teacher, WorkingHours
@@ -59,6 +60,42 @@ class TestTeacherManager(TestCase):
         self.assertEqual(len(res), 2)
         self.assertEqual(len(res[0]['slots']), 4)
 
+    def test_get_free_slots_for_dates_are_the_same_as_for_a_single_date(self):
+        mixer.blend('extevents.ExternalEvent', teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 13, 30), end=self.tzdatetime(2032, 5, 3, 14, 0))
+        mixer.blend('teachers.Absence', teacher=self.teacher, start=self.tzdatetime(2032, 5, 4, 17, 0), end=self.tzdatetime(2032, 5, 4, 18, 0))
+        dates = [self.tzdatetime(2032, 5, 3) + timedelta(days=i) for i in range(0, 14)]
+
+        res = list(self.teacher.free_slots_for_dates(dates))
+        self.assertEqual(len(res), 14)
+        for day in res:
+            self.assertEqual(day['slots'], self.teacher.find_free_slots(day['date']))
+
+    def test_get_free_slots_for_dates_query_count(self):
+        dates = [self.tzdatetime(2032, 5, 3) + timedelta(days=i) for i in range(0, 14)]
+
+        with self.assertNumQueries(5):  # working hours, external events, recurring external events, absences, timeline entries
+            list(self.teacher.free_slots_for_dates(dates))
+
+    def test_recurring_external_events_are_busy(self):
+        RecurringExternalEvent.objects.create(
+            teacher=self.teacher,
+            src=mixer.blend('extevents.GoogleCalendar', teacher=self.teacher),
+            start=self.tzdatetime(2032, 1, 5, 13, 0),  # monday
+            duration=timedelta(hours=1),
+            rrule='RRULE:FREQ=WEEKLY',
+        )
+        slots = self.teacher.find_free_slots(date=self.tzdatetime(2032, 5, 3))
+
+        self.assertEqual([slot.strftime('%H:%M') for slot in slots], ['14:00', '14:30'])
+
+    def test_get_free_slots_for_range(self):
+        res = list(self.teacher.free_slots_for_range(self.tzdatetime(2032, 5, 3), self.tzdatetime(2032, 5, 10)))
+        self.assertEqual(len(res), 7)
+        self.assertEqual(res[0]['date'], self.tzdatetime(2032, 5, 3))
+        self.assertEqual(len(res[0]['slots']), 4)  # monday
+        self.assertEqual(len(res[1]['slots']), 4)  # tuesday
+        self.assertIsNone(res[2]['slots'])  # wednesday
+
     def test_get_free_slots_from_past(self):
         """
         Make sure, that timeline slots are not returned from distant past
@@ -173,6 +210,85 @@ class TestTeacherManager(TestCase):
         free_teachers = list(Teacher.objects.find_free(date=self.tzdatetime(2017, 7, 20)))
         self.assertEquals(len(free_teachers), 0)  # no one works on wednesdays
 
+    def test_find_teacher_by_date_in_batch(self):
+        """
+        Batch mode of find_free() should return the same slots as find_free_slots()
+        """
+        busy_teacher = create_teacher()
+        mixer.blend(WorkingHours, teacher=busy_teacher, weekday=0, start='12:00', end='16:00')
+        mixer.blend('extevents.ExternalEvent', teacher=busy_teacher, start=self.tzdatetime(2032, 5, 3, 12, 30), end=self.tzdatetime(2032, 5, 3, 13, 30))
+        mixer.blend('teachers.Absence', teacher=busy_teacher, start=self.tzdatetime(2032, 5, 3, 14, 00), end=self.tzdatetime(2032, 5, 3, 14, 15))
+
+        free_teachers = list(Teacher.objects.find_free(date=self.tzdatetime(2032, 5, 3)))
+        self.assertEqual(len(free_teachers), 2)
+
+        for teacher in free_teachers:
+            self.assertEqual(list(teacher.free_slots), list(teacher.find_free_slots(date=self.tzdatetime(2032, 5, 3))))
+
+    def test_find_teacher_by_date_query_count_does_not_depend_on_teacher_count(self):
+        for i in range(0, 5):
+            create_teacher(works_24x7=True)
+
+        with self.assertNumQueries(10):  # teachers, materialized slots, working hours, external events, recurring external events, absences, timeline entries and storing the slots within a savepoint
+            free_teachers = list(Teacher.objects.find_free(date=self.tzdatetime(2032, 5, 3)))
+
+        self.assertEqual(len(free_teachers), 6)
+
+    def test_find_nearest_slots(self):
+        slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 3), count=3))
+
+        self.assertEqual([slot for (slot, teacher) in slots], [
+            self.tzdatetime(2032, 5, 3, 13, 0),
+            self.tzdatetime(2032, 5, 3, 13, 30),
+            self.tzdatetime(2032, 5, 3, 14, 0),
+        ])
+        self.assertEqual(slots[0][1], self.teacher)
+
+    def test_find_nearest_slots_of_different_teachers(self):
+        early_bird = create_teacher()
+        mixer.blend(WorkingHours, teacher=early_bird, weekday=0, start='12:00', end='13:30')
+
+        slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 3), count=4))
+
+        self.assertEqual([(slot.strftime('%H:%M'), teacher) for (slot, teacher) in slots], [
+            ('12:00', early_bird),
+            ('12:30', early_bird),
+            ('13:00', self.teacher),  # teachers with the same slot are ordered by pk
+            ('13:00', early_bird),
+        ])
+
+    def test_find_nearest_slots_on_the_next_week(self):
+        slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 4, 18, 0), count=3))
+
+        self.assertEqual([slot for (slot, teacher) in slots], [
+            self.tzdatetime(2032, 5, 4, 18, 0),
+            self.tzdatetime(2032, 5, 4, 18, 30),
+            self.tzdatetime(2032, 5, 10, 13, 0),  # next monday
+        ])
+
+    def test_find_nearest_slots_respects_the_day_limit(self):
+        slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 4, 18, 0), count=3, days=3))
+        self.assertEqual(len(slots), 2)
+
+    def test_find_nearest_slots_stops_after_the_first_day(self):
+        for i in range(0, 5):
+            create_teacher(works_24x7=True)
+
+        with self.assertNumQueries(6):  # teachers, working hours and four busy period sources of a single day
+            slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 3), count=10))
+
+        self.assertEqual(len(slots), 10)
+
+    def test_find_nearest_slots_does_not_load_days_the_teacher_does_not_work(self):
+        sunday_teacher = create_teacher()
+        mixer.blend(WorkingHours, teacher=sunday_teacher, weekday=6, start='13:00', end='15:00')
+        create_teacher()  # no working hours at all
+
+        with self.assertNumQueries(10):  # teachers, working hours and four busy period sources for monday and sunday only
+            slots = list(Teacher.objects.find_nearest_slots(start=self.tzdatetime(2032, 5, 3), count=1))
+
+        self.assertEqual(slots[0][1], self.teacher)
+
     def test_get_teachers_by_lesson_type(self):
         """
         Test that TeacherManager.find_free() ignores teachers that can't host this lesson types.
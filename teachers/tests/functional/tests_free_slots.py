@@ -0,0 +1,125 @@
+from unittest.mock import MagicMock, patch
+
+from django.test import override_settings
+from django.utils import timezone
+from freezegun import freeze_time
+from mixer.backend.django import mixer
+
+from elk.utils.testing import TestCase, create_teacher
+from extevents.models import ExternalEvent
+from teachers.models import Absence, FreeSlots, Teacher, WorkingHours
+from timeline.models import Entry as TimelineEntry
+
+
+class TestMaterializedFreeSlots(TestCase):
+    """
+    Teacher.objects.find_free() reads materialized free slots, see teachers.free_slots
+    """
+    def setUp(self):
+        self.teacher = create_teacher()
+        self.monday = mixer.blend(WorkingHours, teacher=self.teacher, weekday=0, start='13:00', end='15:00')
+
+    def _slots(self, date=None):
+        if date is None:
+            date = self.tzdatetime(2032, 5, 3)
+
+        teachers = list(Teacher.objects.find_free(date=date))
+        if not teachers:
+            return []
+
+        return [slot.strftime('%H:%M') for slot in teachers[0].free_slots]
+
+    def test_slots_are_stored(self):
+        self.assertEqual(self._slots(), ['13:00', '13:30', '14:00', '14:30'])
+
+        self.assertEqual(FreeSlots.objects.filter(teacher=self.teacher).count(), 1)
+
+        with self.assertNumQueries(2):  # teachers and materialized slots
+            self.assertEqual(self._slots(), ['13:00', '13:30', '14:00', '14:30'])
+
+    def test_days_without_working_hours_are_stored(self):
+        self.assertEqual(self._slots(date=self.tzdatetime(2032, 5, 4)), [])
+
+        with self.assertNumQueries(2):
+            self.assertEqual(self._slots(date=self.tzdatetime(2032, 5, 4)), [])
+
+    def test_external_event(self):
+        self._slots()
+
+        mixer.blend(ExternalEvent, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 13, 0), end=self.tzdatetime(2032, 5, 3, 14, 0))
+
+        self.assertEqual(self._slots(), ['14:00', '14:30'])
+
+    def test_absence_approval(self):
+        absence = mixer.blend(Absence, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 0, 0), end=self.tzdatetime(2032, 5, 3, 23, 59), is_approved=False)
+        self.assertEqual(len(self._slots()), 4)
+
+        absence.is_approved = True
+        absence.save()
+
+        self.assertEqual(self._slots(), [])
+
+    def test_moving_a_timeline_entry_invalidates_both_days(self):
+        entry = mixer.blend(TimelineEntry, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 13, 0), end=self.tzdatetime(2032, 5, 3, 14, 0))
+        self.assertEqual(self._slots(), ['14:00', '14:30'])
+        self.assertEqual(len(self._slots(date=self.tzdatetime(2032, 5, 10))), 4)
+
+        entry.start = self.tzdatetime(2032, 5, 10, 13, 0)
+        entry.end = self.tzdatetime(2032, 5, 10, 14, 0)
+        entry.save()
+
+        self.assertEqual(len(self._slots()), 4)
+        self.assertEqual(self._slots(date=self.tzdatetime(2032, 5, 10)), ['14:00', '14:30'])
+
+    @override_settings(TIME_ZONE='UTC')
+    def test_booking_in_other_timezone_invalidates_the_server_day(self):
+        self._slots()
+
+        with timezone.override('Asia/Vladivostok'):  # 2032-05-04 00:00 there
+            mixer.blend(TimelineEntry, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 14, 0), end=self.tzdatetime(2032, 5, 3, 15, 0))
+
+        self.assertEqual(self._slots(), ['13:00', '13:30'])
+
+    @override_settings(TIME_ZONE='UTC')
+    def test_slots_are_stored_by_timezone(self):
+        with timezone.override('Asia/Vladivostok'):
+            self.assertEqual(len(self._slots(date=self.tzdatetime('Asia/Vladivostok', 2032, 5, 3))), 2)  # working hours are clipped by the local midnight
+
+        self.assertEqual(len(self._slots()), 4)
+        self.assertEqual(FreeSlots.objects.filter(teacher=self.teacher).count(), 2)
+
+    def test_other_days_are_not_invalidated(self):
+        self._slots()
+        self._slots(date=self.tzdatetime(2032, 5, 10))
+
+        mixer.blend(ExternalEvent, teacher=self.teacher, start=self.tzdatetime(2032, 5, 10, 13, 0), end=self.tzdatetime(2032, 5, 10, 14, 0))
+
+        self.assertEqual(FreeSlots.objects.filter(teacher=self.teacher).count(), 1)
+        with self.assertNumQueries(2):
+            self._slots()
+
+    def test_working_hours(self):
+        self._slots()
+
+        self.monday.end = '14:00'
+        self.monday.save()
+
+        self.assertEqual(self._slots(), ['13:00', '13:30'])
+
+    def test_past_slots_are_filtered_out(self):
+        with freeze_time('2032-05-01'):
+            self._slots()
+
+        with freeze_time(self.tzdatetime(2032, 5, 3, 13, 45)):
+            self.assertEqual(self._slots(), ['14:00', '14:30'])
+
+    def test_outdated_version(self):
+        self._slots()
+
+        FreeSlots.objects.filter(teacher=self.teacher).update(slots=[])  # now the stored slots are obviously wrong
+
+        with patch('teachers.free_slots.cache') as cache:
+            cache.get_many = MagicMock(return_value={'teachers:free_slots:%d:2032-05-03' % self.teacher.pk: 'new-version'})
+            self.assertEqual(len(self._slots()), 4)
+
+            self.assertEqual(FreeSlots.objects.filter(teacher=self.teacher).count(), 1)
@@ -1,11 +1,13 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
+from django.db import transaction
 from django.test import override_settings
 from django.utils import timezone
 from django.utils.dateparse import parse_time
 from mixer.backend.django import mixer
 
-from elk.utils.testing import TestCase, create_teacher
+from elk.utils.testing import TestCase, TransactionTestCase, create_teacher
+from teachers import working_hours
 from teachers.models import WorkingHours
 
 
@@ -35,14 +37,38 @@ class TestWorkingHours(TestCase):
         timezone.activate('Europe/Moscow')
         tuesday = self.tzdatetime('Europe/Moscow', 2032, 5, 3, 2, 0)
 
+        hours = self.teacher.working_hours.for_date(date=tuesday)  # it is still monday in the server timezone, but we take the user's one
+        self.assertIsNotNone(hours)
+        self.assertEqual(hours.weekday, 0)
+
+    def test_working_hours_for_date_does_not_change_cached_hours(self):
+        first = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+        second = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 10))
+
+        self.assertEqual(first.start.strftime('%Y-%m-%d %H:%M'), '2032-05-03 13:00')
+        self.assertEqual(second.start.strftime('%Y-%m-%d %H:%M'), '2032-05-10 13:00')
+
+    def test_working_hours_for_date_without_a_teacher(self):
         with patch('teachers.models.WorkingHoursManager.get') as get:
             try:
-                self.teacher.working_hours.for_date(date=tuesday)
+                WorkingHours.objects.for_date(date=self.tzdatetime(2032, 5, 3))
             except:
                 pass
 
             get.assert_called_once_with(weekday=0)
 
+    def test_working_hours_by_teacher_for_date(self):
+        other_teacher = create_teacher()
+        mixer.blend(WorkingHours, teacher=other_teacher, weekday=1, start='10:00', end='11:00')
+
+        hours = WorkingHours.objects.by_teacher_for_date([self.teacher, other_teacher], date=self.tzdatetime(2032, 5, 4))
+        self.assertEqual(len(hours), 2)
+        self.assertEqual(hours[self.teacher.pk].start.strftime('%Y-%m-%d %H:%M'), '2032-05-04 17:00')
+        self.assertEqual(hours[other_teacher.pk].start.strftime('%Y-%m-%d %H:%M'), '2032-05-04 10:00')
+
+        hours = WorkingHours.objects.by_teacher_for_date([self.teacher, other_teacher], date=self.tzdatetime(2032, 5, 3))
+        self.assertEqual(list(hours.keys()), [self.teacher.pk])
+
     def test_working_hours_fits_ok(self):
         self.assertTrue(self._does_fit('13:00'))
         self.assertTrue(self._does_fit('13:30'))
@@ -59,3 +85,63 @@ class TestWorkingHours(TestCase):
         return self.monday.does_fit(
             parse_time(t)
         )
+
+
+class TestWorkingHoursCache(TransactionTestCase):
+    """
+    Working hours are cached only outside of transactions, so this test
+    case is not wrapped into a transaction.
+    """
+    def setUp(self):
+        working_hours.clear()
+
+        self.teacher = create_teacher()
+        self.monday = mixer.blend(WorkingHours, teacher=self.teacher, weekday=0, start='13:00', end='15:00')
+
+    def test_cached(self):
+        self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        with self.assertNumQueries(0):
+            hours = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        self.assertEqual(hours.end.strftime('%Y-%m-%d %H:%M'), '2032-05-03 15:00')
+
+    def test_invalidation_on_save(self):
+        self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        self.monday.end = '16:00'
+        self.monday.save()
+
+        hours = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+        self.assertEqual(hours.end.strftime('%Y-%m-%d %H:%M'), '2032-05-03 16:00')
+
+    def test_invalidation_on_delete(self):
+        self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        self.monday.delete()
+
+        self.assertIsNone(self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3)))
+
+    def test_invalidation_waits_for_commit(self):
+        self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        with transaction.atomic():
+            self.monday.end = '16:00'
+            self.monday.save()
+
+            self.assertIn(self.teacher.pk, working_hours._weekly_hours)  # still cached for other requests
+            hours = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+            self.assertEqual(hours.end.strftime('%Y-%m-%d %H:%M'), '2032-05-03 16:00')  # but not for the transaction itself
+
+        self.assertNotIn(self.teacher.pk, working_hours._weekly_hours)
+
+    def test_invalidation_by_another_process(self):
+        self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        WorkingHours.objects.filter(pk=self.monday.pk).update(end='16:00')  # no signals here
+
+        with patch('teachers.working_hours.cache') as cache:
+            cache.get_many = MagicMock(return_value={'teachers:working_hours:%d' % self.teacher.pk: 'new-version'})
+            hours = self.teacher.working_hours.for_date(date=self.tzdatetime(2032, 5, 3))
+
+        self.assertEqual(hours.end.strftime('%Y-%m-%d %H:%M'), '2032-05-03 16:00')
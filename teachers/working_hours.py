@@ -0,0 +1,108 @@
+"""
+Per-process cache of teachers working hours.
+
+Working hours change rarely, but are checked on every availability calculation,
+so every process keeps compiled weekly hours of every teacher it has met. The cache
+is invalidated by teachers.signals when :model:`teachers.WorkingHours` are saved
+or deleted. Other processes learn about the change through a version token, stored
+in the configured django cache backend.
+
+Invalidation happens after the commit, so a parallel request can't cache working hours
+read before it. The cache is neither populated nor read from inside a transaction, because
+the transaction may see uncommitted working hours, that are not invalidated yet.
+"""
+from copy import copy
+from uuid import uuid4
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+_weekly_hours = {}  # teacher pk → (version, WeeklyHours)
+
+
+class WeeklyHours():
+    """
+    Compiled working hours of a single teacher: a weekday → :model:`teachers.WorkingHours` map
+    """
+    def __init__(self, working_hours):
+        self.hours = {hours.weekday: hours for hours in working_hours}
+
+    def for_date(self, date):
+        """
+        Return working hours object for the date with start and end resolved to
+        datetimes in the server timezone, or None if the teacher does not work this day.
+        """
+        date = timezone.localtime(date)
+
+        hours = self.hours.get(date.weekday())
+        if hours is None:
+            return None
+
+        return copy(hours).localize(date)
+
+
+def _version_key(teacher_id):
+    return 'teachers:working_hours:%d' % teacher_id
+
+
+def for_teachers(teacher_ids):
+    """
+    Return a dict of WeeklyHours keyed by teacher pk. Missing ones are loaded with a single query.
+    """
+    teacher_ids = list(teacher_ids)
+    versions = cache.get_many([_version_key(pk) for pk in teacher_ids])
+
+    in_transaction = transaction.get_connection().in_atomic_block
+
+    result = {}
+    missing = []
+    for pk in teacher_ids:
+        version = versions.get(_version_key(pk))
+        cached = _weekly_hours.get(pk)
+        if cached is not None and cached[0] == version and not in_transaction:
+            result[pk] = cached[1]
+        else:
+            missing.append(pk)
+
+    if not missing:
+        return result
+
+    WorkingHours = apps.get_model('teachers.WorkingHours')
+    loaded = {pk: [] for pk in missing}
+    for hours in WorkingHours.objects.filter(teacher_id__in=missing):
+        loaded[hours.teacher_id].append(hours)
+
+    for pk, working_hours in loaded.items():
+        result[pk] = WeeklyHours(working_hours)
+        if not in_transaction:
+            _weekly_hours[pk] = (versions.get(_version_key(pk)), result[pk])
+
+    return result
+
+
+def for_teacher(teacher_id):
+    """
+    Return WeeklyHours of a single teacher
+    """
+    return for_teachers([teacher_id])[teacher_id]
+
+
+def invalidate(teacher_id):
+    """
+    Drop cached working hours of the teacher in this and all other processes after
+    the current transaction commits
+    """
+    def drop():
+        _weekly_hours.pop(teacher_id, None)
+        cache.set(_version_key(teacher_id), uuid4().hex, None)
+
+    transaction.on_commit(drop)
+
+
+def clear():
+    """
+    Drop the whole cache of the current process
+    """
+    _weekly_hours.clear()
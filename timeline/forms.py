@@ -1,4 +1,6 @@
 from django import forms
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
 
 from timeline.models import Entry as TimelineEntry
 
@@ -13,3 +15,33 @@ class EntryForm(forms.ModelForm):
             'lesson_id': forms.Select(),                # populated by calendar.coffee
             'teacher': forms.HiddenInput()              # populated in the template
         }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk is None:
+            self.instance.allow_overlap = False  # the database will not allow a parallel request to create an overlapping entry
+
+
+class RecurringEntryForm(forms.Form):
+    """
+    A lesson, repeated at the same time on selected weekdays, see TimelineEntry.objects.create_recurring()
+    """
+    WEEKDAYS = [(i, i) for i in range(0, 7)]  # 0 is monday
+
+    lesson_type = forms.ModelChoiceField(queryset=ContentType.objects.filter(app_label='lessons'))
+    lesson_id = forms.IntegerField()
+    start = forms.DateTimeField()
+    weekdays = forms.TypedMultipleChoiceField(choices=WEEKDAYS, coerce=int)
+    weeks = forms.IntegerField(min_value=1, max_value=26)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.errors:
+            return cleaned_data
+
+        try:
+            cleaned_data['lesson'] = cleaned_data['lesson_type'].get_object_for_this_type(pk=cleaned_data['lesson_id'])
+        except ObjectDoesNotExist:
+            raise forms.ValidationError('Lesson not found')
+
+        return cleaned_data
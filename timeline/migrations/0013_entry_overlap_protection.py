@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timeline', '0012_ordering'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entry',
+            name='allow_overlap',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunSQL(
+            sql=[
+                'CREATE EXTENSION IF NOT EXISTS btree_gist',
+                # entries, that end before they start, are treated as empty periods, like in market.auto_schedule.BusyPeriods
+                '''CREATE FUNCTION timeline_entry_period(timestamp with time zone, timestamp with time zone) RETURNS tstzrange AS $$
+                    SELECT CASE WHEN $2 > $1 THEN tstzrange($1, $2) ELSE 'empty'::tstzrange END
+                $$ LANGUAGE SQL IMMUTABLE''',
+                'CREATE INDEX timeline_entry_teacher_period ON timeline_entry USING gist (teacher_id, timeline_entry_period(start, "end"))',
+                '''ALTER TABLE timeline_entry ADD CONSTRAINT timeline_entry_no_overlap
+                    EXCLUDE USING gist (teacher_id WITH =, timeline_entry_period(start, "end") WITH &&)
+                    WHERE (NOT allow_overlap)''',
+            ],
+            reverse_sql=[
+                'ALTER TABLE timeline_entry DROP CONSTRAINT timeline_entry_no_overlap',
+                'DROP INDEX timeline_entry_teacher_period',
+                'DROP FUNCTION timeline_entry_period(timestamp with time zone, timestamp with time zone)',
+            ],
+        ),
+    ]
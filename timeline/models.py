@@ -1,18 +1,34 @@
+from collections import OrderedDict
+from datetime import timedelta
+
 from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.postgres.fields import DateTimeRangeField
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.template.defaultfilters import capfirst
 from django.utils import timezone
 from django.utils.dateformat import format
 from django.utils.translation import ugettext as _
 
 from mailer.ical import Ical
-from market.auto_schedule import AutoSchedule
+from market.auto_schedule import AutoSchedule, BusyPeriods, TeacherHasOtherLessons
+from teachers import free_slots, schedule_versions
+from teachers import working_hours as working_hours_cache
 from timeline import exceptions
 
 
+class _EntryPeriod(models.Func):
+    """
+    Period of the entry as a tstzrange, the same expression is indexed, see the 0013 migration
+    """
+    function = 'timeline_entry_period'
+
+    def __init__(self, start, end):
+        super().__init__(start, end, output_field=DateTimeRangeField())
+
+
 class EntryManager(models.Manager):
     def to_be_marked_as_finished(self):
         """
@@ -79,13 +95,172 @@ class EntryManager(models.Manager):
         """
         Generate timeslots for lesson
         """
-        for entry in self.by_lesson(lesson).filter(start__range=(start, end)):
-            if entry.is_free:
-                try:
-                    entry.clean()
-                except (exceptions.AutoScheduleExpcetion, exceptions.DoesNotFitWorkingHours):
+        entries = self.by_lesson(lesson) \
+            .filter(start__range=(start, end)) \
+            .select_related('teacher') \
+            .prefetch_related('lesson')
+
+        for entry in self.only_valid(entry for entry in entries if entry.is_free):
+            yield entry.start
+
+    def only_valid(self, entries):
+        """
+        Bulk version of the Entry.clean(): generate entries, that pass validation.
+
+        Busy periods and working hours are loaded once per teacher, not once per entry.
+        """
+        entries = list(entries)
+        stored_periods = OrderedDict()  # teacher pk → [(entry, start, end)] as they are stored in the DB
+        for entry in entries:
+            stored_periods.setdefault(entry.teacher_id, []).append((entry, entry.start, entry.end))
+            entry.update_from_lesson()
+
+        by_teacher = OrderedDict()
+        for entry in entries:
+            by_teacher.setdefault(entry.teacher_id, []).append(entry)
+
+        schedules = {}
+        for teacher_id, teacher_entries in by_teacher.items():
+            schedules[teacher_id] = AutoSchedule(
+                teacher_entries[0].teacher,
+                exclude_timeline_entries=[entry.pk for entry in teacher_entries],
+                start=min(entry.start for entry in teacher_entries),
+                end=max(entry.end for entry in teacher_entries),
+            )
+
+        weekly_hours = working_hours_cache.for_teachers(by_teacher.keys())
+        now = timezone.now()
+
+        for entry in entries:
+            try:
+                entry.clean(auto_schedule=schedules[entry.teacher_id], working_hours=weekly_hours[entry.teacher_id])
+            except (exceptions.AutoScheduleExpcetion, exceptions.DoesNotFitWorkingHours):
+                continue
+
+            if entry.taken_slots < 1:  # entries from the same bunch are excluded from the schedule, so check them separately
+                siblings = BusyPeriods(
+                    (start, end) for (other, start, end) in stored_periods[entry.teacher_id]
+                    if other is not entry and end >= now and start < entry.end and end > entry.start
+                )
+                if not siblings.is_present(entry.start, entry.end):
                     continue
-                yield entry.start
+
+            yield entry
+
+    def create_occurrences(self, teacher, lesson, starts, allow_besides_working_hours=True):
+        """
+        Bulk-create timeline entries of the lesson, one for every start.
+
+        All occurrences are checked against a single snapshot of the teacher schedule and
+        against each other, valid ones are inserted by a single query. Signals are not sent
+        by bulk_create(), so free slots and the schedule version of the teacher are invalidated here.
+
+        Returns a list of {'start': start, 'entry': entry, 'result': 'ok'} dicts, for conflicting
+        occurrences 'entry' is None and 'result' is the validation exception class name.
+        """
+        occurrences = []
+        for start in sorted(set(starts)):
+            entry = self.model(
+                teacher=teacher,
+                lesson=lesson,
+                start=start,
+                allow_besides_working_hours=allow_besides_working_hours,
+                allow_overlap=False,
+            )
+            entry.update_from_lesson()
+            occurrences.append(entry)
+
+        if not occurrences:
+            return []
+
+        auto_schedule = AutoSchedule(teacher, start=occurrences[0].start, end=max(entry.end for entry in occurrences))
+        working_hours = working_hours_cache.for_teacher(teacher.pk)
+
+        results = []
+        accepted = []
+        for entry in occurrences:
+            try:
+                entry.clean(auto_schedule=auto_schedule, working_hours=working_hours)
+                if not BusyPeriods((other.start, other.end) for other in accepted).is_present(entry.start, entry.end):
+                    raise TeacherHasOtherLessons('Occurrence overlaps with another occurrence')
+            except (exceptions.AutoScheduleExpcetion, exceptions.DoesNotFitWorkingHours) as e:
+                results.append({'start': entry.start, 'entry': None, 'result': e.__class__.__name__})
+                continue
+
+            accepted.append(entry)
+            results.append({'start': entry.start, 'entry': entry, 'result': 'ok'})
+
+        if accepted:
+            try:
+                with transaction.atomic():
+                    self.bulk_create(accepted)
+
+                    free_slots.invalidate(teacher.pk, accepted[0].start, accepted[-1].end)
+                    schedule_versions.bump(teacher.pk)
+            except IntegrityError:  # an overlapping entry has been created in parallel, see Entry.allow_overlap
+                for result in results:
+                    if result['entry'] is not None:
+                        result['entry'] = None
+                        result['result'] = TeacherHasOtherLessons.__name__
+
+        return results
+
+    def create_recurring(self, teacher, lesson, start, weekdays, weeks, **kwargs):
+        """
+        Create timeline entries of the lesson at the time of start on every weekday
+        (0 is monday) for the given count of weeks, starting from the week of start.
+
+        Occurrences before start are skipped. See create_occurrences() for the result format
+        """
+        local_start = timezone.localtime(start).replace(tzinfo=None)  # naive arithmetic keeps the local time over DST changes
+        week_start = local_start - timedelta(days=local_start.weekday())
+
+        starts = []
+        for week in range(0, weeks):
+            for weekday in sorted(set(weekdays)):
+                occurrence = week_start + timedelta(weeks=week, days=weekday)
+                if occurrence >= local_start:
+                    starts.append(timezone.make_aware(occurrence))
+
+        return self.create_occurrences(teacher, lesson, starts, **kwargs)
+
+    def copy_week(self, teacher, week_start):
+        """
+        Copy entries of hosted lessons (i.e. master classes) of the teacher from the week
+        before week_start to the week, starting from week_start.
+
+        Entries of lessons, that do not require a timeline entry (i.e. ordinary lessons) are
+        created by students, so they are not copied. See create_occurrences() for the result format
+        """
+        source = self.get_queryset() \
+            .filter(teacher=teacher) \
+            .filter(start__gte=week_start - timedelta(weeks=1), start__lt=week_start) \
+            .prefetch_related('lesson')
+
+        by_lesson = OrderedDict()
+        for entry in source:
+            if entry.lesson is None or not entry.lesson.timeline_entry_required():
+                continue
+
+            local_start = timezone.localtime(entry.start).replace(tzinfo=None)
+            by_lesson.setdefault(entry.lesson, []).append(timezone.make_aware(local_start + timedelta(weeks=1)))
+
+        results = []
+        for lesson, starts in by_lesson.items():
+            results += self.create_occurrences(teacher, lesson, starts, allow_besides_working_hours=True)
+
+        return sorted(results, key=lambda result: result['start'])
+
+    def overlapping(self, teacher, start, end):
+        """
+        Entries of the teacher, that overlap the [start, end) period.
+
+        The lookup is answered by the GiST index on (teacher, period), see the 0013 migration
+        """
+        return self.get_queryset() \
+            .filter(teacher=teacher) \
+            .annotate(period=_EntryPeriod('start', 'end')) \
+            .filter(period__overlap=_EntryPeriod(models.Value(start), models.Value(end)))
 
     def lessons_for_date(self, start, end, **kwargs):
         """
@@ -120,11 +295,24 @@ class Entry(models.Model):
     ===================
 
     By default timeline entries can overlap each other. You should set
-    instance.`allow_overlap` property to True if you want to enable overlap
-    protection.
+    instance.`allow_overlap` property to False if you want to enable overlap
+    protection. Entries, created by teachers (EntryForm, create_occurrences(),
+    copy_week()) and by students (Class.schedule()) are protected.
+
+    Protection is done by the database: an exclusion constraint does not allow
+    entries of the same teacher with allow_overlap == False to overlap, so save()
+    raises IntegrityError even when the overlapping entry is created in parallel.
+
+    You can check overlapping with the `instance.is_overlapping()` method, it uses
+    the range index, see TimelineEntry.objects.overlapping().
 
-    You can check overlapping with the `instance.is_overlapping()` method. Checks will be
-    done automaticaly, when save() is invoced and allow_overlap == False
+    Student slots
+    =============
+    The `taken_slots` counter is changed only by atomic take_slot() and release_slot()
+    methods, that are used by :model:`market.Class` when scheduling and cancelling. The
+    save() method does not write the counter for existing entries, so saving a stale
+    instance does not overwrite sign-ups, made in parallel. Occasional drift is repaired
+    by the timeline.tasks.reconcile_taken_slots task.
 
     Self-deleting
     =============
@@ -187,6 +375,7 @@ class Entry(models.Model):
     end = models.DateTimeField()
 
     allow_besides_working_hours = models.BooleanField(default=True)
+    allow_overlap = models.BooleanField(default=True)
 
     lesson_type = models.ForeignKey('contenttypes.ContentType', on_delete=models.CASCADE, limit_choices_to={'app_label': 'lessons'})
     lesson_id = models.PositiveIntegerField(null=True, blank=True)
@@ -268,16 +457,65 @@ class Entry(models.Model):
             )
 
     def save(self, *args, **kwargs):
-        self.__get_data_from_lesson()  # update some data (i.e. available slots) from an assigned lesson
-        self.__update_slots()  # update free slot count, check if no classes were added without spare slots for it
+        self.update_from_lesson()  # update some data (i.e. available slots) from an assigned lesson
 
         self.__notify_class_that_it_has_been_finished(*args, **kwargs)  # notify a parent class, that it is used and finished
         should_be_deleted = self.__self_delete_if_needed()  # timeline entry should delete itself, if it is not required
 
-        if not should_be_deleted:
-            super().save(*args, **kwargs)
-        else:
+        if should_be_deleted:
             self.delete()
+            return
+
+        if not self._state.adding and not args and kwargs.get('update_fields') is None:
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != 'taken_slots']  # taken_slots are changed only by take_slot() and release_slot()
+
+        super().save(*args, **kwargs)
+
+    def take_slot(self):
+        """
+        Atomicaly take a single student slot. Returns False if the entry has no free slots.
+
+        The counter is changed by a single UPDATE, guarded by `taken_slots < slots`, so parallel
+        sign-ups can't take more slots, than the entry has. The row stays locked till the end
+        of the current transaction.
+        """
+        updated = Entry.objects \
+            .filter(pk=self.pk, taken_slots__lt=models.F('slots')) \
+            .update(taken_slots=models.F('taken_slots') + 1)
+
+        self.__refresh_taken_slots()
+        schedule_versions.bump(self.teacher_id)
+        return updated == 1
+
+    def release_slot(self):
+        """
+        Atomicaly release a single student slot
+        """
+        Entry.objects \
+            .filter(pk=self.pk, taken_slots__gt=0) \
+            .update(taken_slots=models.F('taken_slots') - 1)
+
+        self.__refresh_taken_slots()
+        schedule_versions.bump(self.teacher_id)
+
+    def recount_slots(self):
+        """
+        Count assigned classes and store the result. Used for repairing counter drift,
+        see timeline.tasks.reconcile_taken_slots.
+
+        Returns True if the counter has been changed
+        """
+        self.taken_slots = self.classes.count()
+
+        updated = Entry.objects \
+            .filter(pk=self.pk) \
+            .exclude(taken_slots=self.taken_slots) \
+            .update(taken_slots=self.taken_slots)
+
+        if updated:
+            schedule_versions.bump(self.teacher_id)
+
+        return updated == 1
 
     def delete(self, src='teacher'):
         """
@@ -298,6 +536,12 @@ class Entry(models.Model):
         if self.pk:  # if the entry has not autodeleted
             super().delete()
 
+    def is_overlapping(self):
+        """
+        Check if the entry overlaps other entries of the teacher
+        """
+        return Entry.objects.overlapping(self.teacher, self.start, self.end).exclude(pk=self.pk).exists()
+
     def has_started(self):
         """
         Did entry start
@@ -312,15 +556,20 @@ class Entry(models.Model):
             return True
         return False
 
-    def is_fitting_working_hours(self):
+    def is_fitting_working_hours(self, working_hours=None):
         """
         Check if timeline entry is within its teachers working hours.
+
+        Accepts preloaded teachers working hours, see teachers.working_hours.
         """
         if self.lesson:
-            self.__get_data_from_lesson()   # When the entry is not saved, we can run into situation when we know the lesson, but don't know the end of entry.
+            self.update_from_lesson()   # When the entry is not saved, we can run into situation when we know the lesson, but don't know the end of entry.
+
+        if working_hours is None:
+            working_hours = self.teacher.working_hours
 
-        hours_start = self.teacher.working_hours.for_date(date=self.start)
-        hours_end = self.teacher.working_hours.for_date(date=self.end)
+        hours_start = working_hours.for_date(date=self.start)
+        hours_end = working_hours.for_date(date=self.end)
 
         if hours_start is None or hours_end is None:
             return False
@@ -344,16 +593,25 @@ class Entry(models.Model):
         )
         return ical.as_string()
 
-    def clean(self):
-        self.__get_data_from_lesson()  # update some data (i.e. available slots) from an assigned lesson
+    def clean(self, auto_schedule=None, working_hours=None):
+        """
+        Validate the entry against teachers timeline.
+
+        Accepts a prebuilt :class:`market.auto_schedule.AutoSchedule`, that should not
+        contain the entry itself, and preloaded teachers working hours. Usefull for checking
+        a bunch of entries, see :model:`timeline.Entry`.objects.only_valid()
+        """
+        self.update_from_lesson()  # update some data (i.e. available slots) from an assigned lesson
 
         if self.taken_slots >= 1:  # there is no need to validate timeline entries when they have students
             return
 
-        auto_schedule = AutoSchedule(self.teacher, exclude_timeline_entries=[self.pk])
+        if auto_schedule is None:
+            auto_schedule = AutoSchedule(self.teacher, exclude_timeline_entries=[self.pk], start=self.start, end=self.end)
+
         auto_schedule.clean(self.start, self.end)
 
-        if not self.allow_besides_working_hours and not self.is_fitting_working_hours():
+        if not self.allow_besides_working_hours and not self.is_fitting_working_hours(working_hours):
             raise exceptions.DoesNotFitWorkingHours('Entry does not fit teachers working hours')
 
     def __self_delete_if_needed(self):
@@ -372,12 +630,13 @@ class Entry(models.Model):
         if self.taken_slots > 0:
             return False
 
-        if self.lesson and not self.lesson.get_contenttype().model_class().timeline_entry_required():
-            return True
+        if not self.lesson or self.lesson.get_contenttype().model_class().timeline_entry_required():
+            return False
 
-        return False
+        self.__refresh_taken_slots()  # a slot could be taken by a parallel request after this instance has been read
+        return self.taken_slots == 0
 
-    def __get_data_from_lesson(self):
+    def update_from_lesson(self):
         """
         Timelentry entry can get some attributes (i.e. available student slots)
         only when it has an assigned lesson.
@@ -392,19 +651,8 @@ class Entry(models.Model):
             if self.teacher != self.lesson.host:
                 raise exceptions.ValidationError('Trying to assign a timeline entry of %s to %s' % (self.teacher, self.lesson.host))
 
-    def __update_slots(self):
-        """
-        Count assigned classes and update available time slots.
-
-        If there is too much customers — raise an exception
-        """
-        if not self.pk:
-            return
-
-        self.taken_slots = self.classes.count()
-
-        if self.taken_slots > self.slots:
-            raise exceptions.ValidationError('Trying to assign a class to event without free slots')
+    def __refresh_taken_slots(self):
+        self.taken_slots = Entry.objects.values_list('taken_slots', flat=True).get(pk=self.pk)
 
     def __notify_class_that_it_has_been_finished(self, *args, **kwargs):
         """
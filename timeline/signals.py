@@ -1,6 +1,10 @@
+from django.conf import settings
+from django.db import transaction
 from django.dispatch import Signal, receiver
+from django.utils import timezone
 
 from mailer.owl import Owl
+from market.signals import class_scheduled
 
 
 class_starting_teacher = Signal(providing_args=['instance'])  # class is about to start (for teachers)
@@ -36,3 +40,23 @@ def notify_class_starting_teacher(sender, **kwargs):
         timezone=c.timeline.teacher.user.crm.timezone,
     )
     owl.send()
+
+
+@receiver(class_scheduled, dispatch_uid='enqueue_pre_start_notifications')
+def enqueue_pre_start_notifications(sender, **kwargs):
+    """
+    Enqueue pre-start notifications for the time, when the class is about to start.
+    When the transaction is rolled back, nothing is enqueued.
+    """
+    if not settings.PRE_START_NOTIFICATIONS_ASYNC:
+        return
+
+    from timeline.tasks import NOTIFY_BEFORE, notify_class_starting  # tasks module imports signals from here
+
+    c = kwargs['instance']
+    start = c.timeline.start
+
+    transaction.on_commit(lambda: notify_class_starting.apply_async(
+        args=[c.pk, start],
+        eta=max(start - NOTIFY_BEFORE, timezone.now()),
+    ))
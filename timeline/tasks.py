@@ -1,22 +1,81 @@
 from datetime import timedelta
 
+from django.db import transaction
+from django.db.models import Count, F
+
 from elk.celery import app as celery
+from elk.logging import logger
 from market.models import Class
+from timeline.models import Entry as TimelineEntry
 from timeline.signals import class_starting_student, class_starting_teacher
 
 
+NOTIFY_BEFORE = timedelta(minutes=30)  # pre-start notifications are sent this time before the class start
+
+
+def _notify_teacher(c):
+    """
+    Send the pre-start notification to the teacher once per timeline entry. Classes
+    are marked as notified by a single UPDATE, so parallel tasks do not send it twice
+    """
+    if Class.objects.filter(timeline_id=c.timeline_id, pre_start_notifications_sent_to_teacher=False).update(pre_start_notifications_sent_to_teacher=True):
+        class_starting_teacher.send(sender=notify_15min_to_class, instance=c)
+
+
+def _notify_student(c):
+    if Class.objects.filter(pk=c.pk, pre_start_notifications_sent_to_student=False).update(pre_start_notifications_sent_to_student=True):
+        class_starting_student.send(sender=notify_15min_to_class, instance=c)
+
+
 @celery.task
 def notify_15min_to_class():
-    for i in Class.objects.starting_soon(timedelta(minutes=30)).filter(pre_start_notifications_sent_to_teacher=False).distinct('timeline'):
-        for other_class_with_the_same_timeline in Class.objects.starting_soon(timedelta(minutes=30)).filter(timeline=i.timeline):
-            """
-            Set all other starting classes as notified either.
-            """
-            other_class_with_the_same_timeline.pre_start_notifications_sent_to_teacher = True
-            other_class_with_the_same_timeline.save()
-        class_starting_teacher.send(sender=notify_15min_to_class, instance=i)
-
-    for i in Class.objects.starting_soon(timedelta(minutes=30)).filter(pre_start_notifications_sent_to_student=False):
-        i.pre_start_notifications_sent_to_student = True
-        i.save()
-        class_starting_student.send(sender=notify_15min_to_class, instance=i)
+    """
+    Send pre-start notifications for classes, that start soon.
+
+    With settings.PRE_START_NOTIFICATIONS_ASYNC notifications are sent by notify_class_starting(),
+    enqueued when the class is scheduled, and this task is only a safety net for lost ones.
+    """
+    for i in Class.objects.starting_soon(NOTIFY_BEFORE).filter(pre_start_notifications_sent_to_teacher=False).distinct('timeline'):
+        _notify_teacher(i)
+
+    for i in Class.objects.starting_soon(NOTIFY_BEFORE).filter(pre_start_notifications_sent_to_student=False):
+        _notify_student(i)
+
+
+@celery.task
+def notify_class_starting(class_id, start):
+    """
+    Send pre-start notifications for a single class. Enqueued with an ETA when the class
+    is scheduled, see timeline.signals.
+
+    Does nothing if the class has been cancelled or rescheduled since then.
+    """
+    c = Class.objects \
+        .filter(pk=class_id, is_scheduled=True, timeline__start=start) \
+        .select_related('timeline') \
+        .first()
+
+    if c is None:
+        return
+
+    _notify_teacher(c)
+    _notify_student(c)
+
+
+@celery.task
+def reconcile_taken_slots():
+    """
+    Repair taken slot counters of non-finished timeline entries, that have drifted
+    from the real count of scheduled classes.
+    """
+    drifted = TimelineEntry.objects \
+        .filter(is_finished=False) \
+        .annotate(classes_count=Count('classes')) \
+        .exclude(taken_slots=F('classes_count')) \
+        .values_list('pk', flat=True)
+
+    for pk in drifted:
+        with transaction.atomic():
+            entry = TimelineEntry.objects.select_for_update().get(pk=pk)  # wait for sign-ups in progress
+            if entry.recount_slots():
+                logger.warning('Taken slot counter of timeline entry #%d has been repaired' % pk)
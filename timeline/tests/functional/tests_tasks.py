@@ -1,11 +1,14 @@
+from datetime import timedelta
 from unittest.mock import patch
 
 from django.core import mail
+from django.test import override_settings
 from freezegun import freeze_time
 from mixer.backend.django import mixer
 
 from elk.utils.testing import ClassIntegrationTestCase, create_customer
-from timeline.tasks import notify_15min_to_class
+from timeline.models import Entry as TimelineEntry
+from timeline.tasks import notify_15min_to_class, notify_class_starting, reconcile_taken_slots
 
 
 class TestStartingSoonEmail(ClassIntegrationTestCase):
@@ -54,3 +57,97 @@ class TestStartingSoonEmail(ClassIntegrationTestCase):
         self.assertIn(self.host.user.email, out_emails)
         self.assertIn(first_customer.user.email, out_emails)
         self.assertIn(other_customer.user.email, out_emails)
+
+
+@override_settings(PRE_START_NOTIFICATIONS_ASYNC=True)
+class TestStartingSoonETA(ClassIntegrationTestCase):
+    """
+    Pre-start notifications, enqueued with an ETA when the class is scheduled
+    """
+    def setUp(self):
+        super().setUp()
+        self.on_commit = patch('timeline.signals.transaction.on_commit', side_effect=lambda f: f())  # test transactions are never commited
+        self.on_commit.start()
+
+    def tearDown(self):
+        self.on_commit.stop()
+
+    def _schedule_a_class(self):
+        entry = self._create_entry()
+        c = self._buy_a_lesson()
+        with patch('timeline.tasks.notify_class_starting.apply_async') as apply_async:
+            self._schedule(c, entry)
+
+        return c, apply_async
+
+    @patch('market.signals.Owl')
+    def test_task_is_enqueued(self, Owl):
+        c, apply_async = self._schedule_a_class()
+
+        apply_async.assert_called_once_with(args=[c.pk, c.timeline.start], eta=self.tzdatetime(2032, 9, 13, 11, 30))
+
+    @patch('market.signals.Owl')
+    def test_task_sends_notifications_once(self, Owl):
+        c, apply_async = self._schedule_a_class()
+
+        with freeze_time('2032-09-13 15:30'):
+            for i in range(0, 3):
+                notify_class_starting(c.pk, c.timeline.start)
+            notify_15min_to_class()  # safety net should not send anything
+
+        self.assertEqual(len(mail.outbox), 2)
+
+    @patch('market.signals.Owl')
+    def test_cancelled_class(self, Owl):
+        c, apply_async = self._schedule_a_class()
+        start = c.timeline.start
+
+        c.cancel()
+        c.save()
+
+        notify_class_starting(c.pk, start)
+        self.assertEqual(len(mail.outbox), 0)
+
+    @patch('market.signals.Owl')
+    def test_rescheduled_class(self, Owl):
+        c, apply_async = self._schedule_a_class()
+
+        notify_class_starting(c.pk, c.timeline.start - timedelta(days=1))  # the task of the previous schedule
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(PRE_START_NOTIFICATIONS_ASYNC=False)
+    @patch('market.signals.Owl')
+    def test_nothing_is_enqueued_without_the_setting(self, Owl):
+        c, apply_async = self._schedule_a_class()
+
+        apply_async.assert_not_called()
+
+
+class TestReconcileTakenSlots(ClassIntegrationTestCase):
+    @patch('market.signals.Owl')
+    def test_drifted_counter_is_repaired(self, Owl):
+        entry = self._create_entry()
+        c = self._buy_a_lesson()
+        self._schedule(c, entry)
+        c.refresh_from_db()
+
+        TimelineEntry.objects.filter(pk=c.timeline.pk).update(taken_slots=0)
+
+        reconcile_taken_slots()
+
+        c.timeline.refresh_from_db()
+        self.assertEqual(c.timeline.taken_slots, 1)
+
+    @patch('market.signals.Owl')
+    def test_finished_entries_are_ignored(self, Owl):
+        entry = self._create_entry()
+        c = self._buy_a_lesson()
+        self._schedule(c, entry)
+        c.refresh_from_db()
+
+        TimelineEntry.objects.filter(pk=c.timeline.pk).update(taken_slots=0, is_finished=True)
+
+        reconcile_taken_slots()
+
+        c.timeline.refresh_from_db()
+        self.assertEqual(c.timeline.taken_slots, 0)
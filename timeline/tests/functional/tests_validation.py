@@ -1,6 +1,8 @@
 import json
 
+from django.db import connection
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from mixer.backend.django import mixer
 
@@ -60,3 +62,54 @@ class TestCheckEntry(ClientTestCase):
         self.assertEqual(response.status_code, 200)
         result = json.loads(response.content.decode('utf-8'))
         return result['result']
+
+
+@freeze_time('2015-01-01 10:00')
+@override_settings(TIME_ZONE='Europe/Moscow')
+class TestCheckEntries(ClientTestCase):
+    """
+    :view:`timeline.check_entries` is a batch version of check_entry for the teacher calendar
+    """
+    def setUp(self):
+        self.teacher = create_teacher()
+        mixer.blend(
+            TimelineEntry,
+            teacher=self.teacher,
+            lesson=mixer.blend(lessons.MasterClass, host=self.teacher),
+            start=self.tzdatetime('Europe/Moscow', 2016, 1, 18, 14, 10),
+            end=self.tzdatetime('Europe/Moscow', 2016, 1, 18, 14, 40),
+        )
+        mixer.blend(
+            Absence,
+            type='vacation',
+            teacher=self.teacher,
+            start=self.tzdatetime(2032, 5, 3, 0, 0),
+            end=self.tzdatetime(2032, 5, 3, 23, 59),
+        )
+
+    def _check_entries(self, *ranges):
+        query = '&'.join('start=%s&end=%s' % r for r in ranges)
+        return self.c.get('/timeline/%s/check_entries/?%s' % (self.teacher.user.username, query))
+
+    def test_per_range_results(self):
+        response = self._check_entries(
+            ('2016-01-18 14:30', '2016-01-18 15:00'),
+            ('2016-01-18 16:00', '2016-01-18 16:30'),
+            ('2032-05-03 14:00', '2032-05-03 14:30'),
+        )
+        self.assertEqual(response.status_code, 200)
+
+        results = json.loads(response.content.decode('utf-8'))['result']
+        self.assertEqual([r['result'] for r in results], ['TeacherHasOtherLessons', 'ok', 'TeacherIsAbsent'])
+        self.assertEqual(results[1]['start'], '2016-01-18T16:00:00+03:00')
+
+    def test_busy_periods_are_loaded_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._check_entries(*[('2016-01-18 %d:00' % hour, '2016-01-18 %d:30' % hour) for hour in range(10, 20)])
+
+        for table in ('teachers_absence', 'extevents_externalevent', 'timeline_entry'):
+            self.assertEqual(len([query for query in queries if 'FROM "%s"' % table in query['sql']]), 1)
+
+    def test_bad_input(self):
+        self.assertEqual(self._check_entries().status_code, 404)
+        self.assertEqual(self._check_entries(('tomorrow', '2016-01-18 15:00')).status_code, 404)
@@ -76,6 +76,20 @@ class TestCancellation(TestCase):
         c.delete()
         self.assertFalse(TimelineEntry.objects.filter(pk=entry.pk).exists())  # during the class saving, entry should have deleted itself
 
+    def test_no_autodelete_when_the_slot_has_been_taken_in_parallel(self):
+        lesson = mixer.blend(lessons.OrdinaryLesson)
+        c = self._buy_a_lesson(lesson)
+        c.schedule(teacher=self.teacher, date=self.tzdatetime(2032, 5, 3, 12, 30))
+        c.save()
+
+        entry = TimelineEntry.objects.get(pk=c.timeline.pk)
+        entry.taken_slots = 0  # stale copy, read before the slot has been taken
+
+        entry.save()
+
+        self.assertTrue(TimelineEntry.objects.filter(pk=entry.pk).exists())
+        self.assertEqual(entry.taken_slots, 1)
+
     def test_entry_no_autodelete_on_lessons_that_require_a_timeline_entry(self):
         """
         Timeline entries for lessons, that require it, should not be deleted event when the class cancles.
@@ -63,19 +63,62 @@ class EntryTestCase(TestCase):
         for i in range(0, 10):
             self.assertTrue(entry.is_free)
             self.assertEqual(entry.taken_slots, i)  # by the way let's test taken_slots count
-            customer = create_customer()
-            c = mixer.blend(Class, lesson_type=lesson.get_contenttype(), customer=customer)
-            entry.classes.add(c)  # please don't use it in your code! use :model:`market.Class`.assign_entry() instead
-            entry.save()
+            self.assertTrue(entry.take_slot())  # please don't use it in your code! use :model:`market.Class`.assign_entry() instead
 
         self.assertFalse(entry.is_free)
 
         """ Let's try to schedule more customers, then event allows """
+        self.assertFalse(entry.take_slot())
+        entry.refresh_from_db()
+        self.assertEqual(entry.taken_slots, 10)
+
+    def test_release_slot(self):
+        lesson = mixer.blend(lessons.MasterClass, slots=10, host=self.teacher1)
+        entry = mixer.blend(TimelineEntry, lesson=lesson, teacher=self.teacher1)
+
+        entry.take_slot()
+        entry.release_slot()
+        self.assertEqual(entry.taken_slots, 0)
+
+        entry.release_slot()
+        self.assertEqual(entry.taken_slots, 0)  # should not go below zero
+
+    def test_saving_a_stale_entry_does_not_change_taken_slots(self):
+        lesson = mixer.blend(lessons.MasterClass, slots=10, host=self.teacher1)
+        entry = mixer.blend(TimelineEntry, lesson=lesson, teacher=self.teacher1)
+
+        TimelineEntry.objects.get(pk=entry.pk).take_slot()  # a parallel sign-up
+
+        entry.save()  # entry.taken_slots == 0 here
+        entry.refresh_from_db()
+        self.assertEqual(entry.taken_slots, 1)
+
+    def test_too_much_classes_can_not_be_scheduled(self):
+        lesson = mixer.blend(lessons.MasterClass, slots=1, host=self.teacher1)
+        entry = mixer.blend(TimelineEntry, lesson=lesson, teacher=self.teacher1)
+
+        first = mixer.blend(Class, lesson_type=lesson.get_contenttype(), customer=create_customer())
+        first.timeline = entry
+        first.save()
+
+        second = mixer.blend(Class, lesson_type=lesson.get_contenttype(), customer=create_customer())
+        second.timeline = TimelineEntry.objects.get(pk=entry.pk)
         with self.assertRaises(ValidationError):
-            customer = create_customer()
-            c = mixer.blend(Class, lesson_type=lesson.get_contenttype(), customer=customer)
-            entry.classes.add(c)  # please don't use it in your code! use :model:`market.Class`.assign_entry() instead
-            entry.save()
+            second.save()
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.taken_slots, 1)
+        self.assertEqual(entry.classes.count(), 1)
+
+    def test_recount_slots(self):
+        lesson = mixer.blend(lessons.MasterClass, slots=10, host=self.teacher1)
+        entry = mixer.blend(TimelineEntry, lesson=lesson, teacher=self.teacher1)
+        c = mixer.blend(Class, lesson_type=lesson.get_contenttype(), customer=create_customer())
+        entry.classes.add(c)  # a class without a taken slot
+
+        self.assertTrue(entry.recount_slots())
+        self.assertEqual(entry.taken_slots, 1)
+        self.assertFalse(entry.recount_slots())  # nothing to repair
 
     def test_as_ical(self):
         """
@@ -1,9 +1,13 @@
 from datetime import timedelta
 
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from freezegun import freeze_time
 from mixer.backend.django import mixer
 
 from elk.utils.testing import TestCase, create_teacher
+from extevents.models import ExternalEvent
 from lessons import models as lessons
 from timeline.models import Entry as TimelineEntry
 
@@ -141,3 +145,80 @@ class TestFindTimelineEntryByStart(TestCase):
         entry = TimelineEntry.objects.by_start(teacher=self.host, start=self.entry.start, lesson=self.lesson)
 
         self.assertIsNone(entry)
+
+
+@override_settings(TIME_ZONE='UTC')
+@freeze_time('2032-05-01 12:00')
+class TestRecurringEntries(TestCase):
+    fixtures = ('lessons',)
+
+    def setUp(self):
+        self.host = create_teacher(works_24x7=True)
+        self.lesson = mixer.blend(lessons.MasterClass, host=self.host, slots=5, duration=timedelta(minutes=30))
+
+    def test_create_recurring(self):
+        results = TimelineEntry.objects.create_recurring(
+            teacher=self.host,
+            lesson=self.lesson,
+            start=self.tzdatetime(2032, 5, 5, 15, 0),  # wednesday
+            weekdays=[0, 2],  # monday and wednesday
+            weeks=2,
+        )
+
+        self.assertEqual([result['start'] for result in results], [
+            self.tzdatetime(2032, 5, 5, 15, 0),  # the monday of the first week is before start
+            self.tzdatetime(2032, 5, 10, 15, 0),
+            self.tzdatetime(2032, 5, 12, 15, 0),
+        ])
+        self.assertEqual(set(result['result'] for result in results), {'ok'})
+        self.assertEqual(TimelineEntry.objects.filter(lesson_id=self.lesson.pk).count(), 3)
+
+        entry = TimelineEntry.objects.get(start=self.tzdatetime(2032, 5, 10, 15, 0))
+        self.assertEqual(entry.end, self.tzdatetime(2032, 5, 10, 15, 30))
+        self.assertEqual(entry.slots, 5)
+
+    def test_conflicts_are_reported_per_occurrence(self):
+        mixer.blend(ExternalEvent, teacher=self.host, start=self.tzdatetime(2032, 5, 10, 14, 0), end=self.tzdatetime(2032, 5, 10, 16, 0))
+
+        results = TimelineEntry.objects.create_recurring(
+            teacher=self.host,
+            lesson=self.lesson,
+            start=self.tzdatetime(2032, 5, 3, 15, 0),
+            weekdays=[0],
+            weeks=3,
+        )
+
+        self.assertEqual([result['result'] for result in results], ['ok', 'TeacherHasEvents', 'ok'])
+        self.assertIsNone(results[1]['entry'])
+        self.assertEqual(TimelineEntry.objects.filter(lesson_id=self.lesson.pk).count(), 2)
+
+    def test_occurrences_check_each_other(self):
+        results = TimelineEntry.objects.create_occurrences(
+            teacher=self.host,
+            lesson=self.lesson,
+            starts=[self.tzdatetime(2032, 5, 3, 15, 0), self.tzdatetime(2032, 5, 3, 15, 15)],
+        )
+
+        self.assertEqual([result['result'] for result in results], ['ok', 'TeacherHasOtherLessons'])
+
+    def test_single_insert(self):
+        starts = [self.tzdatetime(2032, 5, 3, 15, 0) + timedelta(days=i) for i in range(0, 10)]
+        with CaptureQueriesContext(connection) as queries:
+            TimelineEntry.objects.create_occurrences(teacher=self.host, lesson=self.lesson, starts=starts)
+
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('INSERT INTO "timeline_entry"')]), 1)
+
+    def test_copy_week(self):
+        mixer.blend(TimelineEntry, teacher=self.host, lesson=self.lesson, start=self.tzdatetime(2032, 5, 3, 15, 0))
+        mixer.blend(TimelineEntry, teacher=self.host, lesson=self.lesson, start=self.tzdatetime(2032, 5, 6, 17, 0))
+        mixer.blend(TimelineEntry, teacher=self.host, lesson=self.lesson, start=self.tzdatetime(2032, 5, 10, 15, 0))  # already in the target week
+
+        results = TimelineEntry.objects.copy_week(self.host, self.tzdatetime(2032, 5, 10, 0, 0))
+
+        self.assertEqual([result['result'] for result in results], ['TeacherHasOtherLessons', 'ok'])
+        self.assertTrue(TimelineEntry.objects.filter(teacher=self.host, start=self.tzdatetime(2032, 5, 13, 17, 0)).exists())
+
+    def test_ordinary_lessons_are_not_copied(self):
+        mixer.blend(TimelineEntry, teacher=self.host, lesson=lessons.OrdinaryLesson.get_default(), start=self.tzdatetime(2032, 5, 3, 15, 0), taken_slots=1)
+
+        self.assertEqual(TimelineEntry.objects.copy_week(self.host, self.tzdatetime(2032, 5, 10, 0, 0)), [])
@@ -1,3 +1,7 @@
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.db import IntegrityError, transaction
 from django.test import override_settings
 from freezegun import freeze_time
 from mixer.backend.django import mixer
@@ -8,6 +12,7 @@ from lessons import models as lessons
 from market.exceptions import AutoScheduleExpcetion
 from teachers.models import Absence, WorkingHours
 from timeline.exceptions import DoesNotFitWorkingHours
+from timeline.forms import EntryForm
 from timeline.models import Entry as TimelineEntry
 
 
@@ -149,3 +154,149 @@ class TestOverlapValidation(TestCase):
         )
         with self.assertRaises(AutoScheduleExpcetion):
             entry.clean()
+
+
+@override_settings(TIME_ZONE='UTC')
+@freeze_time('2005-02-12 12:22')
+class TestBulkValidation(TestCase):
+    """
+    TimelineEntry.objects.only_valid() should give the same result as Entry.clean()
+    """
+    def setUp(self):
+        self.teacher = create_teacher()
+        self.lesson = mixer.blend(lessons.MasterClass, host=self.teacher, duration=timedelta(minutes=30), slots=5)
+
+    def _entry(self, *args, **kwargs):
+        return mixer.blend(
+            TimelineEntry,
+            teacher=self.teacher,
+            lesson=self.lesson,
+            start=self.tzdatetime(*args),
+            end=self.tzdatetime(*args),
+            **kwargs
+        )
+
+    def test_valid_entries_are_passed(self):
+        first = self._entry(2032, 5, 3, 13, 0)
+        second = self._entry(2032, 5, 3, 14, 0)
+
+        self.assertEqual(list(TimelineEntry.objects.only_valid([first, second])), [first, second])
+
+    def test_entries_check_each_other(self):
+        first = self._entry(2032, 5, 3, 13, 0)
+        overlapping = self._entry(2032, 5, 3, 13, 15)
+
+        self.assertEqual(list(TimelineEntry.objects.only_valid([first, overlapping])), [])
+
+    def test_other_entries(self):
+        mixer.blend(
+            TimelineEntry,
+            teacher=self.teacher,
+            start=self.tzdatetime(2032, 5, 3, 12, 0),
+            end=self.tzdatetime(2032, 5, 3, 13, 15),
+        )
+        overlapping = self._entry(2032, 5, 3, 13, 0)
+        valid = self._entry(2032, 5, 3, 14, 0)
+
+        self.assertEqual(list(TimelineEntry.objects.only_valid([overlapping, valid])), [valid])
+
+    def test_absence(self):
+        mixer.blend(Absence, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 0, 0), end=self.tzdatetime(2032, 5, 3, 23, 59))
+        entry = self._entry(2032, 5, 3, 13, 0)
+
+        self.assertEqual(list(TimelineEntry.objects.only_valid([entry])), [])
+
+    def test_working_hours(self):
+        mixer.blend(WorkingHours, teacher=self.teacher, start='12:00', end='14:00', weekday=0)
+        fitting = self._entry(2032, 5, 3, 13, 0, allow_besides_working_hours=False)
+        not_fitting = self._entry(2032, 5, 3, 15, 0, allow_besides_working_hours=False)
+
+        self.assertEqual(list(TimelineEntry.objects.only_valid([fitting, not_fitting])), [fitting])
+
+    def test_parity_with_clean(self):
+        mixer.blend(ExternalEvent, teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 15, 0), end=self.tzdatetime(2032, 5, 3, 16, 0))
+        entries = [self._entry(2032, 5, 3, hour, minute) for hour in range(12, 18) for minute in (0, 30)]
+
+        def is_valid(entry):
+            try:
+                entry.clean()
+            except AutoScheduleExpcetion:
+                return False
+            return True
+
+        self.assertEqual(
+            [entry.pk for entry in TimelineEntry.objects.only_valid(entries)],
+            [entry.pk for entry in entries if is_valid(entry)]
+        )
+
+    def test_num_queries(self):
+        entries = [self._entry(2032, 5, 3, hour, 0) for hour in range(12, 18)]
+        with self.assertNumQueries(5):  # four busy period sources and working hours
+            list(TimelineEntry.objects.only_valid(entries))
+
+
+class TestDatabaseOverlapProtection(TestCase):
+    def setUp(self):
+        self.teacher = create_teacher()
+
+    def _entry(self, start, end, allow_overlap=False, teacher=None):
+        entry = TimelineEntry(
+            teacher=teacher or self.teacher,
+            lesson_type=lessons.MasterClass.get_contenttype(),
+            start=start,
+            end=end,
+            allow_overlap=allow_overlap,
+        )
+        entry.save()
+        return entry
+
+    def test_overlapping_entries_are_not_saved(self):
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            self._entry(self.tzdatetime(2032, 5, 3, 13, 30), self.tzdatetime(2032, 5, 3, 14, 30))
+
+    def test_adjacent_entries(self):
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+        self._entry(self.tzdatetime(2032, 5, 3, 14, 0), self.tzdatetime(2032, 5, 3, 15, 0))  # should not throw anything
+
+    def test_entries_that_allow_overlap(self):
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 30), self.tzdatetime(2032, 5, 3, 14, 30), allow_overlap=True)  # should not throw anything
+
+    def test_entries_of_other_teachers(self):
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 30), self.tzdatetime(2032, 5, 3, 14, 30), teacher=create_teacher())  # should not throw anything
+
+    def test_overlapping(self):
+        entry = self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0), allow_overlap=True)
+        overlapping = self._entry(self.tzdatetime(2032, 5, 3, 13, 30), self.tzdatetime(2032, 5, 3, 14, 30), allow_overlap=True)
+        self._entry(self.tzdatetime(2032, 5, 3, 14, 30), self.tzdatetime(2032, 5, 3, 15, 30), allow_overlap=True)
+
+        self.assertEqual(list(TimelineEntry.objects.overlapping(self.teacher, entry.start, entry.end)), [entry, overlapping])
+        self.assertTrue(entry.is_overlapping())
+
+        free = TimelineEntry(teacher=self.teacher, start=self.tzdatetime(2032, 5, 3, 16, 0), end=self.tzdatetime(2032, 5, 3, 17, 0))
+        self.assertFalse(free.is_overlapping())
+
+    def test_overlapping_with_an_empty_period(self):
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+
+        self.assertFalse(TimelineEntry.objects.overlapping(self.teacher, self.tzdatetime(2032, 5, 3, 13, 30), self.tzdatetime(2032, 5, 3, 13, 0)).exists())
+
+    def test_entries_created_by_teachers_are_protected(self):
+        self.assertFalse(EntryForm().instance.allow_overlap)
+
+        master_class = mixer.blend(lessons.MasterClass, host=self.teacher, duration=timedelta(minutes=30))
+        results = TimelineEntry.objects.create_occurrences(self.teacher, master_class, [self.tzdatetime(2032, 5, 3, 13, 0)])
+        self.assertFalse(results[0]['entry'].allow_overlap)
+
+    def test_occurrences_overlapping_a_parallel_entry(self):
+        master_class = mixer.blend(lessons.MasterClass, host=self.teacher, duration=timedelta(minutes=30))
+        self._entry(self.tzdatetime(2032, 5, 3, 13, 0), self.tzdatetime(2032, 5, 3, 14, 0))
+
+        with patch('timeline.models.Entry.clean'):  # the entry has been created after the validation
+            results = TimelineEntry.objects.create_occurrences(self.teacher, master_class, [self.tzdatetime(2032, 5, 3, 13, 0)])
+
+        self.assertIsNone(results[0]['entry'])
+        self.assertEqual(results[0]['result'], 'TeacherHasOtherLessons')
@@ -20,6 +20,14 @@ urlpatterns = [
         view=views.EntryCreate.as_view(),
         name='timeline_create',
         ),
+    url(regex=r'(?P<username>.+)/add/recurring/$',
+        view=views.create_recurring,
+        name='create_recurring',
+        ),
+    url(regex=r'(?P<username>.+)/copy_week/(?P<date>\d{4}-\d{2}-\d{2})/$',
+        view=views.copy_week,
+        name='copy_week',
+        ),
     url(regex=r'(?P<username>.+)/(?P<pk>\d+)/$',
         view=views.EntryUpdate.as_view(),
         name='timeline_update',
@@ -33,6 +41,10 @@ urlpatterns = [
         view=views.check_entry,
         name='check_entry',
         ),
+    url(regex=r'(?P<username>.+)/check_entries/$',
+        view=views.check_entries,
+        name='check_entries',
+        ),
 
     url(r'(?P<username>.+)/$', views.TeacherCalendar.as_view(), name='timeline'),
 ]
@@ -2,18 +2,21 @@ from django.apps import apps
 from django.contrib.admin.views.decorators import staff_member_required
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
+from django.db import IntegrityError, transaction
 from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.utils import timezone
 from django.utils.dateformat import format
 from django.utils.dateparse import parse_datetime
 from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_POST
 from django.views.generic.edit import CreateView, UpdateView
 
 from elk.views import DeleteWithoutConfirmationView, StaffRequiredDetailView, StaffRequiredTemplateView
 from market.auto_schedule import AutoSchedule
 from market.sortinghat import SortingHat
 from timeline.forms import EntryForm as TimelineEntryForm
+from timeline.forms import RecurringEntryForm
 from timeline.models import Entry as TimelineEntry
 
 
@@ -53,7 +56,13 @@ class TimelineEntryBaseView():
 
 
 class EntryCreate(TimelineEntryBaseView, CreateView):
-    pass
+    def form_valid(self, form):
+        try:
+            with transaction.atomic():
+                return super().form_valid(form)
+        except IntegrityError:  # an overlapping entry has been created in parallel, see TimelineEntry.allow_overlap
+            form.add_error(None, 'Entry overlaps with another one')
+            return self.form_invalid(form)
 
 
 class EntryUpdate(TimelineEntryBaseView, UpdateView):
@@ -121,10 +130,9 @@ def add_customer(request, username, pk, customer):
         time=format(start, 'H:i'),
     )
 
-    if not hat.do_the_thing():
+    if not hat.schedule():
         raise Http404('%s: %s' % (hat.err, hat.msg))
 
-    hat.c.save()
     return redirect(reverse('timeline:entry_card', kwargs={'username': username, 'pk': hat.c.timeline.pk}))
 
 
@@ -142,7 +150,9 @@ def check_entry(request, username, start, end):
     Teacher = apps.get_model('teachers.Teacher')
 
     s = AutoSchedule(
-        teacher=get_object_or_404(Teacher, user__username=username)
+        teacher=get_object_or_404(Teacher, user__username=username),
+        start=start,
+        end=end,
     )
 
     try:
@@ -152,3 +162,102 @@ def check_entry(request, username, start, end):
         return JsonResponse({'result': e.__class__.__name__})
 
     return JsonResponse({'result': 'ok'})
+
+
+MAX_CHECKED_ENTRIES = 100
+
+
+@staff_member_required
+def check_entries(request, username):
+    """
+    Batch version of check_entry(): check a bunch of ranges for a single teacher.
+    Ranges are passed as the `start` and `end` GET parameters, i.e. ?start=2016-01-18 14:30&end=2016-01-18 15:00&start=...
+
+    Busy periods are loaded once for all ranges. Returns a JSON with the check_entry() result for every range.
+    """
+    try:
+        ranges = [
+            (timezone.make_aware(parse_datetime(start)), timezone.make_aware(parse_datetime(end)))
+            for start, end in zip(request.GET.getlist('start'), request.GET.getlist('end'))
+        ]
+    except (TypeError, ValueError, AttributeError):  # parse_datetime returns None for strings that do not look like a date
+        raise Http404('Bad date format')
+
+    if not ranges or len(ranges) > MAX_CHECKED_ENTRIES or len(request.GET.getlist('start')) != len(request.GET.getlist('end')):
+        raise Http404('Bad range count')
+
+    Teacher = apps.get_model('teachers.Teacher')
+
+    s = AutoSchedule(
+        teacher=get_object_or_404(Teacher, user__username=username),
+        start=min(start for start, end in ranges),
+        end=max(end for start, end in ranges),
+    )
+
+    results = []
+    for start, end in ranges:
+        try:
+            s.clean(start, end)
+        except ValidationError as e:
+            result = e.__class__.__name__
+        else:
+            result = 'ok'
+
+        results.append({
+            'start': timezone.localtime(start).isoformat(),
+            'end': timezone.localtime(end).isoformat(),
+            'result': result,
+        })
+
+    return JsonResponse({'result': results})
+
+
+def _occurrences_response(results):
+    return JsonResponse({'result': [{
+        'start': timezone.localtime(result['start']).isoformat(),
+        'result': result['result'],
+        'pk': result['entry'].pk if result['entry'] is not None else None,
+    } for result in results]})
+
+
+@staff_member_required
+@require_POST
+def create_recurring(request, username):
+    """
+    Create a lesson on selected weekdays for a number of weeks, see TimelineEntry.objects.create_recurring().
+
+    Returns a JSON with the result for every occurrence: 'ok' or the validation exception name.
+    """
+    Teacher = apps.get_model('teachers.Teacher')
+    teacher = get_object_or_404(Teacher, user__username=username)
+
+    form = RecurringEntryForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+
+    results = TimelineEntry.objects.create_recurring(
+        teacher=teacher,
+        lesson=form.cleaned_data['lesson'],
+        start=form.cleaned_data['start'],
+        weekdays=form.cleaned_data['weekdays'],
+        weeks=form.cleaned_data['weeks'],
+    )
+    return _occurrences_response(results)
+
+
+@staff_member_required
+@require_POST
+def copy_week(request, username, date):
+    """
+    Copy hosted lessons of the teacher from the previous week to the week, starting from date,
+    see TimelineEntry.objects.copy_week(). Returns a JSON in the create_recurring() format.
+    """
+    Teacher = apps.get_model('teachers.Teacher')
+    teacher = get_object_or_404(Teacher, user__username=username)
+
+    week_start = parse_datetime(date + ' 00:00:00')
+    if week_start is None:
+        raise Http404('Bad date format')
+
+    results = TimelineEntry.objects.copy_week(teacher, timezone.make_aware(week_start))
+    return _occurrences_response(results)